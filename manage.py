@@ -1,12 +1,16 @@
-import threading
+import sys
 
-from flask.cli import FlaskGroup
+import click
+
+from flask.cli import FlaskGroup, run_command
 from dotenv import load_dotenv
 
 from src import create_app, db
 from src.blockchain import Blockchain
 from src.factory_peer_to_peer import FactoryPeerToPeer
 from src.kafka_peer_to_peer import create_kafka
+from src.validator import ChainValidationError, ChainValidator
+from src.zmq_async_peer_to_peer import create_async_zmq
 from src.zmq_peer_to_peer import create_zmq
 
 load_dotenv()
@@ -22,20 +26,26 @@ blockchain = Blockchain(app)
 
 FactoryPeerToPeer.register('zmq', create_zmq)
 FactoryPeerToPeer.register('kafka', create_kafka)
-peer_to_peer = FactoryPeerToPeer.create(app, app.config['COMM'])
-peer_to_peer.bootstrap()
+FactoryPeerToPeer.register('zmq_async', create_async_zmq)
+
 
-t1 = threading.Thread(target=peer_to_peer.awaiting_received_node)
-t2 = threading.Thread(target=peer_to_peer.awaiting_received_chain)
-t3 = threading.Thread(target=peer_to_peer.awaiting_transaction_broadcast)
+def start_node():
+    """Binds the publishers, joins the network and starts receiving, only the `run` command is a node."""
+    peer_to_peer = FactoryPeerToPeer.create(app, app.config['COMM'])
+    peer_to_peer.bootstrap()
+    peer_to_peer.start_receiving()
 
-t1.start()
-t2.start()
-t3.start()
 
 cli = FlaskGroup(create_app=create_app, params={})
 
 
+@cli.command('run', params=run_command.params, help=run_command.help, with_appcontext=False)
+@click.pass_context
+def run(ctx, **kwargs):
+    start_node()
+    ctx.invoke(run_command, **kwargs)
+
+
 @cli.command('recreate_db')
 def recreate_db():
     """Initializes the database"""
@@ -44,5 +54,20 @@ def recreate_db():
     db.session.commit()
 
 
+@cli.command('validate_chain')
+@click.option('--from-height', type=int, default=None, help='First block to check, by default after the checkpoint')
+@click.option('--to-height', type=int, default=None, help='Last block to check, by default the tip')
+@click.option('--workers', type=int, default=None, help='Processes hashing blocks and checking signatures')
+@click.option('--full', is_flag=True, help='Ignore the checkpoint and check the whole chain')
+def validate_chain(from_height, to_height, workers, full):
+    """Validates the stored chain"""
+    try:
+        height = ChainValidator(app, workers).validate_chain(from_height, to_height, use_checkpoint=not full)
+    except ChainValidationError as e:
+        print('Chain invalid: ', e)
+        sys.exit(1)
+    print(f'Chain valid up to block {height}.')
+
+
 if __name__ == '__main__':
     cli()
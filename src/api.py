@@ -1,14 +1,24 @@
-import os
+import hashlib
+import json
+import threading
 
-from fastecdsa.keys import import_key
-from flask import Blueprint, request, current_app
+from flask import Blueprint, Response, request, current_app, stream_with_context
 from flask_cors import CORS
-from flask_restx import Resource, Api, fields
+from flask_restx import Resource, Api, fields, inputs, marshal, reqparse
 from http import HTTPStatus
-
-from src.models import Block, Node, Transaction
+from sqlalchemy import func, select
+from typing import List, Optional
+
+from src import db
+from src.block_cache import block_cache
+from src.key_cache import public_key_cache
+from src.merkle import merkle_proof
+from src.models import Block, BlockTreeEntry, Node, Transaction
 from src.factory_peer_to_peer import FactoryPeerToPeer
 from src.kafka_peer_to_peer import create_kafka
+from src.submitter import TransactionSubmitter
+from src.utilities import Utilities
+from src.zmq_async_peer_to_peer import create_async_zmq
 from src.zmq_peer_to_peer import create_zmq
 
 api_blueprint = Blueprint('api', __name__)
@@ -17,6 +27,7 @@ cors = CORS(api_blueprint, resources={r"*": {"origins": "*"}})
 
 FactoryPeerToPeer.register('zmq', create_zmq)
 FactoryPeerToPeer.register('kafka', create_kafka)
+FactoryPeerToPeer.register('zmq_async', create_async_zmq)
 
 
 # transaction resource
@@ -29,6 +40,7 @@ transaction_api_model = api.model('Transaction', {
 
 transaction_model = api.model('Transaction', {
     'id': fields.Integer(readOnly=True),
+    'transaction_hash': fields.String(readOnly=True),
     'public_key': fields.String(required=True),
     'transaction_data_string': fields.String(required=True),
     'signature': fields.String(required=True),
@@ -36,15 +48,16 @@ transaction_model = api.model('Transaction', {
 })
 
 
-class TransactionsList(Resource):
+class SigningResource(Resource):
+    """Resources signing transactions with the keys of this node."""
 
     def __init__(self, api=None, *args, **kwargs):
         super().__init__(api, args, kwargs)
-        # get the path of the current file
-        current_file_path = __file__
-        # get the directory path
-        current_directory_path = os.path.dirname(os.path.abspath(current_file_path))
-        self.private_key, self.public_key = import_key(f'{current_directory_path}/../keys/private_key.pem')
+        # flask-restx instantiates the resource per request, the keys are only read once per process
+        self.private_key, self.public_key = Utilities.node_keys()
+
+
+class TransactionsList(SigningResource):
 
     @api.expect(transaction_api_model, validate=True)
     def post(self):
@@ -57,9 +70,20 @@ class TransactionsList(Resource):
             'practice_number': practice_number,
             'notes': notes,
         }
+        if current_app.config.get('TRANSACTION_ACCEPT_MODE', 'sync') == 'async':
+            # signed and broadcast by the submitter workers, the status endpoint tells how it went
+            tracking_id = get_submitter().submit(data)
+            if tracking_id is None:
+                api.abort(HTTPStatus.SERVICE_UNAVAILABLE, 'Too many transactions waiting, try again later')
+            return {
+                'tracking_id': tracking_id,
+                'status_url': api.url_for(TransactionSubmission, tracking_id=tracking_id),
+            }, HTTPStatus.ACCEPTED
         transaction = Transaction(public_key=self.public_key, private_key=self.private_key, data=data)
         peer_to_peer = FactoryPeerToPeer.create(current_app, current_app.config['COMM'])
-        peer_to_peer.broadcast(peer_to_peer.transaction_publisher, transaction.as_dict(), topic='transaction')
+        if peer_to_peer.broadcast(peer_to_peer.transaction_publisher, transaction.as_dict(),
+                                  topic='transaction') is False:
+            api.abort(HTTPStatus.SERVICE_UNAVAILABLE, 'The transaction could not be broadcast, try again later')
 
         response_object = {
             'message': f'{transaction.transaction_data_string}'
@@ -74,6 +98,105 @@ class TransactionsList(Resource):
 api.add_resource(TransactionsList, '/transactions')
 
 
+_submitter = None
+_submitter_lock = threading.Lock()
+
+
+def broadcast_transactions(transactions: List[dict]) -> bool:
+    peer_to_peer = FactoryPeerToPeer.create(current_app, current_app.config['COMM'])
+    return peer_to_peer.broadcast_batch(peer_to_peer.transaction_publisher, transactions, topic='transaction')
+
+
+def get_submitter() -> TransactionSubmitter:
+    global _submitter
+    with _submitter_lock:
+        if _submitter is None:
+            config = current_app.config
+            _submitter = TransactionSubmitter(current_app._get_current_object(), Utilities.node_keys(),
+                                              broadcast_transactions,
+                                              workers=config.get('TRANSACTION_SUBMIT_WORKERS', 1),
+                                              max_queued=config.get('TRANSACTION_QUEUE_SIZE', 10000),
+                                              max_batch=config.get('TRANSACTION_SUBMIT_BATCH_SIZE', 256))
+            _submitter.start()
+    return _submitter
+
+
+class TransactionSubmission(Resource):
+
+    def get(self, tracking_id):
+        """Status (`queued`, `created` or `failed`) of a transaction accepted in the asynchronous mode."""
+        status = get_submitter().status(tracking_id)
+        if status is None:
+            api.abort(HTTPStatus.NOT_FOUND, f'Submission {tracking_id} not found')
+        return status, HTTPStatus.OK
+
+
+api.add_resource(TransactionSubmission, '/transactions/submissions/<string:tracking_id>')
+
+
+def record_error(record) -> Optional[str]:
+    if not isinstance(record, dict):
+        return 'A record must be an object'
+    for name, field in transaction_api_model.items():
+        if field.required and not isinstance(record.get(name), str):
+            return f"'{name}' is a required string"
+    return None
+
+
+class TransactionsBatch(SigningResource):
+
+    def post(self):
+        """
+        Signs a list of records as a group and broadcasts them in one send.
+        :return: one result per record, in the same order
+        """
+        records = request.get_json(silent=True)
+        if not isinstance(records, list) or not records:
+            api.abort(HTTPStatus.BAD_REQUEST, 'Expected a non empty list of records')
+        max_size = current_app.config.get('TRANSACTION_BATCH_MAX_SIZE', 10000)
+        if len(records) > max_size:
+            api.abort(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f'At most {max_size} records per batch')
+
+        results = [None] * len(records)
+        accepted = []
+        for index, record in enumerate(records):
+            error = record_error(record)
+            if error:
+                results[index] = {'index': index, 'status': 'rejected', 'message': error}
+            else:
+                accepted.append((index, {name: record[name] for name in ('full_names', 'practice_number', 'notes')}))
+        transactions = Transaction.create_batch(self.public_key, self.private_key, [data for _, data in accepted],
+                                                workers=current_app.config.get('VERIFY_WORKERS', 1))
+        broadcast = True
+        if transactions:
+            broadcast = broadcast_transactions([transaction.as_dict() for transaction in transactions])
+        for (index, _), transaction in zip(accepted, transactions):
+            results[index] = {
+                'index': index,
+                'status': 'created' if broadcast else 'failed',
+                'transaction_hash': transaction.transaction_hash,
+                'message': transaction.transaction_data_string,
+            }
+
+        if not broadcast:
+            status = HTTPStatus.SERVICE_UNAVAILABLE
+        elif len(accepted) == len(records):
+            status = HTTPStatus.CREATED
+        elif accepted:
+            status = HTTPStatus.MULTI_STATUS
+        else:
+            status = HTTPStatus.BAD_REQUEST
+        response_object = {
+            'created': len(accepted) if broadcast else 0,
+            'rejected': len(records) - len(accepted),
+            'results': results,
+        }
+        return response_object, status
+
+
+api.add_resource(TransactionsBatch, '/transactions/batch')
+
+
 class Transactions(Resource):
 
     @api.marshal_with(transaction_model)
@@ -86,6 +209,63 @@ class Transactions(Resource):
 
 api.add_resource(Transactions, '/transactions/<int:transaction_id>')
 
+
+class TransactionProof(Resource):
+
+    def get(self, transaction_id):
+        """
+        Merkle inclusion proof of a mined transaction, `transaction_id` is either its `transaction_hash` or the id
+        inside `transaction_data_string`.
+        """
+        for block in Block.query.filter(Block.data.contains(transaction_id)).order_by(Block.id.desc()):
+            transactions = block.transactions()
+            for index, transaction in enumerate(transactions):
+                if transaction.get('transaction_hash') != transaction_id and \
+                        json.loads(transaction['transaction_data_string']).get('transaction_id') != transaction_id:
+                    continue
+                leaves = block.leaves()
+                return {
+                    'transaction': transaction,
+                    'block_id': block.id,
+                    'block_hash': block.hash,
+                    'merkle_root': block.merkle_root,
+                    'leaf': leaves[index],
+                    'index': index,
+                    'proof': merkle_proof(leaves, index),
+                }, HTTPStatus.OK
+        api.abort(HTTPStatus.NOT_FOUND, f'Transaction {transaction_id} not found in any block')
+
+
+api.add_resource(TransactionProof, '/transactions/<string:transaction_id>/proof')
+
+
+class PublicKeyCacheStats(Resource):
+
+    def get(self):
+        return public_key_cache.stats(), HTTPStatus.OK
+
+
+api.add_resource(PublicKeyCacheStats, '/stats/public-key-cache')
+
+
+class BlockCacheStats(Resource):
+
+    def get(self):
+        return block_cache.stats(), HTTPStatus.OK
+
+
+api.add_resource(BlockCacheStats, '/stats/block-cache')
+
+
+class TransportStats(Resource):
+
+    def get(self):
+        peer_to_peer = FactoryPeerToPeer.create(current_app, current_app.config['COMM'])
+        return peer_to_peer.transport_stats(), HTTPStatus.OK
+
+
+api.add_resource(TransportStats, '/stats/transport')
+
 # node resource
 node_model = api.model('Node', {
     'id': fields.Integer(readOnly=True),
@@ -128,29 +308,162 @@ block_model = api.model('Block', {
     'prev_hash': fields.String(required=True),
     'nonce': fields.Integer(required=True),
     'data': fields.String(required=True),
+    'merkle_root': fields.String(),
     'timestamp': fields.String(required=True),
+    'target': fields.String(),
     'hash': fields.String(required=True),
 })
 
 
+@api_blueprint.record_once
+def configure_block_cache(state):
+    block_cache.resize(state.app.config.get('BLOCK_CACHE_SIZE', 1024))
+
+
+def serialise_block(block: Block) -> str:
+    serialised = json.dumps(marshal(block, block_model))
+    block_cache.put(block.id, block.hash, serialised)
+    return serialised
+
+
+def serialise_blocks(rows) -> str:
+    """
+    :param rows: (id, hash) of the blocks, in order. Only the ones missing in `block_cache` are read and marshalled.
+    """
+    serialised = {row.id: block_cache.get(row.id, row.hash) for row in rows}
+    missing = [block_id for block_id, block in serialised.items() if block is None]
+    for start in range(0, len(missing), 500):
+        for block in Block.query.filter(Block.id.in_(missing[start:start + 500])):
+            serialised[block.id] = serialise_block(block)
+    return '[' + ','.join(serialised[row.id] for row in rows) + ']'
+
+
+def json_response(body: Optional[str], etag: str, cache_control: str, headers: Optional[dict] = None) -> Response:
+    """:param body: None for a `304 Not Modified`"""
+    if body is None:
+        response = Response(status=HTTPStatus.NOT_MODIFIED)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    response.headers.extend(headers or {})
+    return response
+
+
 class Blocks(Resource):
 
-    @api.marshal_with(block_model)
+    @api.response(HTTPStatus.OK, 'Success', block_model)
     def get(self, block_id):
-        block = Block.query.filter_by(id=block_id).first()
-        if not block:
+        """
+        Strong ETag: the hash of the block. Blocks buried BLOCK_CONFIRMATIONS deep are not expected to change any more
+        and can be cached for BLOCK_CACHE_MAX_AGE seconds, the others have to be revalidated.
+        """
+        block_hash = db.session.query(Block.hash).filter_by(id=block_id).scalar()
+        if block_hash is None:
             api.abort(HTTPStatus.NOT_FOUND, f'Block {block_id} not found')
-        return block, HTTPStatus.OK
+        tip_id = db.session.query(func.max(Block.id)).scalar()
+        if tip_id - block_id + 1 >= current_app.config.get('BLOCK_CONFIRMATIONS', 6):
+            cache_control = f'public, max-age={current_app.config.get("BLOCK_CACHE_MAX_AGE", 86400)}'
+        else:
+            cache_control = 'no-cache'
+        if request.if_none_match.contains(block_hash):
+            return json_response(None, block_hash, cache_control)
+        body = block_cache.get(block_id, block_hash)
+        if body is None:
+            body = serialise_block(Block.query.filter_by(id=block_id).first())
+        return json_response(body, block_hash, cache_control)
 
 
 api.add_resource(Blocks, '/blocks/<int:block_id>')
 
 
+class BlockTip(Resource):
+
+    @api.marshal_with(block_model)
+    def get(self):
+        """The last block of the active chain."""
+        block = Block.query.order_by(Block.id.desc()).first()
+        if not block:
+            api.abort(HTTPStatus.NOT_FOUND, 'No blocks yet')
+        return block, HTTPStatus.OK
+
+
+api.add_resource(BlockTip, '/blocks/tip')
+
+
+blocks_parser = reqparse.RequestParser()
+blocks_parser.add_argument('from_height', type=inputs.positive, location='args',
+                           help='First height (block id) returned')
+blocks_parser.add_argument('after_hash', type=str, location='args', help='Cursor, the blocks after this one')
+blocks_parser.add_argument('limit', type=inputs.positive, location='args', help='How many blocks at most')
+
+
+def blocks_select(args):
+    """The active chain in height order, from `from_height` and/or after the block `after_hash`."""
+    statement = select(Block).order_by(Block.id)
+    if args.get('from_height') is not None:
+        statement = statement.where(Block.id >= args['from_height'])
+    if args.get('after_hash'):
+        # the block tree is indexed by hash, the block table is not
+        entry = db.session.get(BlockTreeEntry, args['after_hash'])
+        after = Block.query.filter_by(id=entry.height).first() if entry else \
+            Block.query.filter_by(hash=args['after_hash']).first()
+        if after is None or after.hash != args['after_hash']:
+            api.abort(HTTPStatus.NOT_FOUND, f'Block {args["after_hash"]} not found in the active chain')
+        statement = statement.where(Block.id > after.id)
+    return statement
+
+
 class BlocksList(Resource):
 
-    @api.marshal_with(block_model, as_list=True)
+    @api.expect(blocks_parser)
+    @api.response(HTTPStatus.OK, 'Success', [block_model])
     def get(self):
-        return Block.query.all(), HTTPStatus.OK
+        """
+        The whole chain, or a page of it when any of `from_height`, `after_hash` or `limit` is given. The `Link`
+        header of a full page points to the next one. Strong ETag: the hash of the tip (and the query), so pollers
+        get a `304 Not Modified` until a block arrives.
+        """
+        args = blocks_parser.parse_args()
+        tip_hash = db.session.query(Block.hash).order_by(Block.id.desc()).limit(1).scalar() or 'empty'
+        etag = tip_hash
+        if request.query_string:
+            etag += '-' + hashlib.sha256(request.query_string).hexdigest()[:16]
+        if request.if_none_match.contains(etag):
+            return json_response(None, etag, 'no-cache')
+
+        if all(args.get(name) is None for name in ('from_height', 'after_hash', 'limit')):
+            rows = db.session.query(Block.id, Block.hash).order_by(Block.id).all()
+            return json_response(serialise_blocks(rows), etag, 'no-cache')
+        limit = min(args['limit'] or current_app.config.get('BLOCKS_PAGE_SIZE', 100),
+                    current_app.config.get('BLOCKS_MAX_PAGE_SIZE', 1000))
+        rows = db.session.execute(blocks_select(args).with_only_columns(Block.id, Block.hash).limit(limit)).all()
+        headers = {}
+        if len(rows) == limit:
+            next_page = api.url_for(BlocksList, after_hash=rows[-1].hash, limit=limit)
+            headers['Link'] = f'<{next_page}>; rel="next"'
+        return json_response(serialise_blocks(rows), etag, 'no-cache', headers)
 
 
 api.add_resource(BlocksList, '/blocks')
+
+
+class BlocksStream(Resource):
+
+    @api.expect(blocks_parser)
+    def get(self):
+        """The blocks as newline delimited JSON, read through a server side cursor instead of a list."""
+        args = blocks_parser.parse_args()
+        statement = blocks_select(args)
+        if args['limit'] is not None:
+            statement = statement.limit(args['limit'])
+        batch_size = current_app.config.get('BLOCKS_STREAM_BATCH_SIZE', 500)
+
+        def generate():
+            for block in db.session.scalars(statement, execution_options={'yield_per': batch_size}):
+                yield json.dumps(marshal(block, block_model)) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+api.add_resource(BlocksStream, '/blocks/stream')
@@ -0,0 +1,61 @@
+import threading
+
+from collections import OrderedDict
+from typing import Optional
+
+
+class BlockCache:
+    """
+    Bounded LRU of blocks serialised as the API returns them, keyed by height. An entry is only served for the hash
+    it was stored with, so a block replaced by a reorg is never returned even before `invalidate_from` runs.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        # height -> (hash, serialised block)
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, height: int, block_hash: str) -> Optional[str]:
+        with self.lock:
+            entry = self.blocks.get(height)
+            if entry is None or entry[0] != block_hash:
+                self.misses += 1
+                return None
+            self.blocks.move_to_end(height)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, height: int, block_hash: str, serialised: str):
+        with self.lock:
+            self.blocks[height] = (block_hash, serialised)
+            self.blocks.move_to_end(height)
+            while len(self.blocks) > self.max_size:
+                self.blocks.popitem(last=False)
+
+    def invalidate_from(self, height: int):
+        """Forgets the blocks from `height` up, they left the active chain."""
+        with self.lock:
+            for cached_height in [cached_height for cached_height in self.blocks if cached_height >= height]:
+                del self.blocks[cached_height]
+
+    def resize(self, max_size: int):
+        with self.lock:
+            self.max_size = max_size
+            while len(self.blocks) > self.max_size:
+                self.blocks.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'size': len(self.blocks), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses}
+
+
+# shared by the API and the chain receiving loop of the process
+block_cache = BlockCache()
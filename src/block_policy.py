@@ -0,0 +1,40 @@
+import time
+
+from typing import Optional
+
+from src.mempool import Mempool
+
+
+class BlockProductionPolicy:
+    """
+    Decides when the pending transactions of a mempool have to be sealed into a block: as soon as the count or the
+    byte budget is reached, or when the oldest pending transaction has waited longer than `max_pending_seconds`.
+    """
+
+    def __init__(self, max_transactions: int, max_bytes: Optional[int] = None,
+                 max_pending_seconds: Optional[float] = None):
+        self.max_transactions = max_transactions
+        self.max_bytes = max_bytes
+        self.max_pending_seconds = max_pending_seconds
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(max_transactions=config.get('BLOCK_MAX_TRANSACTIONS', config['TRANSACTIONS_AMOUNT']),
+                   max_bytes=config.get('BLOCK_MAX_BYTES'),
+                   max_pending_seconds=config.get('BLOCK_MAX_PENDING_SECONDS'))
+
+    def size_reached(self, mempool: Mempool) -> bool:
+        if len(mempool) >= self.max_transactions:
+            return True
+        return self.max_bytes is not None and mempool.pending_bytes >= self.max_bytes
+
+    def deadline_passed(self, mempool: Mempool, now: Optional[float] = None) -> bool:
+        if self.max_pending_seconds is None:
+            return False
+        oldest_arrival = mempool.oldest_arrival()
+        if oldest_arrival is None:
+            return False
+        return (time.monotonic() if now is None else now) - oldest_arrival >= self.max_pending_seconds
+
+    def should_seal(self, mempool: Mempool, now: Optional[float] = None) -> bool:
+        return len(mempool) > 0 and (self.size_reached(mempool) or self.deadline_passed(mempool, now))
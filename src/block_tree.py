@@ -0,0 +1,161 @@
+import json
+
+from typing import List, Optional, Tuple
+
+from src import db
+from src.block_cache import block_cache
+from src.difficulty import MAX_TARGET, block_work
+from src.models import Block, BlockTreeEntry, MinedTransaction
+
+WORK_DIGITS = 80
+
+
+def work_to_hex(work: int) -> str:
+    return f'{work:0{WORK_DIGITS}x}'
+
+
+class BlockTree:
+    """
+    Every valid block this node knows about, side branches included, indexed by hash and by parent. The `block`
+    table holds the active chain: the branch ending at the tip with the most cumulative work. Switching branches
+    only rewrites the blocks after the common ancestor, found by walking back from both tips. There is a single root:
+    the genesis block this node created or received first.
+    Nothing is committed here, the callers commit the tree and the active chain together.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def get(block_hash: str) -> Optional[BlockTreeEntry]:
+        return db.session.get(BlockTreeEntry, block_hash)
+
+    def index_chain(self):
+        """Fills an empty tree with the active chain, e.g. the first time a node runs with a block tree."""
+        if BlockTreeEntry.query.first() is not None:
+            return
+        for block in Block.query.order_by(Block.id).all():
+            if self.add(block) is None:
+                print(f'Block {block.id} could not be indexed, it does not follow block {block.id - 1}.')
+                return
+            self.index_transactions(block)
+
+    def add(self, block: Block) -> Optional[BlockTreeEntry]:
+        """:return: the entry of `block`, None if its parent is unknown or its id is not its height"""
+        entry = self.get(block.hash)
+        if entry is not None:
+            return entry
+        parent = self.get(block.prev_hash)
+        if parent is None:
+            if int(block.id) != 1:
+                return None
+            genesis_hash = self.genesis_hash()
+            if genesis_hash is not None and block.hash != genesis_hash:
+                print(f'Block {block.hash} claims to be the genesis block, this node started from {genesis_hash}.')
+                return None
+        height = parent.height + 1 if parent else 1
+        if int(block.id) != height:
+            print(f'Block {block.hash} claims to be block {block.id} but it is at height {height}.')
+            return None
+        # the target of the genesis block is not checked by anyone, it does not count
+        target = int(block.target, 16) if parent and block.target else MAX_TARGET
+        work = (int(parent.work, 16) if parent else 0) + block_work(target)
+        entry = BlockTreeEntry(hash=block.hash, parent_hash=block.prev_hash, height=height, work=work_to_hex(work),
+                               block=json.dumps(block.as_dict()))
+        db.session.add(entry)
+        # visible to the queries of the same transaction
+        db.session.flush()
+        return entry
+
+    @staticmethod
+    def index_transactions(block: Block):
+        """Records the transactions of a block joining the active chain, see `MinedTransaction`."""
+        for transaction in block.transactions():
+            if isinstance(transaction, dict) and transaction.get('transaction_hash'):
+                db.session.add(MinedTransaction(transaction_hash=transaction['transaction_hash'], block_id=block.id))
+
+    @staticmethod
+    def genesis_hash() -> Optional[str]:
+        """The root of the tree (or of the active chain), None on a node that has no blocks yet."""
+        root = BlockTreeEntry.query.filter_by(height=1).first()
+        if root is not None:
+            return root.hash
+        genesis = Block.query.filter_by(id=1).first()
+        return genesis.hash if genesis else None
+
+    def ancestors(self, block_hash: str, count: int) -> List[Block]:
+        """Up to `count` blocks of the branch ending at `block_hash` (included), oldest first."""
+        blocks = []
+        entry = self.get(block_hash)
+        while entry is not None and len(blocks) < count:
+            blocks.append(Block.from_dict(json.loads(entry.block)))
+            entry = self.get(entry.parent_hash)
+        blocks.reverse()
+        return blocks
+
+    def side_branch(self, block_hash: str) -> List[Block]:
+        """The blocks of the branch ending at `block_hash` (included) that are not on the active chain, oldest first."""
+        blocks = []
+        entry = self.get(block_hash)
+        while entry is not None:
+            active = Block.query.filter_by(id=entry.height).first()
+            if active is not None and active.hash == entry.hash:
+                break
+            blocks.append(Block.from_dict(json.loads(entry.block)))
+            entry = self.get(entry.parent_hash)
+        blocks.reverse()
+        return blocks
+
+    @staticmethod
+    def best_tip() -> Optional[BlockTreeEntry]:
+        return BlockTreeEntry.query.order_by(BlockTreeEntry.work.desc(), BlockTreeEntry.height.desc()).first()
+
+    def fork(self, old_tip: Optional[BlockTreeEntry], new_tip: BlockTreeEntry) \
+            -> Tuple[Optional[BlockTreeEntry], List[BlockTreeEntry], List[BlockTreeEntry]]:
+        """
+        :return: the common ancestor, the entries leaving the active chain (tip first) and the ones joining it
+        (oldest first)
+        """
+        leaving, joining = [], []
+        old, new = old_tip, new_tip
+        while old is not None and (new is None or old.height > new.height):
+            leaving.append(old)
+            old = self.get(old.parent_hash)
+        while new is not None and (old is None or new.height > old.height):
+            joining.append(new)
+            new = self.get(new.parent_hash)
+        while old is not None and new is not None and old.hash != new.hash:
+            leaving.append(old)
+            joining.append(new)
+            old, new = self.get(old.parent_hash), self.get(new.parent_hash)
+        joining.reverse()
+        return old, leaving, joining
+
+    def follow_best_tip(self) -> Tuple[List[Block], List[Block]]:
+        """
+        Makes the branch with the most cumulative work the active chain, ties keep the current one.
+        :return: the blocks that left the active chain and the ones that joined it, both empty if nothing changed
+        """
+        best = self.best_tip()
+        tip = Block.query.order_by(Block.id.desc()).first()
+        current = self.get(tip.hash) if tip else None
+        if best is None or (current is not None and int(best.work, 16) <= int(current.work, 16)):
+            return [], []
+        ancestor, leaving, joining = self.fork(current, best)
+        ancestor_height = ancestor.height if ancestor else 0
+        undone = Block.query.filter(Block.id > ancestor_height).order_by(Block.id).all()
+        for block in undone:
+            # still readable once their rows are gone
+            db.session.expunge(block)
+        if leaving:
+            print(f'Reorg: {len(leaving)} blocks after block {ancestor_height} replaced by {len(joining)}.')
+            block_cache.invalidate_from(ancestor_height + 1)
+        db.session.query(Block).filter(Block.id > ancestor_height).delete()
+        db.session.query(MinedTransaction).filter(MinedTransaction.block_id > ancestor_height).delete()
+        done = []
+        for entry in joining:
+            block = Block.from_dict(json.loads(entry.block))
+            db.session.add(block)
+            self.index_transactions(block)
+            done.append(block)
+        return undone, done
@@ -1,11 +1,15 @@
 import asyncio
-import hashlib
 import json
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from sqlalchemy import select
 from sqlalchemy.exc import SQLAlchemyError
+from typing import Iterator, List, Optional
 
 from src import db
+from src.block_tree import BlockTree
+from src.difficulty import initial_target, meets_target, retarget, target_to_hex
+from src.mining import parallel_search_nonce, search_nonce
 from src.models import Block, Node, Transaction
 from src.utilities import Utilities
 
@@ -21,7 +25,8 @@ class Blockchain:
                 timestamp = datetime.utcnow()
                 data = 'This is the genesis block'
                 # timestamp is cast to string inside Block init
-                block = Block(prev_hash='000000000', nonce=456, data=data, timestamp=timestamp)
+                block = Block(prev_hash='000000000', nonce=456, data=data, timestamp=timestamp,
+                              target=target_to_hex(initial_target(self.app.config)))
                 block.encode_block()
                 db.session.add(block)
                 db.session.commit()
@@ -30,39 +35,153 @@ class Blockchain:
         return False
 
     def proof_of_work(self) -> Block:
-        verified_transactions = []
-        transactions = Transaction.query.all()
-        for transaction in transactions:
-            verified_transactions.append(transaction.as_dict())
-        verified_transactions_str = json.dumps(verified_transactions, sort_keys=True)
+        return self.mine(self.prepare_block())
+
+    def prepare_block(self, transactions: Optional[List[dict]] = None) -> Block:
+        """
+        Builds the next block on top of the tip.
+        :param transactions: as dicts (see `Transaction.as_dict`), by default everything in the `transaction` table
+        """
+        if transactions is None:
+            transactions = [transaction.as_dict() for transaction in Transaction.query.order_by(Transaction.id).all()]
+        verified_transactions_str = json.dumps(transactions, sort_keys=True)
 
-        timestamp = datetime.utcnow()
         last_block = Block.query.order_by(Block.id.desc()).first()
-        block = Block(prev_hash=last_block.hash, nonce=456, data=verified_transactions_str, timestamp=timestamp)
+        # a block has to come after its parent, timestamps only have seconds
+        timestamp = max(datetime.utcnow(),
+                        datetime.strptime(last_block.timestamp, '%Y-%m-%dT%H:%M:%SZ') + timedelta(seconds=1))
+        block = Block(prev_hash=last_block.hash, nonce=456, data=verified_transactions_str, timestamp=timestamp,
+                      target=target_to_hex(self.next_target(last_block)))
         block.id = last_block.id + 1
+        return block
 
-        mining = False
-        while mining is False:
-            block.encode_block()
-            new_hash = hashlib.sha256(json.dumps(block.as_dict(), sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+    def next_target(self, last_block: Block) -> int:
+        """
+        With DIFFICULTY_BLOCK_SECONDS set, the target of the tip is kept and every DIFFICULTY_RETARGET_INTERVAL
+        blocks it is scaled by the observed block time. Otherwise the target comes straight from the config.
+        """
+        block_seconds = self.app.config.get('DIFFICULTY_BLOCK_SECONDS')
+        if not block_seconds or not last_block.target:
+            return initial_target(self.app.config)
+        target = int(last_block.target, 16)
+        interval = self.app.config.get('DIFFICULTY_RETARGET_INTERVAL', 10)
+        if last_block.id % interval != 0:
+            return target
+        timestamps = [row.timestamp for row in Block.query.filter(Block.id >= last_block.id - interval)
+                      .order_by(Block.id).with_entities(Block.timestamp).all()]
+        new_target = retarget(target, timestamps, block_seconds)
+        print(f'Difficulty retargeted at block {last_block.id}: {target_to_hex(target)} -> {target_to_hex(new_target)}')
+        return new_target
 
-            if new_hash[:len(self.app.config['NONCE_ZEROES'])] == self.app.config['NONCE_ZEROES']:
-                mining = True
+    def mine(self, block: Block, cancel_event=None) -> Optional[Block]:
+        """
+        Searches the nonce of a block prepared by `prepare_block`.
+        :param cancel_event: when set (by another thread) the search is abandoned and None is returned
+        """
+        workers = self.app.config.get('MINING_WORKERS', 1)
+        if not block.target:
+            block.target = target_to_hex(initial_target(self.app.config))
+        target = int(block.target, 16)
+        result = None
+        while result is None:
+            if workers > 1:
+                result = parallel_search_nonce(block.header_dict(), target, workers, start=block.nonce,
+                                               cancel_event=cancel_event)
             else:
-                block.nonce += 1
-                block.encode_block()
-                new_hash = hashlib.sha256(json.dumps(block.as_dict(), sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+                result = search_nonce(block.header_dict(), target, start=block.nonce, stop_event=cancel_event)
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+            if result is None:
+                # nonce space exhausted for this timestamp, try again with a fresh one (never before the prepared one,
+                # it follows the parent's)
+                block.timestamp = max(block.timestamp, datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'))
+                block.nonce = 0
+        block.nonce, new_hash = result
 
         print(f'\n\n\nNew block mined: {new_hash}\n\n\n')
         block.hash = new_hash
         return block
 
-    def get_blocks_as_list_of_dict(self):
-        blocks = Block.query.all()
-        _blocks = []
+    @staticmethod
+    def verify_branch(prev_hash: str, blocks: List[Block]) -> bool:
+        """
+        Whether `blocks` hang one after another from `prev_hash` and every hash matches its header and its target.
+        """
         for block in blocks:
-            _blocks.append(block.as_dict())
-        return _blocks
+            if block.prev_hash != prev_hash:
+                print(f'Block {block.id} does not follow {prev_hash}.')
+                return False
+            # the genesis block is hashed differently, see `create_genesis_block`
+            if block.id != 1 and block.hash != block.calculate_hash():
+                print(f'Block {block.id} does not match its hash {block.hash}.')
+                return False
+            if block.id != 1 and block.target and not meets_target(block.hash, int(block.target, 16)):
+                print(f'Block {block.id} does not meet its target.')
+                return False
+            prev_hash = block.hash
+        return True
+
+    def fetch_branch(self, node: Node, first_block: Block, tree: BlockTree) -> Optional[List[Block]]:
+        """
+        Asks `node` for the ancestors of `first_block` missing in the block tree. The first request only covers the
+        blocks above the local best tip, what a node a few blocks behind misses; when they do not link to a known block
+        a second one goes down to MAX_FORK_DEPTH blocks below `first_block`. A branch forking deeper than that, or
+        a block that far ahead of the local chain, is rejected (see `PeerToPeer.fetch_missing`). No lock is needed, the
+        caller checks the branch again before adding it.
+        :return: the missing blocks in chain order, None if they could not be fetched
+        """
+        if first_block.id <= 1:
+            return []
+        deepest_id = max(first_block.id - self.app.config.get('MAX_FORK_DEPTH', 100), 1)
+        best = tree.best_tip()
+        lowest_id = min((best.height if best else 0) + 1, first_block.id - 1)
+        if lowest_id < deepest_id:
+            print(f'Block {first_block.id} is more than {first_block.id - deepest_id} blocks ahead of this node, '
+                  f'ignored.')
+            return None
+        blocks = self.fetch_range(node, lowest_id, first_block.id - 1)
+        if blocks is None:
+            return None
+        if blocks[0].id != 1 and tree.get(blocks[0].prev_hash) is None and lowest_id > deepest_id:
+            # a fork below the local tip
+            deeper = self.fetch_range(node, deepest_id, lowest_id - 1)
+            if deeper is None:
+                return None
+            blocks = deeper + blocks
+        if not self.verify_branch(blocks[0].prev_hash, blocks + [first_block]):
+            # the chain of the node moved on in the meantime
+            print(f'Blocks {blocks[0].id} to {first_block.id - 1} of {node.address} are not the branch of '
+                  f'{first_block.hash}.')
+            return None
+        known = [index for index, block in enumerate(blocks) if tree.get(block.hash) is not None]
+        missing = blocks[known[-1] + 1:] if known else blocks
+        if missing and missing[0].id != 1 and tree.get(missing[0].prev_hash) is None:
+            print(f'Branch of {first_block.hash} forks deeper than block {deepest_id}, ignored.')
+            return None
+        return missing
+
+    def fetch_range(self, node: Node, from_height: int, to_height: int) -> Optional[List[Block]]:
+        """Blocks `from_height` to `to_height` (both included) of `node`, None unless it sent exactly those."""
+        response = self.get_blocks_range(node, from_height, to_height - from_height + 1)
+        if not isinstance(response, list):
+            return None
+        try:
+            blocks = [Block.from_dict(block) for block in response]
+        except (KeyError, TypeError, ValueError):
+            return None
+        if [block.id for block in blocks] != list(range(from_height, to_height + 1)):
+            print(f'{node.address} did not send blocks {from_height} to {to_height}.')
+            return None
+        return blocks
+
+    def iter_blocks(self, from_height: int = 1) -> Iterator[Block]:
+        """The active chain in height order, fetched BLOCKS_STREAM_BATCH_SIZE rows at a time."""
+        statement = select(Block).where(Block.id >= from_height).order_by(Block.id)
+        yield from db.session.scalars(
+            statement, execution_options={'yield_per': self.app.config.get('BLOCKS_STREAM_BATCH_SIZE', 500)})
+
+    def get_blocks_as_list_of_dict(self):
+        return [block.as_dict() for block in self.iter_blocks()]
 
     def get_blocks_from(self, node: Node, block_id=None):
         if not block_id:
@@ -78,6 +197,13 @@ class Blockchain:
             print('Something nasty happened.')
             return None
 
+    def get_blocks_range(self, node: Node, from_height: int, limit: int) -> Optional[list]:
+        url = f'http://{node.address}:{self.app.config["FLASK_RUN_PORT"]}/blocks'
+        result = asyncio.run(Utilities().make_get(f'{url}?from_height={from_height}&limit={limit}'))
+        if result is None:
+            print(f'Blocks {from_height} to {from_height + limit - 1} could not be fetched from {node.address}.')
+        return result
+
     def add_node_at(self, target_node: Node, new_node: Node) -> bool:
         url = f'http://{target_node.address}:{self.app.config["FLASK_RUN_PORT"]}/nodes'
         data = {'node_address': new_node.address}
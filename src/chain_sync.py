@@ -0,0 +1,194 @@
+import asyncio
+import aiohttp
+
+from collections import defaultdict, deque
+from contextlib import nullcontext
+from sqlalchemy.exc import SQLAlchemyError
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src import db
+from src.block_tree import BlockTree
+from src.blockchain import Blockchain
+from src.models import Block
+from src.validator import ChainValidationError, ChainValidator
+
+
+def split_ranges(start: int, end: int, size: int) -> List[Tuple[int, int]]:
+    """The heights from `start` to `end` (both included) in chunks of `size`."""
+    return [(first, min(first + size - 1, end)) for first in range(start, end + 1, size)]
+
+
+def pick_peer(heights: Dict[str, int], block_range: Tuple[int, int], attempt: int,
+              failures: Dict[str, int], max_failures: int) -> Optional[str]:
+    """
+    A peer whose chain covers `block_range`, spreading the ranges (and the retries of a range) over all of them.
+    Peers that failed `max_failures` times are left out.
+    """
+    candidates = sorted(peer for peer, height in heights.items()
+                        if height >= block_range[1] and failures[peer] < max_failures)
+    if not candidates:
+        return None
+    return candidates[(block_range[0] + attempt) % len(candidates)]
+
+
+class ChainSync:
+    """
+    Downloads the chain from several peers at once, when a node starts or when it fell too far behind to fetch the
+    missing blocks one branch at a time. The missing heights are split in ranges of SYNC_RANGE_SIZE blocks fetched
+    concurrently over one connection pool. Every range is checked as it arrives, then validated (see
+    `ChainValidator`) and persisted as soon as it follows the last persisted block, a range that fails (timeout, bad
+    block) is asked to another peer. Whatever got persisted survives an interruption: the next sync resumes from the
+    local tip.
+    """
+
+    def __init__(self, app, lock=None, on_added: Optional[Callable[[List[Block], List[Block]], None]] = None):
+        """
+        :param lock: held while a range is persisted, on a running node the miner and the receivers write blocks too
+        :param on_added: called with the blocks that joined and the ones that left the active chain, after every range
+        """
+        self.app = app
+        self.lock = lock or nullcontext()
+        self.on_added = on_added
+        self.range_size = app.config.get('SYNC_RANGE_SIZE', 500)
+        self.max_connections = app.config.get('SYNC_MAX_CONNECTIONS', 8)
+        self.timeout = app.config.get('SYNC_REQUEST_TIMEOUT', 10)
+        self.max_failures = app.config.get('SYNC_MAX_PEER_FAILURES', 3)
+        self.validator = ChainValidator(app)
+
+    def sync(self, peers: List[str]) -> int:
+        """
+        Needs an app context.
+        :param peers: addresses of the nodes to download from
+        :return: how many blocks were added
+        """
+        if not peers:
+            return 0
+        return asyncio.run(self._sync(peers))
+
+    def url(self, peer: str, path: str) -> str:
+        return f'http://{peer}:{self.app.config["FLASK_RUN_PORT"]}{path}'
+
+    async def _sync(self, peers: List[str]) -> int:
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            tips = await asyncio.gather(*(self._get(session, self.url(peer, '/blocks/tip')) for peer in peers))
+            heights = {peer: tip['id'] for peer, tip in zip(peers, tips) if isinstance(tip, dict) and 'id' in tip}
+            tip = Block.query.order_by(Block.id.desc()).first()
+            self.next_height = tip.id + 1 if tip else 1
+            self.tip_hash = tip.hash if tip else None
+            if not heights or max(heights.values()) < self.next_height:
+                print(f'Chain sync: nothing to download, local tip at {self.next_height - 1}.')
+                return 0
+            print(f'Chain sync: blocks {self.next_height} to {max(heights.values())} from {len(heights)} peers.')
+            return await self._download(session, heights)
+
+    async def _download(self, session, heights: Dict[str, int]) -> int:
+        pending = deque(split_ranges(self.next_height, max(heights.values()), self.range_size))
+        attempts = defaultdict(int)
+        failures = defaultdict(int)
+        in_flight = {}
+        downloaded = {}
+        added = 0
+        while pending or in_flight:
+            while pending and len(in_flight) < self.max_connections:
+                block_range = pending.popleft()
+                peer = pick_peer(heights, block_range, attempts[block_range], failures, self.max_failures)
+                if peer is None:
+                    print(f'Chain sync: no peer left to download blocks {block_range}, stopped at {added} blocks.')
+                    for task in in_flight:
+                        task.cancel()
+                    return added
+                path = f'/blocks?from_height={block_range[0]}&limit={block_range[1] - block_range[0] + 1}'
+                in_flight[asyncio.ensure_future(self._get(session, self.url(peer, path)))] = (block_range, peer)
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                block_range, peer = in_flight.pop(task)
+                blocks = self._verify_range(task.result(), block_range)
+                if blocks is None:
+                    print(f'Chain sync: blocks {block_range} from {peer} failed, retrying with another peer.')
+                    failures[peer] += 1
+                    attempts[block_range] += 1
+                    pending.appendleft(block_range)
+                else:
+                    downloaded[block_range[0]] = (block_range, peer, blocks)
+            persisted, rejected = self._persist(downloaded)
+            added += persisted
+            if rejected is not None:
+                block_range, peer = rejected
+                failures[peer] += 1
+                attempts[block_range] += 1
+                pending.appendleft(block_range)
+        print(f'Chain sync: {added} blocks added, local tip at {self.next_height - 1}.')
+        return added
+
+    @staticmethod
+    async def _get(session, url: str):
+        try:
+            async with session.get(url) as response:
+                if response.status != 200:
+                    return None
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            print(f'GET {url} failed: ', e)
+            return None
+
+    @staticmethod
+    def _verify_range(response, block_range: Tuple[int, int]) -> Optional[List[Block]]:
+        """The blocks of `block_range` if the response holds all of them, in order and matching their hashes."""
+        if not isinstance(response, list) or len(response) != block_range[1] - block_range[0] + 1:
+            return None
+        try:
+            blocks = [Block.from_dict(block) for block in response]
+        except (KeyError, TypeError, ValueError):
+            return None
+        if [block.id for block in blocks] != list(range(block_range[0], block_range[1] + 1)):
+            return None
+        # cheap checks as it arrives, the link with the previous range and the full validation before persisting it
+        if not Blockchain.verify_branch(blocks[0].prev_hash, blocks):
+            return None
+        return blocks
+
+    def _persist(self, downloaded: dict) -> Tuple[int, Optional[Tuple[Tuple[int, int], str]]]:
+        """
+        Persists the downloaded ranges that follow the local tip, one commit per range.
+        :return: how many blocks were added and the (range, peer) that did not follow the tip, if any
+        """
+        added = 0
+        tree = BlockTree(self.app)
+        while self.next_height in downloaded:
+            block_range, peer, blocks = downloaded.pop(self.next_height)
+            with self.lock:
+                changed = self._persist_range(tree, block_range, peer, blocks)
+            if changed is None:
+                return added, (block_range, peer)
+            added += len(blocks)
+            self.next_height = block_range[1] + 1
+            self.tip_hash = blocks[-1].hash
+            if self.on_added is not None:
+                self.on_added(*changed)
+        return added, None
+
+    def _persist_range(self, tree: BlockTree, block_range: Tuple[int, int], peer: str,
+                       blocks: List[Block]) -> Optional[Tuple[List[Block], List[Block]]]:
+        """:return: the blocks that joined and the ones that left the active chain, None if the range was rejected"""
+        tree.index_chain()
+        if self.tip_hash is not None and blocks[0].prev_hash != self.tip_hash:
+            print(f'Chain sync: blocks {block_range} from {peer} do not follow block {self.next_height - 1}.')
+            return None
+        try:
+            self.validator.validate_blocks(blocks, tree.ancestors(blocks[0].prev_hash, self.validator.history_size))
+        except ChainValidationError as e:
+            print(f'Chain sync: blocks {block_range} from {peer} rejected: ', e)
+            return None
+        try:
+            if any(tree.add(block) is None for block in blocks):
+                db.session.rollback()
+                return None
+            undone, done = tree.follow_best_tip()
+            db.session.commit()
+        except SQLAlchemyError as e:
+            print(f'Chain sync: blocks {block_range} could not be added: ', e)
+            db.session.rollback()
+            return None
+        return done, undone
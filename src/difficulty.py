@@ -0,0 +1,47 @@
+from datetime import datetime
+from typing import List
+
+MAX_TARGET = 2 ** 256 - 1
+# a single retarget can not make blocks more than this factor easier or harder
+MAX_ADJUSTMENT = 4
+
+
+def target_from_zeroes(nonce_zeroes: str) -> int:
+    """The numeric equivalent of requiring the hex digest to start with `nonce_zeroes`."""
+    return 16 ** (64 - len(nonce_zeroes)) - 1
+
+
+def initial_target(config) -> int:
+    target = config.get('DIFFICULTY_TARGET')
+    if target is not None:
+        return int(target)
+    return target_from_zeroes(config['NONCE_ZEROES'])
+
+
+def target_to_hex(target: int) -> str:
+    return f'{target:064x}'
+
+
+def meets_target(block_hash: str, target: int) -> bool:
+    return int(block_hash, 16) <= target
+
+
+def block_work(target: int) -> int:
+    """The expected number of hashes needed to meet `target`, what the fork choice adds up."""
+    return 2 ** 256 // (target + 1)
+
+
+def retarget(target: int, timestamps: List[str], block_seconds: float) -> int:
+    """
+    Scales the target by how far the observed block interval is from `block_seconds`.
+    :param timestamps: the `Block.timestamp` values of the last blocks, oldest first
+    """
+    if len(timestamps) < 2:
+        return target
+    first = datetime.strptime(timestamps[0], '%Y-%m-%dT%H:%M:%SZ')
+    last = datetime.strptime(timestamps[-1], '%Y-%m-%dT%H:%M:%SZ')
+    actual = max((last - first).total_seconds(), 1)
+    expected = block_seconds * (len(timestamps) - 1)
+    actual = min(max(actual, expected / MAX_ADJUSTMENT), expected * MAX_ADJUSTMENT)
+    # integer arithmetic, targets are far beyond float precision
+    return min(max(target * max(int(actual), 1) // max(int(expected), 1), 1), MAX_TARGET)
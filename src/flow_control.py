@@ -0,0 +1,63 @@
+import threading
+import time
+
+from collections import defaultdict
+from typing import Dict
+
+
+class CreditGate:
+    """
+    Credit based flow control of the transactions a node publishes. Every receiver advertises how many more messages
+    it can take from each sender (its credit) and the sender spends one credit of every receiver per message. When a
+    receiver runs out, the message is held back (and counted against that receiver) instead of being lost in its
+    queues. Advertisements carry the whole credit, not an increment, so a lost one is fixed by the next. Receivers
+    that stopped advertising for `timeout` seconds, or never did (older nodes), do not hold anything back, nor does a
+    receiver that has been out of credit for more than `max_hold` seconds: one slow (or malicious) node must not
+    stall the whole network. It is waited for again once it advertises some credit.
+    """
+
+    def __init__(self, timeout: float = 5, max_hold: float = 1):
+        self.timeout = timeout
+        self.max_hold = max_hold
+        # receiver -> (credit, advertised at)
+        self.credits = {}
+        # receiver -> since when it holds the messages back
+        self.holding_since = {}
+        self.withheld = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def grant(self, receiver: str, credit: int):
+        with self.lock:
+            self.credits[receiver] = (credit, time.monotonic())
+            if credit > 0:
+                self.holding_since.pop(receiver, None)
+
+    def acquire(self, count: int = 1) -> bool:
+        """:return: True (and spends `count` credits of every receiver) if all of them can take `count` messages"""
+        now = time.monotonic()
+        with self.lock:
+            active = {receiver: credit for receiver, (credit, advertised_at) in self.credits.items()
+                      if now - advertised_at <= self.timeout and not self._overdue(receiver, now)}
+            short = [receiver for receiver, credit in active.items() if credit < count]
+            if short:
+                for receiver in short:
+                    self.withheld[receiver] += count
+                    self.holding_since.setdefault(receiver, now)
+                return False
+            for receiver, credit in active.items():
+                self.credits[receiver] = (credit - count, self.credits[receiver][1])
+            return True
+
+    def _overdue(self, receiver: str, now: float) -> bool:
+        return receiver in self.holding_since and now - self.holding_since[receiver] > self.max_hold
+
+    def stats(self) -> Dict[str, dict]:
+        now = time.monotonic()
+        with self.lock:
+            receivers = set(self.credits) | set(self.withheld)
+            return {receiver: {
+                'credit': self.credits[receiver][0] if receiver in self.credits else None,
+                'active': receiver in self.credits and now - self.credits[receiver][1] <= self.timeout and
+                not self._overdue(receiver, now),
+                'withheld': self.withheld[receiver],
+            } for receiver in receivers}
@@ -4,17 +4,16 @@ import string
 import time
 
 from confluent_kafka import Consumer, Producer
-from fastecdsa import ecdsa, curve
-from fastecdsa.point import Point
 from sqlalchemy.exc import SQLAlchemyError
 
-from src import db
+from src import db, wire
 from src.blockchain import Blockchain
-from src.models import Block, Node, Transaction
-from src.peer_to_peer import PeerToPeer
+from src.chain_sync import ChainSync
+from src.models import Node
+from src.peer_to_peer import BlockingReceiving, PeerToPeer
 
 
-class KafkaPeerToPeer(PeerToPeer):
+class KafkaPeerToPeer(BlockingReceiving, PeerToPeer):
 
     def __init__(self, app):
         super().__init__(app)
@@ -30,20 +29,8 @@ class KafkaPeerToPeer(PeerToPeer):
         first_node = Node(address=self.app.config['FIRST_NODE'])
         this_node = Node(address=self.app.config['THIS_NODE'])
         if first_node.address != this_node.address:
-            # get the genesis block
-            if not Block.query.all():
-                response = blockchain.get_blocks_from(first_node, 1)
-                if response:
-                    try:
-                        genesis_block = Block()
-                        [setattr(genesis_block, key, response[key]) for key in response]
-                        db.session.add(genesis_block)
-                        db.session.commit()
-                        print('Genesis block added.')
-                    except SQLAlchemyError as e:
-                        print(f'Genesis block could not be added: ', e)
-                    except Exception as e:
-                        print(f'A problem occurred while adding the genesis block: ', e)
+            # the chain, or what is missing of it since the last run
+            ChainSync(self.app).sync([first_node.address])
         else:
             if blockchain.create_genesis_block():
                 print('Genesis block created.')
@@ -73,12 +60,26 @@ class KafkaPeerToPeer(PeerToPeer):
         for p in partitions:
             print(f'Assigned to {p.topic}, partition {p.partition}')
 
+    def encode(self, data, topic):
+        if self.app.config.get('WIRE_FORMAT', wire.BINARY) == wire.JSON:
+            return json.dumps(data)
+        return wire.encode(data, topic)
+
     def broadcast(self, publisher, data, topic):
         print(f'Broadcasting {data} to topic {topic}')
-        publisher.produce(topic, key="key1", value=json.dumps(data), callback=self.acked)
+        publisher.produce(topic, key="key1", value=self.encode(data, topic), callback=self.acked)
         publisher.poll(1)
         # publisher.flush()
 
+    def broadcast_batch(self, publisher, items, topic) -> bool:
+        print(f'Broadcasting {len(items)} messages to topic {topic}')
+        for item in items:
+            publisher.produce(topic, key="key1", value=self.encode(item, topic), callback=self.acked)
+            # serves the delivery callbacks without waiting
+            publisher.poll(0)
+        # one flush for the whole batch, the producer packs the messages into a few requests
+        return publisher.flush(self.app.config.get('KAFKA_FLUSH_TIMEOUT', 10)) == 0
+
     def acked(self, err, msg):
         if err is not None:
             print("Failed to deliver message: %s: %s" % (str(msg), str(err)))
@@ -86,61 +87,26 @@ class KafkaPeerToPeer(PeerToPeer):
             print("Message produced: %s" % (str(msg)))
 
     def receive_transaction(self):
-        event = self.transaction_subscriber.poll(1)
-        if event is None:
-            # print("No event")
-            pass
-        elif event.error():
-            print(f'Error: {event.error()}')
-        else:
+        # whatever is already available becomes one micro-batch, the signatures are verified together
+        events = self.transaction_subscriber.consume(num_messages=self.app.config.get('VERIFY_BATCH_SIZE', 64),
+                                                     timeout=self.receive_timeout_ms() / 1000)
+        transactions = []
+        for event in events:
+            if event.error():
+                print(f'Error: {event.error()}')
+                continue
             try:
-                transaction = json.loads(event.value())
+                transaction = wire.decode(event.value())
                 partition = event.partition()
                 print(f'Received: transaction {transaction} from partition {partition}')
-                if transaction['id'] != 'None':
-                    transaction_id = transaction['id']
-                else:
-                    transactions = Transaction.query.all()
-                    transaction_id = len(transactions) + 1
-                received_public_key = transaction['public_key'].split(' ')
-                x = int(received_public_key[1].strip()[:-2], 16)
-                y = int(received_public_key[2].strip()[:-4], 16)
-                public_key = Point(x, y, curve=curve.secp256k1)
-                transaction_data_string = transaction['transaction_data_string']
-                signature = tuple(json.loads(transaction['signature']))
-                valid = ecdsa.verify(signature, str(transaction_data_string), public_key, curve.secp256k1, ecdsa.sha256)
-                # if we ratify the transaction sent is valid we store it in the database
-                if valid:
-                    transaction_db = Transaction()
-                    transaction_db.id = transaction_id
-                    transaction_db.public_key = public_key
-                    transaction_db.transaction_data_string = transaction_data_string
-                    transaction_db.signature = json.dumps(signature)
-                    transaction_db.valid = valid
-                    try:
-                        db.session.add(transaction_db)
-                        db.session.commit()
-                        print(f'Transaction: {transaction_id} added.')
-                        transactions = Transaction.query.all()
-                        if len(transactions) >= self.app.config['TRANSACTIONS_AMOUNT']:
-                            blockchain = Blockchain(self.app)
-                            # proof_work generates a new block
-                            new_block = blockchain.proof_of_work()
-                            db.session.add(new_block)
-                            db.session.commit()
-                            self.broadcast(self.publisher, blockchain.get_blocks_as_list_of_dict(), topic='chain')
-                            db.session.query(Transaction).delete()
-                            db.session.commit()
-                    except SQLAlchemyError as e:
-                        print(f'Transaction {transaction_id} could not be added: ', e)
-                        pass
-                    except Exception as e:
-                        print(f'A problem occurred at receiving transaction: ', e)
-                else:
-                    print(f'Transaction: {transaction_id} is not valid.')
-            except json.decoder.JSONDecodeError as e:
-                # Handle the JSONDecodeError exception
-                print("Failed to decode JSON:", str(e))
+                # a list of transactions can also travel as a single message
+                transactions.extend(transaction if isinstance(transaction, list) else [transaction])
+            except ValueError as e:
+                # JSONDecodeError or wire.WireError
+                print("Failed to decode message:", str(e))
+        if transactions:
+            try:
+                self.process_transactions(transactions)
             except Exception as e:
                 print(f'A problem occurred at receiving transaction: ', e)
 
@@ -151,9 +117,7 @@ class KafkaPeerToPeer(PeerToPeer):
             # print("No event")
             pass
         else:
-            node = json.loads(event.value())
-            if type(node) == str:
-                node = json.loads(node)
+            node = wire.decode(event.value())
             partition = event.partition()
             print(f'Received: node {node} from partition {partition}')
             # consumer.commit(event)
@@ -188,41 +152,16 @@ class KafkaPeerToPeer(PeerToPeer):
             print(f'Error: {event.error()}')
         else:
             try:
-                received_blocks = event.value()
+                received_blocks = wire.decode(event.value())
                 partition = event.partition()
                 print(f'Received: chain {received_blocks} from partition {partition}')
-                stored_blocks = Block.query.all()
-                if isinstance(received_blocks, dict) and len(received_blocks) > len(stored_blocks):
-                    # first we check the received blocks against what we already have
-                    for i in range(len(received_blocks)):
-                        if stored_blocks:
-                            if stored_blocks[i].as_dict() != received_blocks[i]:
-                                print(f'Inconsistency in the chain received compared with the one we already have')
-                                # TODO: maybe discard
-                                continue
-                        try:
-                            # what we have is shorter than what we received
-                            num_blocks_deleted = db.session.query(Block).delete()
-                            print(f'Updating chain: {num_blocks_deleted} blocks deleted.')
-                            for block in received_blocks:
-                                new_block = Block()
-                                [setattr(new_block, key, block[key]) for key in block]
-                                db.session.add(new_block)
-                            db.session.commit()
-                            blockchain = Blockchain(self.app)
-                            print(f'Chain updated and broadcast.')
-                            self.broadcast(self.publisher, blockchain.get_blocks_as_list_of_dict(), topic='chain')
-                            # TODO: delete only required, here we are wiping out everything
-                            db.session.query(Transaction).delete()
-                            db.session.commit()
-                        except SQLAlchemyError as e:
-                            print(f'Chain could not be updated: ', e)
-                            db.session.rollback()
-                        except Exception as e:
-                            print(f'A problem occurred at receiving chain: ', e)
-            except json.decoder.JSONDecodeError as e:
-                # Handle the JSONDecodeError exception
-                print("Failed to decode JSON:", str(e))
+                if not self.is_new_blocks_message(received_blocks):
+                    # a whole chain sent by an older node, the blocks we already know are skipped
+                    received_blocks = {'origin': None, 'blocks': received_blocks}
+                self.receive_blocks(received_blocks)
+            except ValueError as e:
+                # JSONDecodeError or wire.WireError
+                print("Failed to decode message:", str(e))
             except Exception as e:
                 print(f'A problem occurred at receiving chain: ', e)
 
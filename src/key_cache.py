@@ -0,0 +1,64 @@
+import threading
+
+from collections import OrderedDict
+from fastecdsa.point import Point
+
+from src.models import Transaction
+
+
+class PublicKeyCache:
+    """
+    Bounded LRU of decoded public keys keyed by their serialised form. Most of the traffic is signed by a handful of
+    keys, so parsing the string form of the point on every message is mostly wasted.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.points = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, serialised: str) -> Point:
+        with self.lock:
+            point = self.points.get(serialised)
+            if point is not None:
+                self.points.move_to_end(serialised)
+                self.hits += 1
+                return point
+            self.misses += 1
+        point = Transaction.parse_public_key(serialised)
+        with self.lock:
+            self.points[serialised] = point
+            self._evict()
+        return point
+
+    def resize(self, max_size: int):
+        with self.lock:
+            self.max_size = max_size
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.points.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'size': len(self.points),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _evict(self):
+        while len(self.points) > self.max_size:
+            self.points.popitem(last=False)
+            self.evictions += 1
+
+
+# shared by every backend of the process
+public_key_cache = PublicKeyCache()
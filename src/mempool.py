@@ -0,0 +1,198 @@
+import threading
+import time
+
+from collections import OrderedDict
+from sqlalchemy.exc import SQLAlchemyError
+from typing import Iterable, List, Optional
+
+from src import db
+from src.models import Transaction
+
+
+class Mempool:
+    """
+    The pending transactions (as dicts, see `Transaction.as_dict`) in arrival order and indexed by their
+    `transaction_hash`. The `transaction` table is written behind it: inserts and deletes are queued and `flush`
+    persists them. It also remembers the last `max_seen` hashes it came across, so re-broadcasts and replays can be
+    dropped before verifying them again.
+    """
+
+    def __init__(self, max_seen: int = 100000):
+        # transaction_hash -> (transaction, arrived_at, size)
+        self.transactions = OrderedDict()
+        self.pending_bytes = 0
+        self.seen_hashes = OrderedDict()
+        self.max_seen = max_seen
+        self.to_insert = OrderedDict()
+        self.to_delete = set()
+        # when the oldest write still waiting for `flush` was queued
+        self.queued_since = None
+        self.lock = threading.RLock()
+        # one flush at a time: a delete queued after an insert must not commit before it
+        self.flush_lock = threading.Lock()
+
+    def load(self):
+        """Rebuilds the pool out of the `transaction` table, e.g. after a restart (needs an app context)."""
+        with self.lock:
+            self.transactions.clear()
+            self.pending_bytes = 0
+            self.to_insert.clear()
+            self.to_delete.clear()
+            self.queued_since = None
+            for transaction in Transaction.query.order_by(Transaction.id).all():
+                if not transaction.transaction_hash:
+                    # stored before transactions were content addressed
+                    transaction.transaction_hash = transaction.calculate_hash()
+                self._add(transaction.as_dict(), time.monotonic())
+                self.mark_seen(transaction.transaction_hash)
+        return len(self)
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __contains__(self, transaction_hash):
+        return transaction_hash in self.transactions
+
+    def seen(self, transaction_hash: str) -> bool:
+        with self.lock:
+            return transaction_hash in self.seen_hashes
+
+    def mark_seen(self, transaction_hash: str):
+        with self.lock:
+            self.seen_hashes[transaction_hash] = True
+            self.seen_hashes.move_to_end(transaction_hash)
+            while len(self.seen_hashes) > self.max_seen:
+                self.seen_hashes.popitem(last=False)
+
+    def add(self, transaction: dict, arrived_at: Optional[float] = None) -> bool:
+        """:return: False if a transaction with the same hash is already pending"""
+        with self.lock:
+            transaction_hash = transaction['transaction_hash']
+            if transaction_hash in self.transactions:
+                return False
+            self._add(transaction, time.monotonic() if arrived_at is None else arrived_at)
+            self.mark_seen(transaction_hash)
+            self.to_delete.discard(transaction_hash)
+            self.to_insert[transaction_hash] = transaction
+            self._queued()
+            return True
+
+    def get(self, transaction_hash: str) -> Optional[dict]:
+        entry = self.transactions.get(transaction_hash)
+        return entry[0] if entry is not None else None
+
+    def oldest_arrival(self) -> Optional[float]:
+        with self.lock:
+            if not self.transactions:
+                return None
+            return next(iter(self.transactions.values()))[1]
+
+    def take(self, max_transactions: Optional[int] = None, max_bytes: Optional[int] = None) -> List[dict]:
+        """The oldest transactions within the budgets (at least one), they stay in the pool until `remove`."""
+        taken = []
+        taken_bytes = 0
+        with self.lock:
+            for transaction, _, size in self.transactions.values():
+                if max_transactions is not None and len(taken) >= max_transactions:
+                    break
+                if max_bytes is not None and taken and taken_bytes + size > max_bytes:
+                    break
+                taken.append(transaction)
+                taken_bytes += size
+        return taken
+
+    def remove(self, transaction_hashes: Iterable[str]):
+        with self.lock:
+            for transaction_hash in transaction_hashes:
+                entry = self.transactions.pop(transaction_hash, None)
+                if entry is None:
+                    continue
+                self.pending_bytes -= entry[2]
+                # never written, nothing to delete either
+                if self.to_insert.pop(transaction_hash, None) is None:
+                    self.to_delete.add(transaction_hash)
+                    self._queued()
+
+    def clear(self):
+        """Forgets the pending transactions, queued writes included (the caller wipes the table)."""
+        with self.lock:
+            self.transactions.clear()
+            self.pending_bytes = 0
+            self.to_insert.clear()
+            self.to_delete.clear()
+            self.queued_since = None
+
+    @property
+    def queued_writes(self) -> int:
+        return len(self.to_insert) + len(self.to_delete)
+
+    def flush_due(self, max_writes: int, max_delay_ms: float, now: Optional[float] = None) -> bool:
+        """Group commit: True once `max_writes` writes are queued or the oldest one waited `max_delay_ms`."""
+        with self.lock:
+            if self.queued_since is None:
+                return False
+            if self.queued_writes >= max_writes:
+                return True
+            return ((time.monotonic() if now is None else now) - self.queued_since) * 1000 >= max_delay_ms
+
+    def flush(self):
+        """
+        Writes the queued inserts and deletes in one database transaction (needs an app context). Flushes from
+        different threads run one after the other, in the order their writes were queued: the removal of a transaction
+        mined while its insert is being written waits for it, otherwise its row would survive and come back on `load`.
+        """
+        with self.flush_lock:
+            with self.lock:
+                to_insert, self.to_insert = self.to_insert, OrderedDict()
+                to_delete, self.to_delete = self.to_delete, set()
+                self.queued_since = None
+            if not to_insert and not to_delete:
+                return
+            try:
+                if to_delete:
+                    db.session.query(Transaction).filter(Transaction.transaction_hash.in_(to_delete)).delete()
+                for transaction in to_insert.values():
+                    db.session.add(self._as_model(transaction))
+                db.session.commit()
+                for transaction_hash in to_insert:
+                    print(f'Transaction: {transaction_hash} added.')
+            except SQLAlchemyError as e:
+                print(f'Pending transactions could not be written in one go, retrying one by one: ', e)
+                db.session.rollback()
+                self._flush_one_by_one(to_insert, to_delete)
+
+    def _flush_one_by_one(self, to_insert: OrderedDict, to_delete: set):
+        try:
+            db.session.query(Transaction).filter(Transaction.transaction_hash.in_(to_delete)).delete()
+            db.session.commit()
+        except SQLAlchemyError as e:
+            print(f'Transactions {sorted(to_delete)} could not be deleted: ', e)
+            db.session.rollback()
+        for transaction_hash, transaction in to_insert.items():
+            try:
+                db.session.add(self._as_model(transaction))
+                db.session.commit()
+                print(f'Transaction: {transaction_hash} added.')
+            except SQLAlchemyError as e:
+                print(f'Transaction {transaction_hash} could not be added: ', e)
+                db.session.rollback()
+
+    def _queued(self):
+        if self.queued_since is None:
+            self.queued_since = time.monotonic()
+
+    def _add(self, transaction: dict, arrived_at: float):
+        size = len(transaction['transaction_data_string'])
+        self.transactions[transaction['transaction_hash']] = (transaction, arrived_at, size)
+        self.pending_bytes += size
+
+    @staticmethod
+    def _as_model(transaction: dict) -> Transaction:
+        # the id is left to the database, the identity of a transaction is its hash
+        transaction_db = Transaction()
+        transaction_db.transaction_hash = transaction['transaction_hash']
+        transaction_db.public_key = transaction['public_key']
+        transaction_db.transaction_data_string = transaction['transaction_data_string']
+        transaction_db.signature = transaction['signature']
+        transaction_db.valid = transaction['valid'] == 'True'
+        return transaction_db
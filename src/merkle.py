@@ -0,0 +1,55 @@
+import hashlib
+import json
+
+from typing import List
+
+
+def hash_leaf(item: str) -> str:
+    return hashlib.sha256(item.encode()).hexdigest()
+
+
+def transaction_leaf(transaction: dict) -> str:
+    return hash_leaf(json.dumps(transaction, sort_keys=True, ensure_ascii=False))
+
+
+def hash_pair(left: str, right: str) -> str:
+    return hashlib.sha256(bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+
+def _next_level(level: List[str]) -> List[str]:
+    # an odd node out is promoted as it is instead of being paired with a copy of itself
+    return [hash_pair(level[i], level[i + 1]) if i + 1 < len(level) else level[i] for i in range(0, len(level), 2)]
+
+
+def merkle_root(leaves: List[str]) -> str:
+    if not leaves:
+        return hashlib.sha256(b'').hexdigest()
+    level = list(leaves)
+    while len(level) > 1:
+        level = _next_level(level)
+    return level[0]
+
+
+def merkle_proof(leaves: List[str], index: int) -> List[dict]:
+    """
+    The sibling hashes from the leaf at `index` up to the root, each one tagged with the side it goes on.
+    """
+    proof = []
+    level = list(leaves)
+    while len(level) > 1:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append({'position': 'left' if sibling < index else 'right', 'hash': level[sibling]})
+        level = _next_level(level)
+        index //= 2
+    return proof
+
+
+def verify_proof(leaf: str, proof: List[dict], root: str) -> bool:
+    current = leaf
+    for step in proof:
+        if step['position'] == 'left':
+            current = hash_pair(step['hash'], current)
+        else:
+            current = hash_pair(current, step['hash'])
+    return current == root
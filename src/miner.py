@@ -0,0 +1,93 @@
+import threading
+
+from src.blockchain import Blockchain
+from src.models import Block
+
+
+class Miner:
+    """
+    Runs the proof of work on a dedicated thread so transaction intake never waits for it.
+    There is at most one job at a time: submitting a new block or cancelling aborts the running search, submitting
+    the same transactions on top of the same parent again leaves it running.
+    """
+
+    def __init__(self, app, on_block_mined):
+        """
+        :param on_block_mined: called from the mining thread (inside an app context) with the mined block
+        """
+        self.app = app
+        self.on_block_mined = on_block_mined
+        self.condition = threading.Condition()
+        self.job = None
+        # the block being mined
+        self.current = None
+        self.cancel_event = threading.Event()
+        self.running = False
+        self.mining = False
+        self.thread = None
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.job = None
+            self.cancel_event.set()
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def submit(self, block: Block) -> bool:
+        """
+        Replaces whatever is being mined with `block` (prepared by `Blockchain.prepare_block`).
+        :return: False if the job already mines the same transactions on the same parent, restarting it would only
+        throw away the nonces tried so far
+        """
+        with self.condition:
+            running = self.current if self.mining and not self.cancel_event.is_set() else None
+            job = self.job or running
+            if job is not None and job.prev_hash == block.prev_hash and job.data == block.data:
+                return False
+            self.cancel_event.set()
+            self.job = block
+            self.condition.notify()
+            return True
+
+    @property
+    def busy(self) -> bool:
+        return self.mining or self.job is not None
+
+    def cancel(self):
+        with self.condition:
+            self.cancel_event.set()
+            self.job = None
+
+    def run(self):
+        with self.app.app_context():
+            blockchain = Blockchain(self.app)
+            while True:
+                with self.condition:
+                    while self.running and self.job is None:
+                        self.condition.wait()
+                    if not self.running:
+                        return
+                    block, self.job = self.job, None
+                    self.current = block
+                    cancel_event = self.cancel_event = threading.Event()
+                    self.mining = True
+                try:
+                    mined_block = blockchain.mine(block, cancel_event)
+                    if mined_block is None or cancel_event.is_set():
+                        print(f'Mining of block {block.id} on top of {block.prev_hash} cancelled.')
+                        continue
+                    self.on_block_mined(mined_block)
+                except Exception as e:
+                    print(f'A problem occurred while mining: ', e)
+                finally:
+                    self.mining = False
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import multiprocessing
+import uuid
+
+from typing import Optional, Tuple
+
+# `Block.nonce` is stored as an unsigned INTEGER
+NONCE_MAX = 2 ** 32 - 1
+# how many nonces a worker tries between checks of the stop flag
+STOP_CHECK_INTERVAL = 4096
+
+_stop_event = None
+
+
+def hash_block_fields(fields: dict) -> str:
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+class HeaderTemplate:
+    """
+    The serialised block split around the nonce: prefix + nonce + suffix are exactly the bytes `hash_block_fields`
+    hashes, so the prefix is hashed once and every attempt only feeds the nonce digits and the suffix.
+    """
+
+    def __init__(self, fields: dict):
+        marker = uuid.uuid4().hex
+        serialised = json.dumps({**fields, 'nonce': marker}, sort_keys=True, ensure_ascii=False).encode()
+        prefix, suffix = serialised.split(marker.encode())
+        self.prefix_hash = hashlib.sha256(prefix)
+        self.suffix = suffix
+
+    def sha256(self, nonce: int):
+        new_hash = self.prefix_hash.copy()
+        new_hash.update(str(nonce).encode() + self.suffix)
+        return new_hash
+
+    def hash(self, nonce: int) -> str:
+        return self.sha256(nonce).hexdigest()
+
+
+def search_nonce(fields: dict, target: int, start: int = 0, step: int = 1, stop: int = NONCE_MAX,
+                 stop_event=None) -> Optional[Tuple[int, str]]:
+    """
+    Walks the nonces start, start + step, start + 2 * step, ... up to `stop` (inclusive).
+    :param target: a hash matches when its integer value is lower or equal than the target
+    :param fields: the hashable fields of the block, the nonce entry is ignored
+    :param stop_event: anything with an `is_set()` method, checked every STOP_CHECK_INTERVAL attempts
+    :return: (nonce, hash) of the first match, None if the range is exhausted or the search was stopped
+    """
+    template = HeaderTemplate(fields)
+    attempts = 0
+    for nonce in range(start, stop + 1, step):
+        new_hash = template.sha256(nonce)
+        if int.from_bytes(new_hash.digest(), 'big') <= target:
+            return nonce, new_hash.hexdigest()
+        attempts += 1
+        if stop_event is not None and attempts % STOP_CHECK_INTERVAL == 0 and stop_event.is_set():
+            return None
+    return None
+
+
+def _init_worker(stop_event):
+    global _stop_event
+    _stop_event = stop_event
+
+
+def _search_worker(args):
+    fields, target, start, step, stop = args
+    return search_nonce(fields, target, start=start, step=step, stop=stop, stop_event=_stop_event)
+
+
+def parallel_search_nonce(fields: dict, target: int, workers: int, start: int = 0,
+                          stop: int = NONCE_MAX, cancel_event=None) -> Optional[Tuple[int, str]]:
+    """
+    Splits the nonce space across `workers` processes, worker i tries start + i, start + i + workers, ...
+    As soon as one of them finds a match the rest are told to stop and the pool is torn down.
+    :param cancel_event: anything with an `is_set()` method, when set the whole search is abandoned
+    """
+    context = multiprocessing.get_context()
+    stop_event = context.Event()
+    tasks = [(fields, target, start + i, workers, stop) for i in range(workers)]
+    with context.Pool(processes=workers, initializer=_init_worker, initargs=(stop_event,)) as pool:
+        results = pool.imap_unordered(_search_worker, tasks)
+        for _ in range(workers):
+            while True:
+                if cancel_event is not None and cancel_event.is_set():
+                    stop_event.set()
+                    return None
+                try:
+                    result = results.next(timeout=0.005)
+                    break
+                except multiprocessing.TimeoutError:
+                    continue
+            if result is not None:
+                stop_event.set()
+                return result
+    return None
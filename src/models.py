@@ -1,34 +1,46 @@
 import json
 import hashlib
+import threading
 import uuid
 
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from sqlalchemy.dialects.mysql import INTEGER
 from fastecdsa import ecdsa, curve
+from fastecdsa.encoding.sec1 import SEC1Encoder
+from fastecdsa.point import Point
+from typing import List, Optional, Tuple, Union
 
-from src import db
+from src import db, merkle
+from src.mining import hash_block_fields
 
 
 class Block(db.Model):
 
     __tablename__ = 'block'
+    HEADER_FIELDS = ('prev_hash', 'merkle_root', 'timestamp', 'nonce', 'target')
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     prev_hash = db.Column(db.String(1000), nullable=False)
     nonce = db.Column(INTEGER(unsigned=True), nullable=False)
     data = db.Column(db.Text, nullable=False)
+    merkle_root = db.Column(db.String(64), nullable=True)
     timestamp = db.Column(db.String(50), default=datetime.utcnow(), nullable=False)
+    # hex encoded, the hash of the block read as an integer has to be lower or equal than the target
+    target = db.Column(db.String(64), nullable=True)
     hash = db.Column(db.String(1000), nullable=False)
 
     def __init__(self, prev_hash: str = '000000000', nonce: int = 456,
-                 data: str = '', timestamp: datetime = datetime.utcnow()) -> None:
+                 data: str = '', timestamp: datetime = datetime.utcnow(), target: str = None) -> None:
         """
         :param timestamp: Must be given as a UTC value
         """
         self.prev_hash = prev_hash
         self.nonce = nonce
         self.data = data
+        self.merkle_root = merkle.merkle_root(self.leaves()) if data else None
         self.timestamp = timestamp.strftime('%Y-%m-%dT%H:%M:%SZ')
+        self.target = target
         self.hash = 'non-hashed'
 
     def encode_block(self):
@@ -39,15 +51,67 @@ class Block(db.Model):
     def as_dict(self):
         return {c.name: str(getattr(self, c.name)) for c in self.__table__.columns}
 
+    @classmethod
+    def from_dict(cls, block: dict) -> 'Block':
+        """Rebuilds a block out of `as_dict` (every value a string), e.g. when it is received from another node."""
+        new_block = cls()
+        for key, value in block.items():
+            setattr(new_block, key, None if value == 'None' else value)
+        new_block.id = int(new_block.id)
+        new_block.nonce = int(new_block.nonce)
+        return new_block
+
+    def header_dict(self):
+        # the transactions are committed through the merkle root, so the size of the header is fixed
+        return {key: str(getattr(self, key)) for key in self.HEADER_FIELDS}
+
+    def calculate_hash(self) -> str:
+        return hash_block_fields(self.header_dict())
+
+    def transactions(self) -> list:
+        """The transactions (as dicts) in `data`, the genesis block holds a plain string instead."""
+        try:
+            transactions = json.loads(self.data)
+        except (TypeError, ValueError):
+            return []
+        return transactions if isinstance(transactions, list) else []
+
+    def leaves(self) -> list:
+        transactions = self.transactions()
+        if not transactions and self.data:
+            return [merkle.hash_leaf(self.data)]
+        return [merkle.transaction_leaf(transaction) for transaction in transactions]
+
     def __repr__(self):
         return f'Block id: {self.id}, prev_hash: {self.prev_hash}, nonce: {self.nonce}, ' \
                f'timestamp: {self.timestamp}, hash: {self.hash}, data: {self.data}'
 
 
+class BlockTreeEntry(db.Model):
+    """
+    A block known to this node, on the active chain or on a side branch, see `BlockTree`.
+    """
+    __tablename__ = 'block_tree'
+
+    hash = db.Column(db.String(64), primary_key=True)
+    parent_hash = db.Column(db.String(64), index=True, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    # cumulative work from the genesis block, zero padded hex so the column sorts numerically
+    work = db.Column(db.String(80), index=True, nullable=False)
+    # the block as `Block.as_dict`, to rebuild it when its branch becomes the active one
+    block = db.Column(db.Text, nullable=False)
+
+    def __repr__(self):
+        return f'BlockTreeEntry hash: {self.hash}, parent_hash: {self.parent_hash}, height: {self.height}, ' \
+               f'work: {self.work}'
+
+
 class Transaction(db.Model):
     __tablename__ = 'transaction'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # sha256 of transaction_data_string + signature, the identity of the transaction across nodes
+    transaction_hash = db.Column(db.String(64), unique=True, index=True, nullable=True)
     public_key = db.Column(db.String(1000), nullable=False)
     transaction_data_string = db.Column(db.String(1000), nullable=False)
     signature = db.Column(db.String(1000), nullable=False)
@@ -56,6 +120,7 @@ class Transaction(db.Model):
     def __init__(self, public_key=None, private_key=None, data=None):
         # Empty object to be filled afterwards
         if not public_key or not private_key or not data:
+            self.transaction_hash = None
             self.public_key = ''
             self.transaction_data_string = ''
             self.signature = ''
@@ -67,8 +132,74 @@ class Transaction(db.Model):
             signature = ecdsa.sign(self.transaction_data_string, private_key, curve=curve.secp256k1,
                                    hashfunc=ecdsa.sha256)
             self.signature = json.dumps(signature)
+            self.transaction_hash = self.calculate_hash()
             self.valid = ecdsa.verify(signature, self.transaction_data_string, public_key, curve.secp256k1, ecdsa.sha256)
 
+    @staticmethod
+    def content_hash(transaction_data_string: str, signature: str) -> str:
+        """
+        :param signature: the JSON form of (r, s), it is normalised (and s taken as min(s, n - s), both verify) so a
+        reformatted or flipped signature still maps to the same transaction
+        """
+        r, s = json.loads(signature)
+        s = min(s, curve.secp256k1.q - s)
+        return hashlib.sha256((transaction_data_string + json.dumps([r, s])).encode()).hexdigest()
+
+    def calculate_hash(self) -> str:
+        return self.content_hash(self.transaction_data_string, self.signature)
+
+    @staticmethod
+    def parse_public_key(serialised: Union[str, bytes]) -> Point:
+        """
+        Rebuilds the point out of its string form (`str(Point)`), the way it travels in JSON messages, or out of
+        its 33 bytes compressed form used by the binary wire format.
+        """
+        if isinstance(serialised, bytes):
+            return SEC1Encoder.decode_public_key(serialised, curve.secp256k1)
+        received_public_key = serialised.split(' ')
+        x = int(received_public_key[1].strip()[:-2], 16)
+        y = int(received_public_key[2].strip()[:-4], 16)
+        return Point(x, y, curve=curve.secp256k1)
+
+    @staticmethod
+    def verify_batch(items: List[Tuple[str, tuple, Point]], workers: int = 1) -> List[bool]:
+        """
+        Verifies many (message, signature, public key) tuples, spread over a pool of `workers` processes.
+        :return: the validity of every item, in the same order
+        """
+        points = [(message, signature, (public_key.x, public_key.y)) for message, signature, public_key in items]
+        if workers <= 1 or len(points) < 2:
+            return [_verify_signature(item) for item in points]
+        chunksize = max(1, len(points) // (workers * 4))
+        return list(get_worker_pool(workers).map(_verify_signature, points, chunksize=chunksize))
+
+    @classmethod
+    def create_batch(cls, public_key: Point, private_key: int, data_list: List[dict],
+                     workers: int = 1) -> List['Transaction']:
+        """
+        Signs many records at once, spread over the same pool of `workers` processes used by `verify_batch`. The
+        records share one timestamp and, as every receiver verifies them anyway, they are not verified back here.
+        """
+        timestamp = datetime.utcnow()
+        messages = [json.dumps(cls.create_transaction_data_dictionary(data, timestamp), sort_keys=True)
+                    for data in data_list]
+        items = [(message, private_key) for message in messages]
+        if workers <= 1 or len(items) < 2:
+            signatures = [_sign_message(item) for item in items]
+        else:
+            chunksize = max(1, len(items) // (workers * 4))
+            signatures = list(get_worker_pool(workers).map(_sign_message, items, chunksize=chunksize))
+        transactions = []
+        for message, signature in zip(messages, signatures):
+            transaction = cls()
+            transaction.public_key = public_key
+            transaction.transaction_data_string = message
+            transaction.signature = json.dumps(signature)
+            transaction.transaction_hash = transaction.calculate_hash()
+            transaction.valid = True
+            transactions.append(transaction)
+        return transactions
+
     @staticmethod
     def create_transaction_data_dictionary(data, timestamp=datetime.utcnow()):
         an_uuid = uuid.uuid4()
@@ -88,6 +219,76 @@ class Transaction(db.Model):
                f'transaction_data_dictionary: {self.transaction_data_string}'
 
 
+class MinedTransaction(db.Model):
+    """
+    The hash of every transaction on the active chain and the block holding it. The `transaction` table only holds
+    the pending ones, this is what tells a replay of a mined transaction apart without reading the blocks.
+    """
+    __tablename__ = 'mined_transaction'
+
+    transaction_hash = db.Column(db.String(64), primary_key=True)
+    block_id = db.Column(db.Integer, index=True, nullable=False)
+
+    @classmethod
+    def among(cls, transaction_hashes: List[str], below_height: Optional[int] = None) -> set:
+        """
+        The ones of `transaction_hashes` already mined.
+        :param below_height: only in the blocks before this one
+        """
+        if not transaction_hashes:
+            return set()
+        query = cls.query.filter(cls.transaction_hash.in_(transaction_hashes))
+        if below_height is not None:
+            query = query.filter(cls.block_id < below_height)
+        return {row.transaction_hash for row in query.with_entities(cls.transaction_hash)}
+
+    def __repr__(self):
+        return f'MinedTransaction transaction_hash: {self.transaction_hash}, block_id: {self.block_id}'
+
+
+_worker_pools = {}
+_worker_pool_lock = threading.Lock()
+
+
+def get_worker_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    The process pool of `workers` processes shared by the signature checks, the signing and the chain validation,
+    one per size asked for.
+    """
+    with _worker_pool_lock:
+        if workers not in _worker_pools:
+            _worker_pools[workers] = ProcessPoolExecutor(max_workers=workers)
+        return _worker_pools[workers]
+
+
+def _sign_message(item) -> tuple:
+    message, private_key = item
+    return ecdsa.sign(message, private_key, curve=curve.secp256k1, hashfunc=ecdsa.sha256)
+
+
+def _verify_signature(item) -> bool:
+    message, signature, (x, y) = item
+    try:
+        public_key = Point(x, y, curve=curve.secp256k1)
+        return ecdsa.verify(signature, message, public_key, curve.secp256k1, ecdsa.sha256)
+    except Exception as e:
+        print(f'Signature could not be verified: ', e)
+        return False
+
+
+class Checkpoint(db.Model):
+    """The last block `ChainValidator` checked, so the next run starts after it."""
+    __tablename__ = 'checkpoint'
+
+    name = db.Column(db.String(50), primary_key=True)
+    height = db.Column(db.Integer, nullable=False)
+    hash = db.Column(db.String(64), nullable=False)
+    validated_at = db.Column(db.String(50), nullable=False)
+
+    def as_dict(self):
+        return {c.name: str(getattr(self, c.name)) for c in self.__table__.columns}
+
+
 class Node(db.Model):
     __tablename__ = 'node'
 
@@ -1,12 +1,255 @@
+import json
+import random
+import threading
+
 from abc import ABC, abstractmethod
+from sqlalchemy.exc import SQLAlchemyError
+from typing import List, Optional
 
-from src.models import Node
+from src import db
+from src.block_policy import BlockProductionPolicy
+from src.block_tree import BlockTree
+from src.blockchain import Blockchain
+from src.chain_sync import ChainSync
+from src.key_cache import public_key_cache
+from src.mempool import Mempool
+from src.miner import Miner
+from src.models import Block, MinedTransaction, Node, Transaction
+from src.validator import ChainValidationError, ChainValidator
 
 
 class PeerToPeer(ABC):
+    _miner_lock = threading.Lock()
+    # the miner and the chain receiving loop both write blocks
+    _chain_lock = threading.Lock()
+    # at most one chain sync running at a time, see `catch_up`
+    _sync_lock = threading.Lock()
 
     def __init__(self, app):
         self.app = app
+        public_key_cache.resize(app.config.get('PUBLIC_KEY_CACHE_SIZE', 1024))
+
+    @property
+    def miner(self) -> Miner:
+        # the backends can be instantiated several times (e.g. per API request), only one miner is ever started
+        with self._miner_lock:
+            if getattr(self, '_miner', None) is None:
+                self._miner = Miner(self.app, self.on_block_mined)
+                self._miner.start()
+        return self._miner
+
+    @property
+    def mempool(self) -> Mempool:
+        with self._miner_lock:
+            if getattr(self, '_mempool', None) is None:
+                self._mempool = Mempool(max_seen=self.app.config.get('SEEN_TRANSACTIONS_SIZE', 100000))
+                # pending transactions left over from a previous run
+                print(f'Mempool loaded with {self._mempool.load()} pending transactions.')
+        return self._mempool
+
+    @property
+    def block_policy(self) -> BlockProductionPolicy:
+        if getattr(self, '_block_policy', None) is None:
+            self._block_policy = BlockProductionPolicy.from_config(self.app.config)
+        return self._block_policy
+
+    def request_block(self):
+        """
+        To be called whenever the pending transactions or the chain tip change: (re)starts mining on top of the
+        current tip or cancels the running job when there is nothing worth mining any more.
+        """
+        if self.block_policy.should_seal(self.mempool):
+            transactions = self.mempool.take(max_transactions=self.block_policy.max_transactions,
+                                             max_bytes=self.block_policy.max_bytes)
+            self.miner.submit(Blockchain(self.app).prepare_block(transactions))
+        else:
+            self.miner.cancel()
+
+    @property
+    def group_commit(self) -> bool:
+        return self.app.config.get('TRANSACTION_COMMIT_BATCH_SIZE') is not None
+
+    def receive_timeout_ms(self) -> int:
+        # with group commit the receiving loop has to wake up often enough to honour the commit interval
+        if self.group_commit:
+            return min(1000, self.app.config.get('TRANSACTION_COMMIT_INTERVAL_MS', 50))
+        return 1000
+
+    def flush_transactions(self, force: bool = False):
+        """
+        Persists the received transactions. Without group commit every micro-batch is committed straight away,
+        with it the writes pile up until TRANSACTION_COMMIT_BATCH_SIZE or TRANSACTION_COMMIT_INTERVAL_MS is reached.
+        """
+        if force or not self.group_commit or self.mempool.flush_due(
+                self.app.config['TRANSACTION_COMMIT_BATCH_SIZE'],
+                self.app.config.get('TRANSACTION_COMMIT_INTERVAL_MS', 50)):
+            self.mempool.flush()
+
+    def seal_if_due(self):
+        # the deadline is not tied to any incoming message, the receiving loops check it on every iteration
+        if not self.miner.busy and self.block_policy.deadline_passed(self.mempool):
+            print(f'Pending transactions waited more than {self.block_policy.max_pending_seconds}s, sealing block.')
+            self.request_block()
+
+    def on_block_mined(self, block: Block):
+        with self._chain_lock:
+            last_block = Block.query.order_by(Block.id.desc()).first()
+            if last_block is None or last_block.hash != block.prev_hash:
+                print(f'Mined block {block.hash} is stale, the tip moved on.')
+                return
+            try:
+                tree = BlockTree(self.app)
+                tree.index_chain()
+                tree.add(block)
+                tree.index_transactions(block)
+                db.session.add(block)
+                db.session.commit()
+            except SQLAlchemyError as e:
+                print(f'Mined block {block.hash} could not be added: ', e)
+                db.session.rollback()
+                return
+        # only the new block travels, see `receive_blocks`
+        self.broadcast(self.chain_publisher, self.new_blocks_message([block]), topic='chain')
+        self.blocks_added([block])
+
+    def blocks_added(self, blocks: List[Block], undone: List[Block] = ()):
+        """
+        The pending transactions mined in `blocks` are done with, the ones of blocks that left the active chain in a
+        reorg are pending again. Mining restarts on top of the new tip.
+        """
+        mined = {transaction['transaction_hash'] for block in blocks for transaction in block.transactions()
+                 if 'transaction_hash' in transaction}
+        for block in undone:
+            for transaction in block.transactions():
+                if transaction.get('transaction_hash') not in mined and 'transaction_hash' in transaction:
+                    self.mempool.add(transaction)
+        for transaction_hash in mined:
+            # a late copy or a replay is dropped unchecked, see `process_transactions`
+            self.mempool.mark_seen(transaction_hash)
+        self.mempool.remove(mined)
+        self.flush_transactions(force=True)
+        self.request_block()
+
+    def new_blocks_message(self, blocks: List[Block]) -> dict:
+        # the origin is asked for whatever a receiver misses below these blocks
+        return {'origin': self.app.config['THIS_NODE'], 'blocks': [block.as_dict() for block in blocks]}
+
+    @staticmethod
+    def is_new_blocks_message(message) -> bool:
+        # the legacy message is the whole chain as a list
+        return isinstance(message, dict) and 'blocks' in message
+
+    def receive_blocks(self, message: dict) -> bool:
+        """
+        Handles a new-blocks message. Every valid block goes to the block tree, side branches included; when the
+        parent of the first one is unknown only the missing ancestors are fetched from the origin of the message. The
+        active chain then follows the tip with the most cumulative work (see `BlockTree`) and the new blocks are
+        relayed.
+        :return: True if the active chain changed
+        """
+        tree = BlockTree(self.app)
+        blocks = sorted((Block.from_dict(block) for block in message['blocks']), key=lambda block: block.id)
+        with self._chain_lock:
+            tree.index_chain()
+            received = [block for block in blocks if tree.get(block.hash) is None]
+            if not received:
+                return False
+            parent_known = received[0].id == 1 or tree.get(received[0].prev_hash) is not None
+            # the transaction is not kept open during the fetch
+            db.session.commit()
+        missing = []
+        if not parent_known:
+            # fetched without holding the lock, the miner and the other messages go on meanwhile
+            missing = self.fetch_missing(message.get('origin'), received[0], tree)
+            if missing is None:
+                return False
+        with self._chain_lock:
+            # whatever arrived while fetching is not added twice
+            branch = [block for block in missing + received if tree.get(block.hash) is None]
+            if not branch:
+                return False
+            if branch[0].id != 1 and tree.get(branch[0].prev_hash) is None:
+                print(f'Parent of block {branch[0].id} unknown, blocks dropped.')
+                return False
+            validator = ChainValidator(self.app)
+            # a side branch they extend is checked again with them, its transactions count as mined on the branch
+            checked = tree.side_branch(branch[0].prev_hash) + branch
+            try:
+                validator.validate_blocks(checked, tree.ancestors(checked[0].prev_hash, validator.history_size))
+            except ChainValidationError as e:
+                print(f'Blocks from {message.get("origin")} rejected: ', e)
+                return False
+            try:
+                if any(tree.add(block) is None for block in branch):
+                    db.session.rollback()
+                    return False
+                undone, done = tree.follow_best_tip()
+                db.session.commit()
+            except SQLAlchemyError as e:
+                print(f'Blocks could not be added: ', e)
+                db.session.rollback()
+                return False
+        if not done:
+            print(f'Blocks up to {branch[-1].hash} stored on a side branch.')
+            return False
+        print(f'Active chain now ends at block {done[-1].id}.')
+        if self.should_relay():
+            # whoever misses their ancestors can now fetch them from this node too
+            self.broadcast(self.chain_publisher, self.new_blocks_message(received), topic='chain')
+        self.blocks_added(done, undone)
+        return True
+
+    def fetch_missing(self, origin: Optional[str], first_block: Block, tree: BlockTree) -> Optional[List[Block]]:
+        """
+        The ancestors of `first_block` missing in the block tree, asked to `origin` if it is a known node. A block
+        more than MAX_FORK_DEPTH blocks ahead of the local chain is not fetched that way, the chain sync catches up.
+        """
+        best = tree.best_tip()
+        if first_block.id - (best.height if best else 0) > self.app.config.get('MAX_FORK_DEPTH', 100):
+            print(f'Block {first_block.id} is too far ahead of this node, catching up with the chain sync.')
+            self.catch_up()
+            return None
+        node = Node.query.filter_by(address=origin).first() if origin else None
+        if node is None:
+            print(f'Parent of block {first_block.id} unknown and no known node to ask for it ({origin}).')
+            return None
+        print(f'Parent of block {first_block.id} unknown, fetching it from {origin}.')
+        return Blockchain(self.app).fetch_branch(node, first_block, tree)
+
+    def catch_up(self) -> Optional[threading.Thread]:
+        """
+        Downloads what this node misses from all the nodes it knows with `ChainSync`, in the background. The blocks are
+        added under the chain lock and go through `blocks_added` like any other.
+        :return: None if a sync is already running
+        """
+        if not self._sync_lock.acquire(blocking=False):
+            return None
+        peers = [node.address for node in Node.query.all() if node.address != self.app.config['THIS_NODE']]
+
+        def sync():
+            try:
+                with self.app.app_context():
+                    ChainSync(self.app, lock=self._chain_lock, on_added=self.blocks_added).sync(peers)
+            except Exception as e:
+                print(f'Chain sync failed: ', e)
+            finally:
+                self._sync_lock.release()
+
+        thread = threading.Thread(target=sync, daemon=True)
+        thread.start()
+        return thread
+
+    def should_relay(self) -> bool:
+        """
+        Gossip: with GOSSIP_FANOUT set, a node relays the blocks it accepted with probability fanout / peers, so about
+        `fanout` nodes relay each block instead of all of them. The nodes it misses get it with the next block.
+        """
+        fanout = self.app.config.get('GOSSIP_FANOUT')
+        if fanout is None:
+            return True
+        # this node is in the table too
+        peers = Node.query.count() - 1
+        return peers <= fanout or random.random() < fanout / peers
 
     @abstractmethod
     def bootstrap(self, *args, **kwargs):
@@ -28,6 +271,89 @@ class PeerToPeer(ABC):
     def broadcast(self, publisher, data, topic) -> bool:
         raise NotImplementedError
 
+    def transport_stats(self) -> dict:
+        """Counters of the messaging layer (sent, dropped, queued...), for the backends that keep them."""
+        return {}
+
+    def broadcast_batch(self, publisher, items: List[dict], topic) -> bool:
+        """Publishes many messages of the same topic, the backends override it to do it in one send."""
+        return all([self.broadcast(publisher, item, topic) is not False for item in items])
+
+    def process_transactions(self, transactions: List[dict]):
+        """
+        Verifies the signatures of a micro-batch of received transactions in one go (see `Transaction.verify_batch`)
+        and keeps the valid ones. Transactions are identified by their content hash, the ones already seen (pending,
+        mined or with an unreadable signature) or on the active chain (see `MinedTransaction`) are dropped before
+        paying for the signature check. The hash does not cover the public key, so a transaction failing verification
+        is not marked seen: a copy with a bogus key must not get the genuine one dropped.
+        """
+        parsed = []
+        batch = set()
+        for transaction in transactions:
+            try:
+                transaction_hash = Transaction.content_hash(transaction['transaction_data_string'],
+                                                            transaction['signature'])
+                if self.mempool.seen(transaction_hash) or (transaction_hash, transaction['public_key']) in batch:
+                    print(f'Transaction: {transaction_hash} already seen, dropped.')
+                    continue
+                try:
+                    signature = tuple(json.loads(transaction['signature']))
+                except (TypeError, ValueError):
+                    # whatever the key, this transaction can never be valid
+                    self.mempool.mark_seen(transaction_hash)
+                    raise
+                public_key = public_key_cache.get(transaction['public_key'])
+                batch.add((transaction_hash, transaction['public_key']))
+                parsed.append((transaction, transaction_hash, public_key, signature))
+            except Exception as e:
+                print(f'Problem receiving transaction: ', e)
+        # the seen hashes are bounded, the mined ones outlive them
+        mined = MinedTransaction.among([transaction_hash for _, transaction_hash, _, _ in parsed])
+        for transaction_hash in mined:
+            print(f'Transaction: {transaction_hash} already mined, dropped.')
+            self.mempool.mark_seen(transaction_hash)
+        parsed = [item for item in parsed if item[1] not in mined]
+        validity = Transaction.verify_batch(
+            [(str(transaction['transaction_data_string']), signature, public_key)
+             for transaction, _, public_key, signature in parsed],
+            workers=self.app.config.get('VERIFY_WORKERS', 1))
+
+        for (transaction, transaction_hash, public_key, signature), valid in zip(parsed, validity):
+            # if we ratify the transaction sent is valid we keep it (and it is seen), the table is written behind the
+            # mempool
+            if valid:
+                transaction_db = Transaction()
+                transaction_db.transaction_hash = transaction_hash
+                transaction_db.public_key = public_key
+                transaction_db.transaction_data_string = transaction['transaction_data_string']
+                transaction_db.signature = transaction['signature']
+                transaction_db.valid = valid
+                self.mempool.add(transaction_db.as_dict())
+            else:
+                print(f'Transaction: {transaction_hash} is not valid.')
+        self.flush_transactions()
+        if any(validity):
+            # mining happens in the background, a bigger pending set refreshes the job
+            self.request_block()
+
+    def transactions_idle(self):
+        # the commit interval and the block deadline run out without any message arriving
+        self.flush_transactions()
+        self.seal_if_due()
+
+    @abstractmethod
+    def start_receiving(self) -> List[threading.Thread]:
+        """Starts receiving nodes, chains and transactions in the background."""
+        raise NotImplementedError
+
+
+class BlockingReceiving(ABC):
+    """
+    Mixin of the backends receiving through blocking reads: `receive_*` wait for the messages of one topic (up to a
+    timeout) and handle them, `start_receiving` runs them in a loop on a thread per topic. It goes before
+    `PeerToPeer` in the bases, unless the backend starts receiving its own way.
+    """
+
     @abstractmethod
     def receive_transaction(self):
         raise NotImplementedError
@@ -36,6 +362,7 @@ class PeerToPeer(ABC):
         with self.app.app_context():
             while True:
                 self.receive_transaction()
+                self.transactions_idle()
 
     @abstractmethod
     def receive_node(self):
@@ -54,3 +381,11 @@ class PeerToPeer(ABC):
         with self.app.app_context():
             while True:
                 self.receive_chain()
+
+    def start_receiving(self) -> List[threading.Thread]:
+        threads = [threading.Thread(target=self.awaiting_received_node),
+                   threading.Thread(target=self.awaiting_received_chain),
+                   threading.Thread(target=self.awaiting_transaction_broadcast)]
+        for thread in threads:
+            thread.start()
+        return threads
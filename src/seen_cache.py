@@ -0,0 +1,46 @@
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Hashable
+
+
+class SeenCache:
+    """
+    The ids of the last messages received, each one remembered for `ttl` seconds and at most `max_size` of them, so
+    the copies of a message gossiped by several nodes are dropped before decoding it.
+    """
+
+    def __init__(self, max_size: int = 100000, ttl: float = 600):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> expiry, in expiry order since they all live as long
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, key: Hashable) -> bool:
+        """:return: False if `key` was already seen (and has not expired)"""
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            if key in self.keys:
+                return False
+            self.keys[key] = now + self.ttl
+            while len(self.keys) > self.max_size:
+                self.keys.popitem(last=False)
+            return True
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self.lock:
+            self._expire(time.monotonic())
+            return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _expire(self, now: float):
+        while self.keys:
+            key, expiry = next(iter(self.keys.items()))
+            if expiry > now:
+                return
+            del self.keys[key]
@@ -0,0 +1,112 @@
+import queue
+import threading
+import uuid
+
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+from src.models import Transaction
+
+
+class TransactionSubmitter:
+    """
+    Takes signing and broadcasting off the request thread: posted records are queued under a tracking id and a pool
+    of worker threads signs them in batches (see `Transaction.create_batch`) and broadcasts them.
+    """
+
+    def __init__(self, app, keys: tuple, broadcast: Callable[[List[dict]], bool], workers: int = 1,
+                 max_queued: int = 10000, max_batch: int = 256, max_tracked: int = 100000):
+        """
+        :param keys: (private key, public key) signing the transactions
+        :param broadcast: called from the workers (inside an app context) with the signed transactions as dicts
+        :param max_tracked: how many statuses are remembered, the oldest ones are forgotten first
+        """
+        self.app = app
+        self.private_key, self.public_key = keys
+        self.broadcast = broadcast
+        self.workers = workers
+        self.max_batch = max_batch
+        self.max_tracked = max_tracked
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.statuses = OrderedDict()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def submit(self, data: dict) -> Optional[str]:
+        """:return: the tracking id of the record, None if the queue is full"""
+        tracking_id = uuid.uuid4().hex
+        self._set_status(tracking_id, {'status': 'queued'})
+        try:
+            self.queue.put_nowait((tracking_id, data))
+        except queue.Full:
+            with self.lock:
+                self.statuses.pop(tracking_id, None)
+            return None
+        return tracking_id
+
+    def status(self, tracking_id: str) -> Optional[dict]:
+        with self.lock:
+            status = self.statuses.get(tracking_id)
+            return dict(status, tracking_id=tracking_id) if status is not None else None
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                items = [item]
+                # whatever else is already waiting is signed and broadcast along
+                while len(items) < self.max_batch:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        # let the next loop exit
+                        self.queue.put(None)
+                        break
+                    items.append(item)
+                self.process(items)
+
+    def process(self, items: list):
+        try:
+            transactions = Transaction.create_batch(self.public_key, self.private_key, [data for _, data in items],
+                                                    workers=self.app.config.get('VERIFY_WORKERS', 1))
+            broadcast = self.broadcast([transaction.as_dict() for transaction in transactions])
+        except Exception as e:
+            print(f'Queued transactions could not be submitted: ', e)
+            for tracking_id, _ in items:
+                self._set_status(tracking_id, {'status': 'failed', 'message': str(e)})
+            return
+        for (tracking_id, _), transaction in zip(items, transactions):
+            if broadcast:
+                self._set_status(tracking_id, {
+                    'status': 'created',
+                    'transaction_hash': transaction.transaction_hash,
+                    'message': transaction.transaction_data_string,
+                })
+            else:
+                self._set_status(tracking_id, {'status': 'failed', 'message': 'Broadcast failed'})
+
+    def _set_status(self, tracking_id: str, status: dict):
+        with self.lock:
+            self.statuses[tracking_id] = status
+            self.statuses.move_to_end(tracking_id)
+            while len(self.statuses) > self.max_tracked:
+                self.statuses.popitem(last=False)
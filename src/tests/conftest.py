@@ -1,13 +1,19 @@
+import json
 import os
 import signal
+import time
 
 import pytest
 
 from aiohttp import web
 from aiohttp.test_utils import TestClient
+from datetime import datetime, timedelta
+from fastecdsa import curve
+from fastecdsa.keys import gen_keypair
 from src import create_app, db
+from src.blockchain import Blockchain
 from src.kafka_peer_to_peer import KafkaPeerToPeer
-from src.models import Transaction, Node
+from src.models import Block, Transaction, Node
 from src.zmq_peer_to_peer import ZMQPeerToPeer
 
 
@@ -47,6 +53,44 @@ def add_node():
     return _add_node
 
 
+@pytest.fixture(scope='function')
+def make_chain():
+    def _make_chain(app, length, data=None, genesis=None, target=None):
+        """
+        A genesis block followed by `length` blocks mined a second apart (NONCE_ZEROES of `app`).
+        :param data: of every mined block, by default two transactions signed with a fresh key
+        """
+        if genesis is None:
+            genesis = Block(data='This is the genesis block', timestamp=datetime(2022, 1, 1))
+            genesis.id = 1
+            genesis.encode_block()
+        private_key, public_key = gen_keypair(curve.secp256k1)
+        blocks = [genesis]
+        for block_id in range(2, length + 2):
+            block_data = data
+            if block_data is None:
+                transactions = Transaction.create_batch(public_key, private_key,
+                                                        [{'block': block_id, 'n': n} for n in range(2)])
+                block_data = json.dumps([transaction.as_dict() for transaction in transactions], sort_keys=True)
+            block = Block(prev_hash=blocks[-1].hash, nonce=0, data=block_data,
+                          timestamp=datetime(2022, 1, 1) + timedelta(seconds=block_id), target=target)
+            block.id = block_id
+            blocks.append(Blockchain(app).mine(block))
+        return blocks
+    return _make_chain
+
+
+@pytest.fixture(scope='function')
+def wait_for():
+    # for the work done by background threads
+    def _wait_for(condition, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.005)
+        return condition()
+    return _wait_for
+
+
 @pytest.fixture(scope='function')
 def test_kafka_peer_to_peer():
     app = create_app()
@@ -2,6 +2,7 @@ import json
 import os
 import uuid
 
+from datetime import datetime
 from fastecdsa.keys import import_key
 from freezegun import freeze_time
 from sqlalchemy.exc import SQLAlchemyError
@@ -9,6 +10,7 @@ from unittest.mock import patch
 
 from src import db
 from src.blockchain import Blockchain
+from src.merkle import verify_proof
 from src.models import Block, Node, Transaction
 
 
@@ -68,6 +70,36 @@ def test_add_transaction_invalid_json_keys(test_app, test_database):
     assert 'Input payload validation failed' in data['message']
 
 
+def test_add_transactions_batch(test_app, test_database):
+    client = test_app.test_client()
+    records = [
+        {'full_names': 'fullNames Test String 1', 'practice_number': '1234567890', 'notes': 'notes 1'},
+        {'full_names': 'fullNames Test String 2'},
+        {'full_names': 'fullNames Test String 3', 'practice_number': '1234567890', 'notes': 'notes 3 ñandú'},
+    ]
+    resp = client.post(
+        '/transactions/batch',
+        data=json.dumps(records),
+        content_type='application/json',
+    )
+    data = json.loads(resp.data)
+    assert resp.status_code == 207
+    assert data['created'] == 2
+    assert data['rejected'] == 1
+    assert [result['status'] for result in data['results']] == ['created', 'rejected', 'created']
+    assert json.loads(data['results'][2]['message'])['data'] == records[2]
+
+
+def test_add_transactions_batch_invalid_json(test_app, test_database):
+    client = test_app.test_client()
+    resp = client.post(
+        '/transactions/batch',
+        data=json.dumps({'full_names': 'fullNames Test String'}),
+        content_type='application/json',
+    )
+    assert resp.status_code == 400
+
+
 def test_get_transactions(test_app, test_database, add_transaction):
     # get the path of the current file
     current_file_path = __file__
@@ -218,6 +250,53 @@ def test_get_blocks(test_app, test_database):
     assert resp.status_code == 200
 
 
+def add_chain(length):
+    prev_hash = '000000000'
+    for block_id in range(1, length + 1):
+        block = Block(prev_hash=prev_hash, nonce=0, data='[]', timestamp=datetime.utcnow())
+        block.id = block_id
+        block.hash = block.calculate_hash()
+        prev_hash = block.hash
+        db.session.add(block)
+    db.session.commit()
+
+
+def test_get_blocks_paginated(test_app, test_database):
+    client = test_app.test_client()
+    add_chain(7)
+    resp = client.get('/blocks?from_height=3&limit=2')
+    assert resp.status_code == 200
+    assert [block['id'] for block in json.loads(resp.data.decode())] == [3, 4]
+    next_page = resp.headers['Link'].split(';')[0].strip('<>')
+    resp = client.get(next_page)
+    assert [block['id'] for block in json.loads(resp.data.decode())] == [5, 6]
+    resp = client.get('/blocks?after_hash=unknown')
+    assert resp.status_code == 404
+
+
+def test_get_blocks_not_modified(test_app, test_database):
+    client = test_app.test_client()
+    add_chain(7)
+    resp = client.get('/blocks/1')
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] == f'"{Block.query.filter_by(id=1).first().hash}"'
+    assert resp.headers['Cache-Control'].startswith('public, max-age=')
+    resp = client.get('/blocks/1', headers={'If-None-Match': resp.headers['ETag']})
+    assert resp.status_code == 304
+    assert client.get('/blocks/7').headers['Cache-Control'] == 'no-cache'
+    resp = client.get('/blocks')
+    assert client.get('/blocks', headers={'If-None-Match': resp.headers['ETag']}).status_code == 304
+
+
+def test_stream_blocks(test_app, test_database):
+    client = test_app.test_client()
+    add_chain(7)
+    resp = client.get('/blocks/stream?from_height=5')
+    assert resp.status_code == 200
+    assert resp.mimetype == 'application/x-ndjson'
+    assert [json.loads(line)['id'] for line in resp.data.decode().splitlines()] == [5, 6, 7]
+
+
 def test_get_single_block(test_app, test_database):
     client = test_app.test_client()
     blockchain = Blockchain(test_app)
@@ -231,3 +310,35 @@ def test_get_single_block(test_app, test_database):
     assert data['id'] == 1
     assert data['prev_hash'] == '000000000'
     assert data['data'] == 'This is the genesis block'
+
+
+def test_get_transaction_proof(test_app, test_database):
+    client = test_app.test_client()
+    blockchain = Blockchain(test_app)
+    test_app.config['FIRST_NODE'] = '1.2.3.4'
+    test_app.config['THIS_NODE'] = '1.2.3.4'
+    test_app.config['NONCE_ZEROES'] = '0'
+    assert blockchain.create_genesis_block() is True
+    current_file_path = __file__
+    current_directory_path = os.path.dirname(os.path.abspath(current_file_path))
+    private_key, public_key = import_key(f'{current_directory_path}/../../../keys/private_key.pem')
+    transactions = [Transaction(public_key=public_key, private_key=private_key, data={'test': f'test{i}'})
+                    for i in range(3)]
+    for transaction in transactions:
+        db.session.add(transaction)
+    db.session.commit()
+    block = blockchain.proof_of_work()
+    db.session.add(block)
+    db.session.commit()
+
+    transaction_id = json.loads(transactions[1].transaction_data_string)['transaction_id']
+    resp = client.get(f'/transactions/{transaction_id}/proof')
+    data = json.loads(resp.data.decode())
+    assert resp.status_code == 200
+    assert data['block_id'] == 2
+    assert data['merkle_root'] == block.merkle_root
+    assert data['index'] == 1
+    assert verify_proof(data['leaf'], data['proof'], data['merkle_root']) is True
+
+    resp = client.get('/transactions/0123456789abcdef/proof')
+    assert resp.status_code == 404
@@ -1,11 +1,10 @@
 import json
 import os
 import pytest
-import threading
 import time
 import zmq
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from fastecdsa.keys import import_key
 from freezegun import freeze_time
 
@@ -15,6 +14,14 @@ from src.models import Block, Node, Transaction
 from src.zmqpublisher import ZMQPublisher
 
 
+@pytest.fixture(scope='function')
+def receiving(test_zmq_peer_to_peer):
+    # the reactor reads every subscriber socket, whenever they are subscribed
+    test_zmq_peer_to_peer.start_receiving()
+    yield test_zmq_peer_to_peer
+    test_zmq_peer_to_peer.reactor.stop()
+
+
 def test_peer_to_peer_object_init(test_zmq_peer_to_peer):
     assert test_zmq_peer_to_peer.broadcast_nodes_port == '20344'
     assert test_zmq_peer_to_peer.broadcast_transaction_port == '22344'
@@ -32,31 +39,17 @@ def test_subscribe_to_nodes(test_zmq_peer_to_peer, test_database):
     assert test_zmq_peer_to_peer.add_node(localhost_node) is True
     assert test_zmq_peer_to_peer.subscribe_to_node(localhost_node) is True
     assert test_zmq_peer_to_peer.num_of_subscribers == 3
-    assert len(test_zmq_peer_to_peer.poller.sockets) == 3
-    assert isinstance(test_zmq_peer_to_peer.poller.sockets[0][0], zmq.Socket)
-    assert test_zmq_peer_to_peer.poller.sockets[0][1] == zmq.POLLIN
-    assert test_zmq_peer_to_peer.poller.sockets[0][0].getsockopt(zmq.LINGER) == 0
-    assert test_zmq_peer_to_peer.poller.sockets[0][0].getsockopt(zmq.RCVTIMEO) == -1
-    assert test_zmq_peer_to_peer.poller.sockets[0][0].getsockopt(zmq.RCVHWM) == 1000
-    assert test_zmq_peer_to_peer.poller.sockets[0][0].type == zmq.SUB
-    # Define a function that will run in a separate thread to receive messages
-    def receive():
-        msg = test_zmq_peer_to_peer.poller.sockets[0][0].recv_json()
-        assert msg == {"message": "Hello World!"}
-        assert test_zmq_peer_to_peer.num_of_subscribers == 3
-    # Start the receive function in a separate thread
-    receive_thread = threading.Thread(target=receive)
-    receive_thread.start()
-    # Wait for the thread to start before publishing the message
-    time.sleep(0.1)
-    message = {"message": "Hello World!"}
-    test_zmq_peer_to_peer.node_publisher.send_json(message)
-    # Wait for the message to be received before cleaning up
-    receive_thread.join(1)
+    subscriber = test_zmq_peer_to_peer.node_sub_sockets[-1]
+    assert isinstance(subscriber, zmq.Socket)
+    assert subscriber.getsockopt(zmq.LINGER) == 0
+    assert subscriber.getsockopt(zmq.RCVTIMEO) == -1
+    assert subscriber.getsockopt(zmq.RCVHWM) == 1000
+    assert subscriber.type == zmq.SUB
+    # handed over to the reactor, nothing else reads it
+    assert (subscriber, 'node') in list(test_zmq_peer_to_peer.reactor.added.queue)
 
     # Clean up the sockets
     test_zmq_peer_to_peer.node_publisher.close()
-    test_zmq_peer_to_peer.poller.sockets[0][0].close()
 
 
 def test_self_subscription(test_zmq_peer_to_peer, test_database, monkeypatch):
@@ -71,60 +64,43 @@ def test_self_subscription(test_zmq_peer_to_peer, test_database, monkeypatch):
     assert test_zmq_peer_to_peer.subscribe_to_node(localhost_node) is True
 
 
-def test_broadcasting(test_app, test_zmq_peer_to_peer, test_database):
+def test_broadcasting(test_app, test_zmq_peer_to_peer, test_database, receiving, monkeypatch, wait_for):
     # this is indeed a loop for testing
+    received = []
+    monkeypatch.setattr(test_zmq_peer_to_peer, 'handle_node', received.append)
     localhost = '127.0.0.1'
     localhost_node = Node(localhost)
     assert test_zmq_peer_to_peer.subscribe_to_node(localhost_node) is True
-    # Define a function that will run in a separate thread to receive messages
-    def receive():
-        msg = json.loads(test_zmq_peer_to_peer.poller.sockets[0][0].recv_json())
-        assert msg == {"message": "Hello World!"}
-        assert test_zmq_peer_to_peer.num_of_subscribers == 1
-    # Start the receive function in a separate thread
-    receive_thread = threading.Thread(target=receive)
-    receive_thread.start()
-    # Wait for the thread to start before publishing the message
+    # Wait for the subscription before publishing the message
     time.sleep(0.1)
     message = {"message": "Hello World!"}
-    test_zmq_peer_to_peer.broadcast(test_zmq_peer_to_peer.node_publisher, message)
-    # Wait for the message to be received before cleaning up
-    receive_thread.join()
+    assert test_zmq_peer_to_peer.broadcast(test_zmq_peer_to_peer.node_publisher, message) is True
+    # received through the reactor and the node worker
+    assert wait_for(lambda: received)
+    assert received == [message]
     # Clean up the sockets and context
     test_zmq_peer_to_peer.node_publisher.close()
-    test_zmq_peer_to_peer.poller.sockets[0][0].close()
 
 
-def test_receive_node(test_zmq_peer_to_peer, test_database, monkeypatch):
+def test_receive_node(test_zmq_peer_to_peer, test_database, receiving, wait_for):
     localhost = '127.0.0.1'
     localhost_node = Node(localhost)
     localhost_node.id = 1
 
     assert test_zmq_peer_to_peer.subscribe_to_node(localhost_node) is True
-
-    receive_thread = threading.Thread(target=test_zmq_peer_to_peer.awaiting_received_node)
-    receive_thread.start()
-    # Wait for the thread to start before publishing the message
+    # Wait for the subscription before publishing the message
     time.sleep(0.1)
 
     test_zmq_peer_to_peer.broadcast(test_zmq_peer_to_peer.node_publisher, localhost_node.as_dict())
 
-    # Wait for the message to be received before cleaning up
-
-    receive_thread.join(1)
-    nodes = Node.query.all()
-    assert len(nodes) == 1
-
-    print("Thread is alive: ", receive_thread.is_alive())
-    receive_thread.join(1)
+    assert wait_for(lambda: Node.query.count() == 1)
     test_zmq_peer_to_peer.node_publisher.close()
     test_zmq_peer_to_peer.chain_publisher.close()
-    test_zmq_peer_to_peer.poller.sockets[0][0].close()
     # peer_to_peer.context.term()  # apparently this is not needed
 
 
 @freeze_time("2012-01-01")
-def test_receive_chain(test_zmq_peer_to_peer, test_database, monkeypatch):
+def test_receive_chain(test_app, test_zmq_peer_to_peer, test_database, receiving, wait_for):
     localhost = '127.0.0.1'
     localhost_node = Node(localhost)
     localhost_node.id = 1
@@ -132,39 +108,37 @@ def test_receive_chain(test_zmq_peer_to_peer, test_database, monkeypatch):
     block1 = Block(prev_hash='000000000', nonce=456, data='first block', timestamp=datetime.utcnow())
     block1.hash = 'firsthash'
     block1.id = 1
-    block2 = Block(prev_hash='firsthash', nonce=456, data='second block', timestamp=datetime.utcnow())
-    block2.hash = 'secondhash'
+    # received blocks are validated, they have to meet their target
+    test_app.config['NONCE_ZEROES'] = '0'
+    blockchain = Blockchain(test_app)
+    # every block comes after its parent
+    block2 = Block(prev_hash='firsthash', nonce=456, data='second block',
+                   timestamp=datetime.utcnow() + timedelta(seconds=1))
     block2.id = 2
-    block3 = Block(prev_hash='secondhash', nonce=456, data='third block', timestamp=datetime.utcnow())
-    block3.hash = 'third'
+    block2 = blockchain.mine(block2)
+    block3 = Block(prev_hash=block2.hash, nonce=456, data='third block',
+                   timestamp=datetime.utcnow() + timedelta(seconds=2))
     block3.id = 3
+    block3 = blockchain.mine(block3)
     blocks = [block1, block2, block3]
     _blocks = []
     for block in blocks:
         _blocks.append(block.as_dict())
 
     assert test_zmq_peer_to_peer.subscribe_to_node(localhost_node) is True
-
-    receive_thread = threading.Thread(target=test_zmq_peer_to_peer.awaiting_received_chain)
-    receive_thread.start()
-    # Wait for the thread to start before publishing the message
+    # Wait for the subscription before publishing the message
     time.sleep(0.1)
 
     # we broadcast the chain
     test_zmq_peer_to_peer.broadcast(test_zmq_peer_to_peer.chain_publisher, _blocks)
 
-    # Wait for the message to be received before cleaning up
-    receive_thread.join(1)
-
+    assert wait_for(lambda: Block.query.count() == 3)
     blocks = Block.query.all()
-    assert len(blocks) == 3
     assert blocks[0].id == 1
     assert blocks[2].prev_hash == blocks[1].hash
 
     test_zmq_peer_to_peer.node_publisher.close()
     test_zmq_peer_to_peer.chain_publisher.close()
-    for socket in test_zmq_peer_to_peer.poller.sockets:
-        socket[0].close()
     # peer_to_peer.context.term()  # apparently this is not needed
 
 
@@ -197,7 +171,7 @@ def test_add_node_repeated_nodes(test_app, test_zmq_peer_to_peer, test_database,
 
 
 @pytest.mark.timeout(2)
-def test_broadcast_and_receive_transaction(test_app, test_zmq_peer_to_peer, test_database):
+def test_broadcast_and_receive_transaction(test_app, test_zmq_peer_to_peer, test_database, receiving, wait_for):
     localhost = '127.0.0.1'
     localhost_node = Node(localhost)
     localhost_node.id = 1
@@ -211,27 +185,16 @@ def test_broadcast_and_receive_transaction(test_app, test_zmq_peer_to_peer, test
     private_key, public_key = import_key(f'{current_directory_path}/../../../keys/private_key.pem')
     transaction = Transaction(private_key=private_key, public_key=public_key, data={'test': 'test'})
     transaction.id = 1
-
-    def receive():
-        with test_app.app_context():
-            test_zmq_peer_to_peer.receive_transaction()
-
-    receive_thread = threading.Thread(target=receive)
-    receive_thread.start()
-    # Wait for the thread to start before publishing the message
+    # Wait for the subscription before publishing the message
     time.sleep(0.1)
 
     test_zmq_peer_to_peer.broadcast(test_zmq_peer_to_peer.transaction_publisher, transaction.as_dict())
 
-    # Wait for the message to be received before cleaning up
-    receive_thread.join(1)
-
-    transactions = Transaction.query.all()
-    assert len(transactions) == 1
-    print("Thread is alive: ", receive_thread.is_alive())
+    assert wait_for(lambda: Transaction.query.count() == 1)
 
 
-def test_receive_transaction_threshold_must_broadcast(test_app, test_zmq_peer_to_peer, test_database, monkeypatch):
+def test_receive_transaction_threshold_must_broadcast(test_app, test_zmq_peer_to_peer, test_database, receiving,
+                                                      wait_for):
     localhost = '127.0.0.1'
     localhost_node = Node(localhost)
     localhost_node.id = 1
@@ -262,14 +225,7 @@ def test_receive_transaction_threshold_must_broadcast(test_app, test_zmq_peer_to
     db.session.add(transaction2)
     db.session.add(transaction3)
     db.session.commit()
-
-    def receive():
-        with test_app.app_context():
-            test_zmq_peer_to_peer.receive_transaction()
-
-    receive_thread = threading.Thread(target=receive)
-    receive_thread.start()
-    # Wait for the thread to start before publishing the message
+    # Wait for the subscription before publishing the message
     time.sleep(0.1)
 
     # the fourth should trigger the proof of work
@@ -278,16 +234,13 @@ def test_receive_transaction_threshold_must_broadcast(test_app, test_zmq_peer_to
 
     test_zmq_peer_to_peer.broadcast(test_zmq_peer_to_peer.transaction_publisher, transaction4.as_dict())
 
-    receive_thread.join(1)
-
-    # a block was mined
-    blocks = Block.query.all()
-    assert len(blocks) == 2
-    assert blocks[1].id == 2
+    # a block was mined, in the background
+    assert wait_for(lambda: Block.query.count() == 2, timeout=5)
+    assert Block.query.order_by(Block.id).all()[1].id == 2
 
 
 @freeze_time("2012-01-01")
-def test_broadcast_and_receive_chain(test_app, test_zmq_peer_to_peer, test_database):
+def test_broadcast_and_receive_chain(test_app, test_zmq_peer_to_peer, test_database, receiving, wait_for):
     localhost = '127.0.0.1'
     localhost_node = Node(localhost)
     localhost_node.id = 1
@@ -297,31 +250,109 @@ def test_broadcast_and_receive_chain(test_app, test_zmq_peer_to_peer, test_datab
     block1 = Block(prev_hash='000000000', nonce=456, data='first block', timestamp=datetime.utcnow())
     block1.hash = 'firsthash'
     block1.id = 1
-    block2 = Block(prev_hash='firsthash', nonce=456, data='second block', timestamp=datetime.utcnow())
-    block2.hash = 'secondhash'
+    # received blocks are validated, they have to meet their target
+    test_app.config['NONCE_ZEROES'] = '0'
+    blockchain = Blockchain(test_app)
+    # every block comes after its parent
+    block2 = Block(prev_hash='firsthash', nonce=456, data='second block',
+                   timestamp=datetime.utcnow() + timedelta(seconds=1))
     block2.id = 2
-    block3 = Block(prev_hash='secondhash', nonce=456, data='third block', timestamp=datetime.utcnow())
-    block3.hash = 'third'
+    block2 = blockchain.mine(block2)
+    block3 = Block(prev_hash=block2.hash, nonce=456, data='third block',
+                   timestamp=datetime.utcnow() + timedelta(seconds=2))
     block3.id = 3
+    block3 = blockchain.mine(block3)
     blocks = [block1, block2, block3]
     _blocks = []
     for block in blocks:
         _blocks.append(block.as_dict())
-
-    def receive():
-        with test_app.app_context():
-            test_zmq_peer_to_peer.receive_chain()
-
-    receive_thread = threading.Thread(target=receive)
-    receive_thread.start()
-    # Wait for the thread to start before publishing the message
+    # Wait for the subscription before publishing the message
     time.sleep(0.1)
 
     test_zmq_peer_to_peer.broadcast(test_zmq_peer_to_peer.chain_publisher, _blocks)
 
-    # Wait for the message to be received before cleaning up
-    receive_thread.join(1)
+    assert wait_for(lambda: Block.query.count() == 3)
+
+
+def test_receive_new_blocks(test_app, test_zmq_peer_to_peer, test_database, monkeypatch):
+    blockchain = Blockchain(test_app)
+    assert blockchain.create_genesis_block() is True
+    test_app.config['NONCE_ZEROES'] = '0'
+    block2 = blockchain.mine(blockchain.prepare_block([]))
+    block3 = Block(prev_hash=block2.hash, nonce=0, data='[]', target=block2.target,
+                   timestamp=datetime.strptime(block2.timestamp, '%Y-%m-%dT%H:%M:%SZ') + timedelta(seconds=1))
+    block3.id = 3
+    block3 = blockchain.mine(block3)
+    _block2, _block3 = block2.as_dict(), block3.as_dict()
+
+    broadcast = []
+    monkeypatch.setattr(test_zmq_peer_to_peer, 'broadcast', lambda publisher, data, topic=None: broadcast.append(data))
+    fetched = []
+
+    def get_blocks_range(self, node, from_height, limit):
+        fetched.append((from_height, limit))
+        chain = [block.as_dict() for block in Block.query.order_by(Block.id).all()] + [_block2]
+        return chain[from_height - 1:from_height - 1 + limit]
+
+    monkeypatch.setattr(Blockchain, 'get_blocks_range', get_blocks_range)
 
-    the_blocks = Block.query.all()
-    assert len(the_blocks) == 3
-    print("Thread is alive: ", receive_thread.is_alive())
+    # only known nodes are asked for missing blocks
+    assert test_zmq_peer_to_peer.receive_blocks({'origin': '127.0.0.1', 'blocks': [_block3]}) is False
+    assert fetched == []
+    db.session.add(Node(address='127.0.0.1'))
+    db.session.commit()
+    # block 2 never arrived, only the gap above the local tip is asked to the origin
+    assert test_zmq_peer_to_peer.receive_blocks({'origin': '127.0.0.1', 'blocks': [_block3]}) is True
+    assert fetched == [(2, 1)]
+    assert [block.hash for block in Block.query.order_by(Block.id).all()][1:] == [_block2['hash'], _block3['hash']]
+    assert broadcast[0]['blocks'] == [_block3]
+    # already known
+    assert test_zmq_peer_to_peer.receive_blocks({'origin': '127.0.0.1', 'blocks': [_block3]}) is False
+
+
+def test_reorg_to_the_branch_with_more_work(test_app, test_zmq_peer_to_peer, test_database, monkeypatch):
+    blockchain = Blockchain(test_app)
+    assert blockchain.create_genesis_block() is True
+    genesis = Block.query.first()
+    test_app.config['NONCE_ZEROES'] = '0'
+    monkeypatch.setattr(test_zmq_peer_to_peer, 'broadcast', lambda publisher, data, topic=None: True)
+
+    def branch(length, data):
+        blocks, prev_hash = [], genesis.hash
+        for block_id in range(2, length + 2):
+            block = Block(prev_hash=prev_hash, nonce=0, data=data,
+                          timestamp=datetime.utcnow() + timedelta(seconds=block_id))
+            block.id = block_id
+            block = blockchain.mine(block)
+            blocks.append(block.as_dict())
+            prev_hash = block.hash
+        return blocks
+
+    short, long = branch(1, 'a'), branch(2, 'b')
+    assert test_zmq_peer_to_peer.receive_blocks({'origin': None, 'blocks': short}) is True
+    assert Block.query.order_by(Block.id.desc()).first().hash == short[-1]['hash']
+    assert test_zmq_peer_to_peer.receive_blocks({'origin': None, 'blocks': long}) is True
+    assert [block.hash for block in Block.query.order_by(Block.id).all()][1:] == [block['hash'] for block in long]
+    # the shorter branch is still known, it just is not the active one
+    assert test_zmq_peer_to_peer.receive_blocks({'origin': None, 'blocks': short}) is False
+
+
+def test_mined_transactions_are_not_accepted_again(test_app, test_zmq_peer_to_peer, test_database, monkeypatch):
+    blockchain = Blockchain(test_app)
+    assert blockchain.create_genesis_block() is True
+    test_app.config['NONCE_ZEROES'] = '0'
+    monkeypatch.setattr(test_zmq_peer_to_peer, 'broadcast', lambda publisher, data, topic=None: True)
+    monkeypatch.setattr(test_zmq_peer_to_peer, 'request_block', lambda: None)
+    current_directory_path = os.path.dirname(os.path.abspath(__file__))
+    private_key, public_key = import_key(f'{current_directory_path}/../../../keys/private_key.pem')
+    transaction = Transaction(private_key=private_key, public_key=public_key, data={'test': 'test'}).as_dict()
+
+    test_zmq_peer_to_peer.process_transactions([transaction])
+    block = blockchain.mine(blockchain.prepare_block(test_zmq_peer_to_peer.mempool.take()))
+    test_zmq_peer_to_peer.on_block_mined(block)
+    assert len(test_zmq_peer_to_peer.mempool) == 0
+    # a replay long after the seen hashes forgot it
+    test_zmq_peer_to_peer.mempool.seen_hashes.clear()
+    test_zmq_peer_to_peer.process_transactions([transaction])
+    assert len(test_zmq_peer_to_peer.mempool) == 0
+    assert Transaction.query.count() == 0
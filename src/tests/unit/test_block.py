@@ -1,6 +1,8 @@
 import datetime
+import json
 import pytz
 
+from src.merkle import merkle_root
 from src.models import Block
 
 
@@ -29,3 +31,13 @@ class TestBlock:
         assert test_block.timestamp == '2022-04-21T18:30:00Z'
         assert test_block.hash == 'a89d454457144b2cb92317db6ff5273d7b81d6f149a483afe3b421be8a45c828'
         assert test_block.data == 'some data'
+
+    def test_header_hash_commits_to_the_transactions_through_the_merkle_root(self):
+        transactions = json.dumps([{'id': '1', 'transaction_data_string': 'a'}, {'id': '2', 'transaction_data_string': 'b'}])
+        test_block = Block(data=transactions, timestamp=datetime.datetime(2022, 4, 21, 18, 30, 0), target='f' * 64)
+        assert test_block.merkle_root == merkle_root(test_block.leaves())
+        assert 'data' not in test_block.header_dict()
+        first_hash = test_block.calculate_hash()
+        test_block.data = json.dumps([{'id': '1', 'transaction_data_string': 'tampered'}])
+        test_block.merkle_root = merkle_root(test_block.leaves())
+        assert test_block.calculate_hash() != first_hash
@@ -0,0 +1,27 @@
+from src.block_cache import BlockCache
+
+
+class TestBlockCache:
+    def test_served_only_for_the_same_hash(self):
+        cache = BlockCache(max_size=2)
+        cache.put(1, 'hash1', '{"id": 1}')
+        assert cache.get(1, 'hash1') == '{"id": 1}'
+        # replaced by a reorg
+        assert cache.get(1, 'other') is None
+        assert cache.stats() == {'size': 1, 'max_size': 2, 'hits': 1, 'misses': 1}
+
+    def test_least_recently_used_is_evicted(self):
+        cache = BlockCache(max_size=2)
+        cache.put(1, 'hash1', '1')
+        cache.put(2, 'hash2', '2')
+        cache.get(1, 'hash1')
+        cache.put(3, 'hash3', '3')
+        assert cache.get(2, 'hash2') is None
+        assert cache.get(1, 'hash1') == '1'
+
+    def test_invalidate_from(self):
+        cache = BlockCache()
+        for height in range(1, 6):
+            cache.put(height, f'hash{height}', str(height))
+        cache.invalidate_from(3)
+        assert [cache.get(height, f'hash{height}') for height in range(1, 6)] == ['1', '2', None, None, None]
@@ -0,0 +1,39 @@
+from src.block_policy import BlockProductionPolicy
+from src.mempool import Mempool
+
+
+def transaction(number, size=100):
+    return {'id': 'None', 'transaction_hash': f'hash{number}', 'public_key': 'key',
+            'transaction_data_string': 'x' * size, 'signature': '[1, 2]', 'valid': 'True'}
+
+
+class TestBlockProductionPolicy:
+    def test_seals_when_the_count_is_reached(self):
+        policy = BlockProductionPolicy(max_transactions=2)
+        mempool = Mempool()
+        assert policy.should_seal(mempool) is False
+        mempool.add(transaction(1))
+        assert policy.should_seal(mempool) is False
+        mempool.add(transaction(2))
+        assert policy.should_seal(mempool) is True
+
+    def test_seals_when_the_byte_budget_is_reached(self):
+        policy = BlockProductionPolicy(max_transactions=100, max_bytes=250)
+        mempool = Mempool()
+        mempool.add(transaction(1, size=200))
+        assert policy.should_seal(mempool) is False
+        mempool.add(transaction(2, size=100))
+        assert policy.should_seal(mempool) is True
+
+    def test_seals_when_the_oldest_transaction_waited_too_long(self):
+        policy = BlockProductionPolicy(max_transactions=100, max_pending_seconds=5)
+        mempool = Mempool()
+        assert policy.deadline_passed(mempool, now=1000) is False
+        mempool.add(transaction(1), arrived_at=990)
+        mempool.add(transaction(2), arrived_at=999)
+        assert policy.should_seal(mempool, now=994) is False
+        assert policy.should_seal(mempool, now=995) is True
+        # the next oldest one sets the deadline
+        mempool.remove(['hash1'])
+        assert policy.should_seal(mempool, now=1000) is False
+        assert policy.should_seal(mempool, now=1004) is True
@@ -0,0 +1,156 @@
+import pytest
+import threading
+
+from collections import defaultdict
+from flask import Flask
+from urllib.parse import parse_qs, urlparse
+
+from src import db
+from src.chain_sync import ChainSync, pick_peer, split_ranges
+from src.models import Block
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', NONCE_ZEROES='0', FLASK_RUN_PORT=5000, SYNC_RANGE_SIZE=2)
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+def as_served(block: Block) -> dict:
+    return dict(block.as_dict(), id=int(block.id), nonce=int(block.nonce))
+
+
+def served_chain(make_chain, app, length: int, **kwargs) -> list:
+    """`make_chain` as the API serves it."""
+    return [as_served(block) for block in make_chain(app, length, **kwargs)]
+
+
+def serve(monkeypatch, chains: dict, failing=()) -> list:
+    """
+    Stubs the HTTP requests: every peer serves its chain, the `failing` ones only their tip.
+    :return: the urls asked
+    """
+    requested = []
+
+    async def get(session, url):
+        requested.append(url)
+        url = urlparse(url)
+        chain = chains[url.hostname]
+        if url.path == '/blocks/tip':
+            return chain[-1]
+        if url.hostname in failing:
+            return None
+        query = parse_qs(url.query)
+        first, limit = int(query['from_height'][0]), int(query['limit'][0])
+        return chain[first - 1:first - 1 + limit]
+
+    monkeypatch.setattr(ChainSync, '_get', staticmethod(get))
+    return requested
+
+
+def store(blocks: list):
+    for block in blocks:
+        db.session.add(Block.from_dict(block))
+    db.session.commit()
+
+
+def local_chain() -> list:
+    return [block.hash for block in Block.query.order_by(Block.id).all()]
+
+
+class TestChainSync:
+    def test_split_ranges(self):
+        assert split_ranges(1, 10, 4) == [(1, 4), (5, 8), (9, 10)]
+        assert split_ranges(11, 10, 4) == []
+
+    def test_ranges_are_spread_over_the_peers_that_have_them(self):
+        heights = {'1.1.1.1': 100, '2.2.2.2': 100, '3.3.3.3': 50}
+        failures = defaultdict(int)
+        assert {pick_peer(heights, (first, first + 9), 0, failures, 3) for first in range(1, 41, 10)} == \
+               set(heights)
+        # only the longer chains go that far
+        assert pick_peer(heights, (91, 100), 0, failures, 3) in ('1.1.1.1', '2.2.2.2')
+
+    def test_retries_go_to_another_peer(self):
+        heights = {'1.1.1.1': 100, '2.2.2.2': 100}
+        failures = defaultdict(int)
+        first = pick_peer(heights, (1, 10), 0, failures, 3)
+        assert pick_peer(heights, (1, 10), 1, failures, 3) != first
+        failures['1.1.1.1'] = failures['2.2.2.2'] = 3
+        assert pick_peer(heights, (1, 10), 2, failures, 3) is None
+
+    def test_verify_range_rejects_bad_ranges(self, app, make_chain):
+        chain = served_chain(make_chain, app, 4)
+        assert [block.id for block in ChainSync._verify_range(chain[1:3], (2, 3))] == [2, 3]
+        assert ChainSync._verify_range(None, (2, 3)) is None
+        assert ChainSync._verify_range({'id': 2}, (2, 3)) is None
+        # missing, out of order and malformed blocks
+        assert ChainSync._verify_range(chain[1:2], (2, 3)) is None
+        assert ChainSync._verify_range([chain[2], chain[1]], (2, 3)) is None
+        assert ChainSync._verify_range([{'id': 2}, chain[2]], (2, 3)) is None
+        # a block that does not match its hash or does not follow the previous one
+        assert ChainSync._verify_range([dict(chain[1], nonce='1'), chain[2]], (2, 3)) is None
+        assert ChainSync._verify_range([chain[1], chain[3]], (2, 3)) is None
+
+    def test_resumes_from_the_local_tip(self, app, monkeypatch, make_chain):
+        chain = served_chain(make_chain, app, 5)
+        store(chain[:3])
+        requested = serve(monkeypatch, {'1.1.1.1': chain})
+        assert ChainSync(app).sync(['1.1.1.1']) == 3
+        assert local_chain() == [block['hash'] for block in chain]
+        assert 'http://1.1.1.1:5000/blocks?from_height=4&limit=2' in requested
+        assert not any('from_height=1&' in url or 'from_height=2&' in url for url in requested)
+        # nothing left to download
+        assert ChainSync(app).sync(['1.1.1.1']) == 0
+
+    def test_failed_range_is_asked_to_another_peer(self, app, monkeypatch, make_chain):
+        chain = served_chain(make_chain, app, 5)
+        store(chain[:1])
+        # the first choice for every range
+        requested = serve(monkeypatch, {'0.0.0.0': chain, '1.1.1.1': chain}, failing=('0.0.0.0',))
+        assert ChainSync(app).sync(['0.0.0.0', '1.1.1.1']) == 5
+        assert local_chain() == [block['hash'] for block in chain]
+        assert any(url.startswith('http://0.0.0.0:5000/blocks?') for url in requested)
+
+    def test_invalid_range_is_asked_to_another_peer(self, app, monkeypatch, make_chain):
+        chain = served_chain(make_chain, app, 5)
+        store(chain[:1])
+        # hashes matching their headers and their own target, rejected by the validator only
+        easy = served_chain(make_chain, app, 5, genesis=Block.from_dict(chain[0]), target='f' * 64)
+        requested = serve(monkeypatch, {'0.0.0.0': easy, '1.1.1.1': chain})
+        assert ChainSync(app).sync(['0.0.0.0', '1.1.1.1']) == 5
+        assert local_chain() == [block['hash'] for block in chain]
+        assert any(url.startswith('http://0.0.0.0:5000/blocks?') for url in requested)
+
+    def test_persist_holds_back_out_of_order_ranges(self, app, make_chain):
+        chain = served_chain(make_chain, app, 4)
+        store(chain[:1])
+        sync = ChainSync(app)
+        sync.next_height, sync.tip_hash = 2, chain[0]['hash']
+        downloaded = {4: ((4, 5), '1.1.1.1', [Block.from_dict(block) for block in chain[3:5]])}
+        assert sync._persist(downloaded) == (0, None)
+        assert 4 in downloaded and len(local_chain()) == 1
+        downloaded[2] = ((2, 3), '1.1.1.1', [Block.from_dict(block) for block in chain[1:3]])
+        assert sync._persist(downloaded) == (4, None)
+        assert downloaded == {} and sync.next_height == 6
+        assert local_chain() == [block['hash'] for block in chain]
+
+    def test_a_running_node_persists_under_its_lock(self, app, monkeypatch, make_chain):
+        chain = served_chain(make_chain, app, 2)
+        store(chain[:1])
+        serve(monkeypatch, {'1.1.1.1': chain})
+        lock, added = threading.Lock(), []
+
+        def on_added(done, undone):
+            # released before the mempool and the miner are told
+            assert not lock.locked()
+            added.append(([block.id for block in done], undone))
+
+        assert ChainSync(app, lock=lock, on_added=on_added).sync(['1.1.1.1']) == 2
+        assert added == [([2, 3], [])]
@@ -0,0 +1,27 @@
+from src.difficulty import MAX_TARGET, meets_target, retarget, target_from_zeroes, target_to_hex
+
+
+class TestDifficulty:
+    def test_target_from_zeroes(self):
+        target = target_from_zeroes('000')
+        assert target_to_hex(target) == '000' + 'f' * 61
+        assert meets_target('000' + 'f' * 61, target) is True
+        assert meets_target('001' + '0' * 61, target) is False
+        assert target_from_zeroes('') == MAX_TARGET
+
+    def test_retarget_follows_the_block_time(self):
+        target = target_from_zeroes('0000')
+        # blocks twice as slow as wanted, the target doubles (easier)
+        timestamps = ['2012-01-01T00:00:00Z', '2012-01-01T00:00:20Z', '2012-01-01T00:00:40Z']
+        assert retarget(target, timestamps, block_seconds=10) == target * 2
+        # blocks twice as fast as wanted, the target halves (harder)
+        timestamps = ['2012-01-01T00:00:00Z', '2012-01-01T00:00:05Z', '2012-01-01T00:00:10Z']
+        assert retarget(target, timestamps, block_seconds=10) == target // 2
+
+    def test_retarget_is_clamped(self):
+        target = target_from_zeroes('0000')
+        timestamps = ['2012-01-01T00:00:00Z', '2012-01-01T01:00:00Z']
+        assert retarget(target, timestamps, block_seconds=10) == target * 4
+        timestamps = ['2012-01-01T00:00:00Z', '2012-01-01T00:00:00Z']
+        assert retarget(target, timestamps, block_seconds=100) == target // 4
+        assert retarget(MAX_TARGET, timestamps[:1], block_seconds=10) == MAX_TARGET
@@ -0,0 +1,44 @@
+import time
+
+from src.flow_control import CreditGate
+
+
+class TestCreditGate:
+    def test_credit_is_spent_per_message(self):
+        gate = CreditGate()
+        gate.grant('1.1.1.1', 2)
+        gate.grant('2.2.2.2', 1)
+        assert gate.acquire() is True
+        # 2.2.2.2 has no room left, nothing is sent
+        assert gate.acquire() is False
+        stats = gate.stats()
+        assert stats['1.1.1.1']['credit'] == 1 and stats['1.1.1.1']['withheld'] == 0
+        assert stats['2.2.2.2']['credit'] == 0 and stats['2.2.2.2']['withheld'] == 1
+        # an advertisement replaces the credit
+        gate.grant('2.2.2.2', 5)
+        assert gate.acquire() is True
+
+    def test_silent_receivers_do_not_hold_back(self):
+        gate = CreditGate(timeout=0.01)
+        assert gate.acquire() is True
+        gate.grant('1.1.1.1', 0)
+        assert gate.acquire() is False
+        time.sleep(0.02)
+        assert gate.acquire() is True
+        assert gate.stats()['1.1.1.1']['active'] is False
+
+    def test_a_receiver_out_of_credit_only_holds_back_for_a_while(self):
+        gate = CreditGate(max_hold=0.01)
+        gate.grant('1.1.1.1', 0)
+        gate.grant('2.2.2.2', 5)
+        assert gate.acquire() is False
+        time.sleep(0.02)
+        # still advertising no credit at all, it is not waited for any more
+        gate.grant('1.1.1.1', 0)
+        assert gate.acquire() is True
+        assert gate.stats()['1.1.1.1']['active'] is False
+        assert gate.stats()['2.2.2.2']['credit'] == 4
+        # until it has room again
+        gate.grant('1.1.1.1', 1)
+        assert gate.acquire() is True
+        assert gate.acquire() is False
@@ -0,0 +1,26 @@
+from fastecdsa import curve
+from fastecdsa.keys import gen_keypair
+
+from src.key_cache import PublicKeyCache
+
+
+class TestPublicKeyCache:
+    def test_hits_and_misses(self):
+        _, public_key = gen_keypair(curve.secp256k1)
+        cache = PublicKeyCache(max_size=2)
+        assert cache.get(str(public_key)) == public_key
+        assert cache.get(str(public_key)) == public_key
+        assert cache.stats() == {'size': 1, 'max_size': 2, 'hits': 1, 'misses': 1, 'evictions': 0}
+
+    def test_least_recently_used_is_evicted(self):
+        keys = [str(gen_keypair(curve.secp256k1)[1]) for _ in range(3)]
+        cache = PublicKeyCache(max_size=2)
+        cache.get(keys[0])
+        cache.get(keys[1])
+        # keys[0] becomes the most recently used one
+        cache.get(keys[0])
+        cache.get(keys[2])
+        assert list(cache.points) == [keys[0], keys[2]]
+        assert cache.stats()['evictions'] == 1
+        cache.resize(1)
+        assert list(cache.points) == [keys[2]]
@@ -0,0 +1,112 @@
+import pytest
+import threading
+
+from flask import Flask
+
+from src import db
+from src.mempool import Mempool
+from src.models import Transaction
+
+
+def transaction(number, size=100):
+    return {'id': 'None', 'transaction_hash': f'hash{number}', 'public_key': 'key',
+            'transaction_data_string': 'x' * size, 'signature': '[1, 2]', 'valid': 'True'}
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+class TestMempool:
+    def test_add_lookup_and_count(self):
+        mempool = Mempool()
+        assert mempool.add(transaction(1)) is True
+        assert mempool.add(transaction(2, size=50)) is True
+        # duplicates are rejected
+        assert mempool.add(transaction(1)) is False
+        assert len(mempool) == 2
+        assert 'hash2' in mempool
+        assert mempool.get('hash2') == transaction(2, size=50)
+        assert mempool.get('hash3') is None
+        assert mempool.pending_bytes == 150
+
+    def test_take_keeps_arrival_order_within_the_budgets(self):
+        mempool = Mempool()
+        for number in (3, 1, 2):
+            mempool.add(transaction(number))
+        assert [t['transaction_hash'] for t in mempool.take()] == ['hash3', 'hash1', 'hash2']
+        assert [t['transaction_hash'] for t in mempool.take(max_transactions=2)] == ['hash3', 'hash1']
+        assert [t['transaction_hash'] for t in mempool.take(max_bytes=250)] == ['hash3', 'hash1']
+        # at least one, whatever its size
+        assert [t['transaction_hash'] for t in mempool.take(max_bytes=10)] == ['hash3']
+
+    def test_writes_are_queued_behind(self):
+        mempool = Mempool()
+        mempool.add(transaction(1))
+        mempool.add(transaction(2))
+        assert list(mempool.to_insert) == ['hash1', 'hash2']
+        # never written, so there is nothing to delete
+        mempool.remove(['hash1'])
+        assert list(mempool.to_insert) == ['hash2']
+        assert mempool.to_delete == set()
+        mempool.to_insert.clear()
+        mempool.remove(['hash2'])
+        assert mempool.to_delete == {'hash2'}
+        assert len(mempool) == 0
+        assert mempool.pending_bytes == 0
+
+    def test_seen_hashes_outlive_the_pending_transactions(self):
+        mempool = Mempool(max_seen=2)
+        mempool.add(transaction(1))
+        mempool.remove(['hash1'])
+        assert mempool.seen('hash1') is True
+        mempool.clear()
+        assert mempool.seen('hash1') is True
+        mempool.mark_seen('hash2')
+        mempool.mark_seen('hash3')
+        assert mempool.seen('hash1') is False
+        assert mempool.seen('hash3') is True
+
+    def test_flush_due(self):
+        mempool = Mempool()
+        assert mempool.flush_due(max_writes=2, max_delay_ms=10) is False
+        mempool.add(transaction(1))
+        assert mempool.flush_due(max_writes=2, max_delay_ms=10, now=mempool.queued_since) is False
+        assert mempool.flush_due(max_writes=2, max_delay_ms=10, now=mempool.queued_since + 0.02) is True
+        mempool.add(transaction(2))
+        assert mempool.flush_due(max_writes=2, max_delay_ms=10, now=mempool.queued_since) is True
+        mempool.clear()
+        assert mempool.flush_due(max_writes=2, max_delay_ms=10) is False
+
+    def test_a_removal_waits_for_the_insert_being_flushed(self, app, monkeypatch):
+        mempool = Mempool()
+        mempool.add(transaction(1))
+        writing, as_model = threading.Event(), Mempool._as_model
+
+        def slow_as_model(transaction):
+            writing.set()
+            threading.Event().wait(0.2)
+            return as_model(transaction)
+
+        monkeypatch.setattr(Mempool, '_as_model', staticmethod(slow_as_model))
+
+        def flush():
+            with app.app_context():
+                mempool.flush()
+
+        # the transaction thread writes the insert while the chain thread learns it was mined
+        writer = threading.Thread(target=flush)
+        writer.start()
+        writing.wait(1)
+        mempool.remove(['hash1'])
+        mempool.flush()
+        writer.join()
+        assert Transaction.query.count() == 0
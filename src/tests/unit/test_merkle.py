@@ -0,0 +1,22 @@
+from src.merkle import hash_leaf, hash_pair, merkle_proof, merkle_root, verify_proof
+
+
+class TestMerkle:
+    leaves = [hash_leaf(f'transaction {i}') for i in range(5)]
+
+    def test_merkle_root(self):
+        assert merkle_root(self.leaves[:1]) == self.leaves[0]
+        assert merkle_root(self.leaves[:2]) == hash_pair(self.leaves[0], self.leaves[1])
+        # the odd one out is promoted as it is
+        assert merkle_root(self.leaves[:3]) == hash_pair(hash_pair(self.leaves[0], self.leaves[1]), self.leaves[2])
+
+    def test_every_leaf_has_a_valid_proof(self):
+        root = merkle_root(self.leaves)
+        for index, leaf in enumerate(self.leaves):
+            assert verify_proof(leaf, merkle_proof(self.leaves, index), root) is True
+
+    def test_proof_does_not_verify_another_leaf(self):
+        root = merkle_root(self.leaves)
+        proof = merkle_proof(self.leaves, 1)
+        assert verify_proof(self.leaves[2], proof, root) is False
+        assert verify_proof(hash_leaf('forged'), proof, root) is False
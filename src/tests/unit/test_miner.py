@@ -0,0 +1,67 @@
+import threading
+import time
+
+from datetime import datetime
+from flask import Flask
+
+from src.miner import Miner
+from src.models import Block
+
+
+def make_block():
+    block = Block(prev_hash='000000000', nonce=456, data='[]', timestamp=datetime.utcnow())
+    block.id = 2
+    return block
+
+
+class TestMiner:
+    def test_mines_in_the_background(self):
+        app = Flask(__name__)
+        app.config['NONCE_ZEROES'] = '00'
+        mined = []
+        done = threading.Event()
+
+        def on_block_mined(block):
+            mined.append(block)
+            done.set()
+
+        miner = Miner(app, on_block_mined)
+        miner.start()
+        miner.submit(make_block())
+        assert done.wait(5)
+        miner.stop()
+        assert mined[0].hash.startswith('00')
+        assert mined[0].hash == mined[0].calculate_hash()
+
+    def test_cancel_aborts_the_running_job(self):
+        app = Flask(__name__)
+        # practically impossible to find
+        app.config['NONCE_ZEROES'] = '0' * 20
+        mined = []
+        miner = Miner(app, mined.append)
+        miner.start()
+        miner.submit(make_block())
+        time.sleep(0.05)
+        started = time.time()
+        miner.cancel()
+        miner.stop()
+        assert time.time() - started < 1
+        assert mined == []
+
+    def test_same_job_keeps_running(self):
+        app = Flask(__name__)
+        app.config['NONCE_ZEROES'] = '0' * 20
+        miner = Miner(app, lambda block: None)
+        miner.start()
+        block = make_block()
+        assert miner.submit(block)
+        time.sleep(0.05)
+        cancel_event = miner.cancel_event
+        # a fresh timestamp but the same transactions on the same parent
+        assert miner.submit(make_block()) is False
+        assert not cancel_event.is_set()
+        other = make_block()
+        other.data = '[{"transaction_hash": "ab"}]'
+        assert miner.submit(other)
+        assert cancel_event.is_set()
+        miner.stop()
@@ -0,0 +1,31 @@
+from src.difficulty import target_from_zeroes
+from src.mining import HeaderTemplate, hash_block_fields, parallel_search_nonce, search_nonce
+
+
+class TestMining:
+    fields = {
+        'id': '2',
+        'prev_hash': 'a89d454457144b2cb92317db6ff5273d7b81d6f149a483afe3b421be8a45c828',
+        'nonce': '456',
+        'data': 'some data',
+        'timestamp': '2022-04-21T18:30:00Z',
+    }
+
+    def test_search_nonce(self):
+        nonce, new_hash = search_nonce(self.fields, target_from_zeroes('00'), start=456)
+        assert new_hash.startswith('00')
+        assert new_hash == hash_block_fields({**self.fields, 'nonce': str(nonce)})
+
+    def test_search_nonce_exhausted(self):
+        assert search_nonce(self.fields, target_from_zeroes('0000000000'), start=0, stop=10) is None
+
+    def test_parallel_search_nonce(self):
+        nonce, new_hash = parallel_search_nonce(self.fields, target_from_zeroes('000'), workers=2, start=456)
+        assert new_hash.startswith('000')
+        assert new_hash == hash_block_fields({**self.fields, 'nonce': str(nonce)})
+
+    def test_header_template_matches_full_serialisation(self):
+        template = HeaderTemplate({**self.fields, 'data': 'some "quoted" data ñandú'})
+        for nonce in (0, 7, 456, 4294967295):
+            fields = {**self.fields, 'data': 'some "quoted" data ñandú', 'nonce': str(nonce)}
+            assert template.hash(nonce) == hash_block_fields(fields)
@@ -0,0 +1,27 @@
+import time
+
+from src.seen_cache import SeenCache
+
+
+class TestSeenCache:
+    def test_duplicates_are_reported(self):
+        cache = SeenCache()
+        assert cache.add(('chain', b'1')) is True
+        assert cache.add(('chain', b'1')) is False
+        assert cache.add(('transaction', b'1')) is True
+        assert ('chain', b'1') in cache
+
+    def test_bounded(self):
+        cache = SeenCache(max_size=2)
+        for key in (1, 2, 3):
+            cache.add(key)
+        assert len(cache) == 2
+        assert 1 not in cache
+        assert cache.add(1) is True
+
+    def test_expires(self):
+        cache = SeenCache(ttl=0.01)
+        cache.add(1)
+        time.sleep(0.02)
+        assert 1 not in cache
+        assert cache.add(1) is True
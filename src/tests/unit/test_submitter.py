@@ -0,0 +1,45 @@
+import json
+
+from fastecdsa import curve
+from fastecdsa.keys import gen_keypair
+from flask import Flask
+
+from src.models import Transaction
+from src.submitter import TransactionSubmitter
+
+
+class TestTransactionSubmitter:
+    def test_signs_and_broadcasts_off_the_caller_thread(self, wait_for):
+        private_key, public_key = gen_keypair(curve.secp256k1)
+        broadcast = []
+
+        def on_broadcast(transactions):
+            broadcast.extend(transactions)
+            return True
+
+        submitter = TransactionSubmitter(Flask(__name__), (private_key, public_key), on_broadcast, workers=2)
+        submitter.start()
+        tracking_ids = [submitter.submit({'test': f'test{i}'}) for i in range(5)]
+        for tracking_id in tracking_ids:
+            assert wait_for(lambda: submitter.status(tracking_id)['status'] != 'queued', timeout=5)
+        statuses = [submitter.status(tracking_id) for tracking_id in tracking_ids]
+        submitter.stop()
+        assert [status['status'] for status in statuses] == ['created'] * 5
+        assert sorted(status['transaction_hash'] for status in statuses) == \
+               sorted(transaction['transaction_hash'] for transaction in broadcast)
+        transaction = broadcast[0]
+        assert Transaction.verify_batch([(transaction['transaction_data_string'],
+                                          tuple(json.loads(transaction['signature'])), public_key)]) == [True]
+
+    def test_reports_failures_and_a_full_queue(self, wait_for):
+        private_key, public_key = gen_keypair(curve.secp256k1)
+        submitter = TransactionSubmitter(Flask(__name__), (private_key, public_key), lambda transactions: False,
+                                         max_queued=1)
+        tracking_id = submitter.submit({'test': 'test'})
+        # not started, nothing takes it out of the queue
+        assert submitter.submit({'test': 'other'}) is None
+        submitter.start()
+        assert wait_for(lambda: submitter.status(tracking_id)['status'] != 'queued', timeout=5)
+        assert submitter.status(tracking_id)['status'] == 'failed'
+        submitter.stop()
+        assert submitter.status('unknown') is None
@@ -2,10 +2,11 @@ import json
 import os
 import uuid
 
-from fastecdsa.keys import import_key
+from fastecdsa import curve
+from fastecdsa.keys import gen_keypair, import_key
 from freezegun import freeze_time
 
-from src.models import Transaction
+from src.models import Transaction, get_worker_pool
 
 
 class TestTransaction:
@@ -35,3 +36,45 @@ class TestTransaction:
         assert transaction_data_dictionary['timestamp'] == '2012-01-01T00:00:00Z'
         assert transaction_data_dictionary['data'] == data
         assert transaction_object.valid is True
+
+    def test_verify_batch(self):
+        private_key, public_key = gen_keypair(curve.secp256k1)
+        transactions = [Transaction(public_key=public_key, private_key=private_key, data={'test': f'test{i}'})
+                        for i in range(4)]
+        items = [(transaction.transaction_data_string, tuple(json.loads(transaction.signature)),
+                  Transaction.parse_public_key(str(transaction.public_key))) for transaction in transactions]
+        # a message that does not match its signature
+        items[2] = ('tampered', items[2][1], items[2][2])
+        assert Transaction.verify_batch(items) == [True, True, False, True]
+        assert Transaction.verify_batch(items, workers=2) == [True, True, False, True]
+
+    def test_worker_pool_per_size(self):
+        assert get_worker_pool(2) is get_worker_pool(2)
+        # a larger size asked later gets a pool of that size, not the first one created
+        assert get_worker_pool(3) is not get_worker_pool(2)
+        assert get_worker_pool(3)._max_workers == 3
+
+    def test_content_hash_is_the_identity(self):
+        private_key, public_key = gen_keypair(curve.secp256k1)
+        transaction = Transaction(public_key=public_key, private_key=private_key, data={'test': 'test'})
+        assert transaction.transaction_hash == Transaction.content_hash(transaction.transaction_data_string,
+                                                                        transaction.signature)
+        r, s = json.loads(transaction.signature)
+        # reformatted or with the other valid s, still the same transaction
+        assert Transaction.content_hash(transaction.transaction_data_string, f'[{r},{s}]') == \
+               transaction.transaction_hash
+        assert Transaction.content_hash(transaction.transaction_data_string,
+                                        json.dumps([r, curve.secp256k1.q - s])) == transaction.transaction_hash
+        assert Transaction.content_hash('other data', transaction.signature) != transaction.transaction_hash
+
+    def test_create_batch(self):
+        private_key, public_key = gen_keypair(curve.secp256k1)
+        data_list = [{'test': f'test{i}'} for i in range(4)]
+        for workers in (1, 2):
+            transactions = Transaction.create_batch(public_key, private_key, data_list, workers=workers)
+            assert [json.loads(transaction.transaction_data_string)['data'] for transaction in transactions] == \
+                   data_list
+            assert len({transaction.transaction_hash for transaction in transactions}) == 4
+            items = [(transaction.transaction_data_string, tuple(json.loads(transaction.signature)), public_key)
+                     for transaction in transactions]
+            assert Transaction.verify_batch(items) == [True] * 4
@@ -0,0 +1,159 @@
+import json
+import pytest
+
+from datetime import datetime, timedelta
+from flask import Flask
+
+from src import db
+from src.block_tree import BlockTree
+from src.blockchain import Blockchain
+from src.models import Block, Transaction
+from src.validator import ChainValidationError, ChainValidator
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', NONCE_ZEROES='0')
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+def remine(app, block: Block) -> Block:
+    block.merkle_root = Block(data=block.data).merkle_root
+    return Blockchain(app).mine(block)
+
+
+class TestChainValidator:
+    def test_valid_chain(self, app, make_chain):
+        blocks = make_chain(app, 3)
+        ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks(blocks, [])
+        # a range only needs the blocks right before it
+        ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks(blocks[2:], blocks[1:2])
+
+    def test_valid_chain_with_workers(self, app, make_chain):
+        blocks = make_chain(app, 3)
+        ChainValidator(app, workers=2, genesis_hash=blocks[0].hash).validate_blocks(blocks, [])
+
+    def test_parent_unknown(self, app, make_chain):
+        blocks = make_chain(app, 2)
+        with pytest.raises(ChainValidationError) as e:
+            ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks(blocks[2:], [])
+        assert e.value.block_id == 3
+
+    def test_other_genesis_block(self, app, make_chain):
+        blocks = make_chain(app, 1)
+        genesis = Block(data='Another genesis block', timestamp=datetime(2022, 1, 1), target='0' * 64)
+        genesis.id = 1
+        genesis.encode_block()
+        with pytest.raises(ChainValidationError, match='genesis') as e:
+            ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks([genesis], [])
+        assert e.value.block_id == 1
+
+    def test_broken_link(self, app, make_chain):
+        blocks = make_chain(app, 2)
+        blocks[2].prev_hash = blocks[0].hash
+        blocks[2] = remine(app, blocks[2])
+        with pytest.raises(ChainValidationError, match='does not follow'):
+            ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks(blocks, [])
+
+    def test_hash_does_not_match_the_header(self, app, make_chain):
+        blocks = make_chain(app, 2)
+        blocks[1].nonce += 1
+        with pytest.raises(ChainValidationError, match='hash does not match'):
+            ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks(blocks, [])
+
+    def test_target_not_met(self, app, make_chain):
+        blocks = make_chain(app, 1)
+        app.config['NONCE_ZEROES'] = '0000'
+        with pytest.raises(ChainValidationError, match='target'):
+            ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks(blocks, [])
+
+    def test_merkle_root_does_not_match(self, app, make_chain):
+        blocks = make_chain(app, 1)
+        blocks[1].merkle_root = '0' * 64
+        blocks[1] = Blockchain(app).mine(blocks[1])
+        with pytest.raises(ChainValidationError, match='merkle root'):
+            ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks(blocks, [])
+
+    def test_merkle_root_missing(self, app, make_chain):
+        blocks = make_chain(app, 1)
+        blocks[1].merkle_root = None
+        blocks[1] = Blockchain(app).mine(blocks[1])
+        with pytest.raises(ChainValidationError, match='merkle root'):
+            ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks(blocks, [])
+
+    def test_invalid_signature(self, app, make_chain):
+        blocks = make_chain(app, 2)
+        transactions = json.loads(blocks[2].data)
+        other = make_chain(app, 1)
+        transactions[1]['signature'] = json.loads(other[1].data)[1]['signature']
+        transactions[1]['transaction_hash'] = Transaction.content_hash(transactions[1]['transaction_data_string'],
+                                                                       transactions[1]['signature'])
+        blocks[2].data = json.dumps(transactions, sort_keys=True)
+        blocks[2] = remine(app, blocks[2])
+        with pytest.raises(ChainValidationError, match='invalid signature') as e:
+            ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks(blocks, [])
+        assert e.value.block_id == 3
+
+    def test_transaction_hash_does_not_match(self, app, make_chain):
+        blocks = make_chain(app, 1)
+        transactions = json.loads(blocks[1].data)
+        transactions[0]['transaction_hash'] = '0' * 64
+        blocks[1].data = json.dumps(transactions, sort_keys=True)
+        blocks[1] = remine(app, blocks[1])
+        with pytest.raises(ChainValidationError, match='does not match its hash'):
+            ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks(blocks, [])
+
+    def test_transaction_repeated_in_the_branch(self, app, make_chain):
+        blocks = make_chain(app, 2)
+        transactions = json.loads(blocks[2].data)
+        transactions[1] = json.loads(blocks[1].data)[0]
+        blocks[2].data = json.dumps(transactions, sort_keys=True)
+        blocks[2] = remine(app, blocks[2])
+        with pytest.raises(ChainValidationError, match='already in block 2') as e:
+            ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks(blocks, [])
+        assert e.value.block_id == 3
+
+    def test_transaction_repeated_in_a_block(self, app, make_chain):
+        blocks = make_chain(app, 1)
+        transactions = json.loads(blocks[1].data)
+        blocks[1].data = json.dumps([transactions[0], transactions[0]], sort_keys=True)
+        blocks[1] = remine(app, blocks[1])
+        with pytest.raises(ChainValidationError, match='already in block 2'):
+            ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks(blocks, [])
+
+    def test_transaction_already_on_the_active_chain(self, app, make_chain):
+        blocks = make_chain(app, 2)
+        BlockTree.index_transactions(blocks[1])
+        db.session.commit()
+        # the stored chain checked again
+        ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks(blocks[1:], blocks[:1])
+        transactions = json.loads(blocks[2].data)
+        transactions[1] = json.loads(blocks[1].data)[0]
+        blocks[2].data = json.dumps(transactions, sort_keys=True)
+        blocks[2] = remine(app, blocks[2])
+        with pytest.raises(ChainValidationError, match='already mined') as e:
+            ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks(blocks[2:], blocks[1:2])
+        assert e.value.block_id == 3
+
+    def test_timestamp_not_after_the_parent(self, app, make_chain):
+        blocks = make_chain(app, 2)
+        blocks[2].timestamp = blocks[1].timestamp
+        blocks[2] = remine(app, blocks[2])
+        with pytest.raises(ChainValidationError, match='timestamp not after') as e:
+            ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks(blocks, [])
+        assert e.value.block_id == 3
+
+    def test_timestamp_in_the_future(self, app, make_chain):
+        blocks = make_chain(app, 1)
+        blocks[1].timestamp = (datetime.utcnow() + timedelta(minutes=10)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        blocks[1] = remine(app, blocks[1])
+        with pytest.raises(ChainValidationError, match='future'):
+            ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks(blocks, [])
+        app.config['BLOCK_MAX_FUTURE_SECONDS'] = 3600
+        ChainValidator(app, genesis_hash=blocks[0].hash).validate_blocks(blocks, [])
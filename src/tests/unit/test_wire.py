@@ -0,0 +1,71 @@
+import json
+
+import pytest
+from fastecdsa import curve
+from fastecdsa.keys import gen_keypair
+
+from src import wire
+from src.models import Transaction
+
+
+class TestWire:
+    def test_transaction_round_trip(self):
+        private_key, public_key = gen_keypair(curve.secp256k1)
+        transaction = Transaction(public_key=public_key, private_key=private_key, data={'test': 'ñandú'})
+        message = wire.encode(transaction.as_dict(), topic='transaction')
+        assert message[:2] == wire.MAGIC + bytes((wire.VERSION,))
+        assert len(message) < len(json.dumps(json.dumps(transaction.as_dict())))
+        decoded = wire.decode(message)
+        assert decoded['transaction_hash'] == transaction.transaction_hash
+        assert decoded['transaction_data_string'] == transaction.transaction_data_string
+        assert Transaction.parse_public_key(decoded['public_key']) == public_key
+        assert json.loads(decoded['signature']) == json.loads(transaction.signature)
+
+    def test_transaction_batch_round_trip(self):
+        private_key, public_key = gen_keypair(curve.secp256k1)
+        transactions = [transaction.as_dict() for transaction in
+                        Transaction.create_batch(public_key, private_key, [{'test': f'test{i}'} for i in range(3)])]
+        decoded = wire.decode(wire.encode(transactions, topic='transaction'))
+        assert [transaction['transaction_hash'] for transaction in decoded] == \
+               [transaction['transaction_hash'] for transaction in transactions]
+        # the legacy format carries the batch as a JSON list
+        assert wire.decode(json.dumps(json.dumps(transactions)).encode()) == transactions
+
+    def test_node_and_json_round_trip(self):
+        node = {'id': '3', 'address': '1.2.3.4'}
+        assert wire.decode(wire.encode(node, topic='node')) == node
+        blocks = [{'id': '1', 'data': 'This is the genesis block'}]
+        assert wire.decode(wire.encode(blocks, topic='chain')) == blocks
+
+    def test_decodes_the_legacy_json_formats(self):
+        node = {'id': '3', 'address': '1.2.3.4'}
+        assert wire.decode(json.dumps(node).encode()) == node
+        # the ZMQ backend used to encode the JSON string twice
+        assert wire.decode(json.dumps(json.dumps(node)).encode()) == node
+
+    def test_rejects_malformed_envelopes(self):
+        message = wire.encode({'id': '3', 'address': '1.2.3.4'}, topic='node')
+        with pytest.raises(wire.WireError):
+            wire.decode(message[:-3])
+        with pytest.raises(wire.WireError):
+            wire.decode(wire.MAGIC + bytes((wire.VERSION + 1,)) + message[2:])
+
+    def test_message_ids(self):
+        private_key, public_key = gen_keypair(curve.secp256k1)
+        transaction = Transaction(public_key=public_key, private_key=private_key, data={'test': 'test'})
+        assert wire.message_id(wire.encode(transaction.as_dict(), topic='transaction')).hex() == \
+               transaction.transaction_hash
+        # the same blocks relayed by another node keep their id
+        blocks = [{'id': '2', 'hash': 'ab'}, {'id': '3', 'hash': 'cd'}]
+        mined = wire.encode({'origin': '1.1.1.1', 'blocks': blocks}, topic='chain')
+        relayed = wire.encode({'origin': '2.2.2.2', 'blocks': blocks}, topic='chain')
+        assert wire.message_id(mined) == wire.message_id(relayed)
+        assert wire.message_id(mined) != wire.message_id(wire.encode({'origin': None, 'blocks': blocks[:1]}, 'chain'))
+        assert wire.message_id(json.dumps(blocks).encode()) is None
+        assert wire.message_id(wire.encode({'id': '3', 'address': '1.2.3.4'}, topic='node')) is None
+        # what a receiver recomputes out of the decoded messages
+        assert wire.content_id(wire.decode(wire.encode(transaction.as_dict(), topic='transaction')), 'transaction') == \
+               bytes.fromhex(transaction.transaction_hash)
+        assert wire.content_id(wire.decode(relayed), 'chain') == wire.message_id(mined)
+        assert wire.content_id({'id': '3', 'address': '1.2.3.4'}, 'node') is None
+        assert wire.content_id({'signature': '[1, 2]'}, 'transaction') is None
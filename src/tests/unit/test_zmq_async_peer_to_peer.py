@@ -0,0 +1,84 @@
+import threading
+import time
+import zmq
+import zmq.asyncio
+
+from flask import Flask
+
+from src import wire
+from src.seen_cache import SeenCache
+from src.zmq_async_peer_to_peer import AsyncZMQReactor
+
+
+class TestAsyncZMQReactor:
+    def setup_method(self):
+        self.context = zmq.Context()
+        self.async_context = zmq.asyncio.Context()
+        self.app = Flask(__name__)
+
+    def teardown_method(self):
+        self.context.destroy(linger=0)
+        self.async_context.destroy(linger=0)
+
+    def pair(self, topics=('',)):
+        publisher = self.context.socket(zmq.PUB)
+        publisher.bind('tcp://127.0.0.1:*')
+        subscriber = self.async_context.socket(zmq.SUB)
+        subscriber.connect(publisher.getsockopt_string(zmq.LAST_ENDPOINT))
+        for topic in topics:
+            subscriber.setsockopt_string(zmq.SUBSCRIBE, topic)
+        return publisher, subscriber
+
+    def test_messages_are_handled_by_coroutines(self, wait_for):
+        received = {'chain': [], 'node': []}
+        handled_in = set()
+        seen = SeenCache()
+        reactor = AsyncZMQReactor(seen=seen)
+
+        def store(topic, messages):
+            handled_in.add(threading.current_thread().name)
+            received[topic].extend(messages)
+            for message in messages:
+                seen.add((topic, wire.content_id(message, topic)))
+
+        async def on_chain(messages):
+            await reactor.offload('chain', store, 'chain', messages)
+
+        async def on_node(messages):
+            await reactor.offload('node', store, 'node', messages)
+
+        reactor.on('chain', on_chain)
+        reactor.on('node', on_node)
+        chain_publisher, chain_subscriber = self.pair()
+        # added before the loop runs
+        reactor.add(chain_subscriber, 'chain')
+        reactor.start(self.app)
+        topic_publisher, topic_subscriber = self.pair(topics=('node',))
+        reactor.add(topic_subscriber)
+        time.sleep(0.2)
+
+        message = {'origin': '1.1.1.1', 'blocks': [{'id': '2', 'hash': 'ab'}]}
+        chain_publisher.send(wire.encode(message, 'chain'))
+        assert wait_for(lambda: received['chain'])
+        chain_publisher.send(wire.encode(dict(message, origin='2.2.2.2'), 'chain'))
+        topic_publisher.send_multipart([b'node', wire.encode({'id': '3', 'address': '1.2.3.4'}, 'node')])
+        assert wait_for(lambda: received['chain'] and received['node'] and reactor.duplicates['chain'] == 1)
+        reactor.stop()
+        assert received == {'chain': [message], 'node': [{'id': '3', 'address': '1.2.3.4'}]}
+        # the blocking work ran off the event loop
+        assert all('handler' in name for name in handled_in)
+
+    def test_idle_runs_without_messages(self):
+        ticks = threading.Event()
+        reactor = AsyncZMQReactor()
+
+        async def idle():
+            ticks.set()
+
+        async def ignore(messages):
+            pass
+
+        reactor.on('transaction', ignore, idle=idle, idle_ms=10)
+        reactor.start(self.app)
+        assert ticks.wait(1)
+        reactor.stop()
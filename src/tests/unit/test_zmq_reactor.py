@@ -0,0 +1,162 @@
+import threading
+import time
+import zmq
+
+from flask import Flask
+
+from src import wire
+from src.seen_cache import SeenCache
+from src.zmq_reactor import TopicWorker, ZMQReactor
+
+
+class TestZMQReactor:
+    def setup_method(self):
+        self.context = zmq.Context()
+        self.app = Flask(__name__)
+
+    def teardown_method(self):
+        self.context.destroy(linger=0)
+
+    def pair(self, address):
+        publisher = self.context.socket(zmq.PUB)
+        publisher.bind(address)
+        subscriber = self.context.socket(zmq.SUB)
+        subscriber.connect(address)
+        subscriber.setsockopt_string(zmq.SUBSCRIBE, '')
+        return publisher, subscriber
+
+    def test_messages_are_dispatched_by_topic(self, wait_for):
+        received = {'chain': [], 'node': []}
+        reactor = ZMQReactor(self.context)
+        reactor.on('chain', received['chain'].extend)
+        reactor.on('node', received['node'].extend)
+        chain_publisher, chain_subscriber = self.pair('inproc://chain')
+        node_publisher, node_subscriber = self.pair('inproc://node')
+        reactor.add(chain_subscriber, 'chain')
+        reactor.start(self.app)
+        # subscribed after the reactor started, the wakeup registers it straight away
+        reactor.add(node_subscriber, 'node')
+        assert wait_for(lambda: len(reactor.topics) == 2)
+        time.sleep(0.05)
+
+        chain_publisher.send(wire.encode({'origin': None, 'blocks': []}, 'chain'))
+        node_publisher.send(wire.encode({'id': 3, 'address': '1.2.3.4'}, 'node'))
+        assert wait_for(lambda: received['chain'] and received['node'])
+        reactor.stop()
+        assert received['chain'] == [{'origin': None, 'blocks': []}]
+        assert received['node'] == [{'id': '3', 'address': '1.2.3.4'}]
+
+    def test_undecodable_messages_are_skipped(self, wait_for):
+        received = []
+        reactor = ZMQReactor(self.context)
+        reactor.on('chain', received.extend)
+        publisher, subscriber = self.pair('inproc://chain')
+        reactor.add(subscriber, 'chain')
+        reactor.start(self.app)
+        assert wait_for(lambda: reactor.topics)
+        time.sleep(0.05)
+
+        publisher.send(b'not json')
+        publisher.send(wire.encode([1, 2], 'chain'))
+        assert wait_for(lambda: received)
+        reactor.stop()
+        assert received == [[1, 2]]
+
+    def test_topic_frames_on_a_shared_socket(self, wait_for):
+        received = {'chain': [], 'node': []}
+        reactor = ZMQReactor(self.context)
+        reactor.on('chain', received['chain'].extend)
+        reactor.on('node', received['node'].extend)
+        publisher = self.context.socket(zmq.PUB)
+        publisher.bind('inproc://topics')
+        subscriber = self.context.socket(zmq.SUB)
+        subscriber.connect('inproc://topics')
+        for topic in ('chain', 'node'):
+            subscriber.setsockopt_string(zmq.SUBSCRIBE, topic)
+        reactor.add(subscriber)
+        reactor.start(self.app)
+        assert wait_for(lambda: reactor.topics)
+        time.sleep(0.05)
+
+        # not subscribed to, filtered out by the socket
+        publisher.send_multipart([b'transaction', wire.encode([3], 'chain')])
+        publisher.send_multipart([b'chain', wire.encode([1], 'chain')])
+        publisher.send_multipart([b'node', wire.encode([2], 'chain')])
+        assert wait_for(lambda: received['chain'] and received['node'])
+        reactor.stop()
+        assert received == {'chain': [[1]], 'node': [[2]]}
+
+    def test_handled_messages_are_dropped_before_decoding(self, wait_for):
+        received = []
+        seen = SeenCache()
+        reactor = ZMQReactor(self.context, seen=seen)
+
+        def handle(messages):
+            received.extend(messages)
+            for message in messages:
+                seen.add(('chain', wire.content_id(message, 'chain')))
+
+        reactor.on('chain', handle)
+        publisher, subscriber = self.pair('inproc://chain')
+        reactor.add(subscriber, 'chain')
+        reactor.start(self.app)
+        assert wait_for(lambda: reactor.topics)
+        time.sleep(0.05)
+
+        message = {'origin': '1.1.1.1', 'blocks': [{'id': '2', 'hash': 'ab'}]}
+        # junk sent under the id of the real message is handled (and rejected) but does not shadow it
+        junk = wire.encode({'origin': '3.3.3.3', 'blocks': []}, 'chain')
+        real = wire.encode(message, 'chain')
+        publisher.send(real[:4] + wire.message_id(real) + junk[4 + junk[3]:])
+        assert wait_for(lambda: len(received) == 1)
+        publisher.send(real)
+        assert wait_for(lambda: len(received) == 2)
+        # relayed by another node
+        publisher.send(wire.encode(dict(message, origin='2.2.2.2'), 'chain'))
+        assert wait_for(lambda: reactor.duplicates['chain'] == 1)
+        reactor.stop()
+        assert received == [{'origin': '3.3.3.3', 'blocks': []}, message]
+
+
+class TestTopicWorker:
+    def test_full_queue_drops_and_counts(self, wait_for):
+        release = threading.Event()
+        handled = []
+
+        def handler(messages):
+            release.wait()
+            handled.extend(messages)
+
+        worker = TopicWorker('transaction', handler, queue_size=1)
+        worker.start(Flask(__name__))
+        assert worker.put([1])
+        assert wait_for(lambda: worker.queue.empty())
+        assert worker.put([2])
+        # the handler is still busy with the first batch and the queue holds the second one
+        assert worker.put([3, 4]) is False
+        assert worker.dropped == 2
+        release.set()
+        worker.stop()
+        assert handled == [1, 2]
+
+    def test_idle_runs_without_messages(self):
+        ticks = threading.Event()
+        worker = TopicWorker('transaction', lambda messages: None, queue_size=1, idle=ticks.set, idle_ms=10)
+        worker.start(Flask(__name__))
+        assert ticks.wait(1)
+        worker.stop()
+
+    def test_failing_idle_keeps_the_worker_running(self, wait_for):
+        ticks = []
+        handled = []
+
+        def idle():
+            ticks.append(1)
+            raise RuntimeError('database down')
+
+        worker = TopicWorker('transaction', handled.extend, queue_size=1, idle=idle, idle_ms=10)
+        worker.start(Flask(__name__))
+        assert wait_for(lambda: len(ticks) > 1)
+        assert worker.put([1])
+        assert wait_for(lambda: handled == [1])
+        worker.stop()
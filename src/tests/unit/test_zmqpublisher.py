@@ -0,0 +1,84 @@
+import socket
+import threading
+import time
+import zmq
+
+from src.zmqpublisher import ZMQPublisher
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class TestZMQPublisher:
+    def test_nodrop_counts_what_a_slow_subscriber_has_no_room_for(self):
+        port = free_port()
+        publisher = ZMQPublisher(port, {'SNDHWM': 10, 'LINGER': 0}, nodrop=True)
+        subscriber = publisher.context.socket(zmq.SUB)
+        subscriber.setsockopt(zmq.RCVHWM, 10)
+        subscriber.connect(f'tcp://127.0.0.1:{port}')
+        subscriber.setsockopt_string(zmq.SUBSCRIBE, '')
+        time.sleep(0.2)
+
+        # nobody reads, the queues fill up
+        results = [publisher.send(b'x' * 100) for _ in range(10000)]
+        assert False in results
+        stats = publisher.stats()
+        assert stats['dropped'] == results.count(False)
+        assert stats['sent'] == results.count(True)
+        subscriber.close(linger=0)
+        publisher.close()
+
+    def test_retried_messages_get_through_once_there_is_room(self):
+        port = free_port()
+        publisher = ZMQPublisher(port, {'SNDHWM': 10, 'LINGER': 0}, nodrop=True)
+        subscriber = publisher.context.socket(zmq.SUB)
+        subscriber.setsockopt(zmq.RCVHWM, 10)
+        subscriber.connect(f'tcp://127.0.0.1:{port}')
+        subscriber.setsockopt_string(zmq.SUBSCRIBE, '')
+        time.sleep(0.2)
+        # until a subscriber is full
+        while publisher.send(b'x' * 100):
+            pass
+
+        def drain():
+            time.sleep(0.05)
+            while subscriber.poll(100):
+                subscriber.recv()
+
+        reader = threading.Thread(target=drain)
+        reader.start()
+        assert publisher.send(b'block', retry_ms=2000) is True
+        reader.join()
+        subscriber.close(linger=0)
+        publisher.close()
+
+    def test_retried_messages_go_to_the_others_once_given_up(self):
+        port = free_port()
+        # small kernel buffers, what the full subscriber does not read stays in the publisher queue
+        publisher = ZMQPublisher(port, {'SNDHWM': 10, 'SNDBUF': 4096, 'LINGER': 0}, nodrop=True)
+        full = publisher.context.socket(zmq.SUB)
+        full.setsockopt(zmq.RCVHWM, 10)
+        full.setsockopt(zmq.RCVBUF, 4096)
+        full.connect(f'tcp://127.0.0.1:{port}')
+        full.setsockopt_string(zmq.SUBSCRIBE, '')
+        time.sleep(0.2)
+        # until the queues of the connection are full too
+        for _ in range(2):
+            while publisher.send(b'x' * 100000):
+                pass
+            time.sleep(0.2)
+        other = publisher.context.socket(zmq.SUB)
+        other.connect(f'tcp://127.0.0.1:{port}')
+        other.setsockopt_string(zmq.SUBSCRIBE, '')
+        time.sleep(0.2)
+        dropped = publisher.stats()['dropped']
+
+        assert publisher.send(b'block', retry_ms=50) is True
+        assert publisher.stats()['dropped'] == dropped + 1
+        assert other.poll(1000) and other.recv() == b'block'
+        full.close(linger=0)
+        other.close(linger=0)
+        publisher.close()
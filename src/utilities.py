@@ -1,11 +1,23 @@
 import aiohttp
 import os
+import threading
 
 from fastecdsa.keys import import_key, gen_keypair, export_key
 from fastecdsa import ecdsa, curve
 
 
 class Utilities:
+    _node_keys = None
+    _node_keys_lock = threading.Lock()
+
+    @classmethod
+    def node_keys(cls) -> tuple:
+        """(private key, public key) of this node, read from `keys/private_key.pem` once per process."""
+        with cls._node_keys_lock:
+            if cls._node_keys is None:
+                current_directory_path = os.path.dirname(os.path.abspath(__file__))
+                cls._node_keys = import_key(f'{current_directory_path}/../keys/private_key.pem')
+        return cls._node_keys
 
     @staticmethod
     def generate_key_pair():
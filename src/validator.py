@@ -0,0 +1,191 @@
+import json
+
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from src import db, merkle
+from src.block_tree import BlockTree
+from src.difficulty import initial_target, meets_target, retarget
+from src.key_cache import public_key_cache
+from src.models import Block, Checkpoint, MinedTransaction, Transaction, get_worker_pool
+
+
+class ChainValidationError(ValueError):
+
+    def __init__(self, block_id, reason: str):
+        super().__init__(f'Block {block_id}: {reason}')
+        self.block_id = block_id
+        self.reason = reason
+
+
+def _block_digests(block: dict) -> Tuple[str, Optional[str]]:
+    # runs in the worker processes
+    block = Block.from_dict(block)
+    return block.calculate_hash(), merkle.merkle_root(block.leaves()) if block.data else None
+
+
+class ChainValidator:
+    """
+    Checks blocks the way they are produced: they link to their parent, come after it but not from the future, their
+    hash matches their header and meets their target, the target follows the difficulty rules, the merkle root matches
+    the transactions and every transaction is correctly signed and mined only once. Block hashing and signature checks
+    are spread over VALIDATION_WORKERS processes. `validate_chain` records the last block it checked, so the next run only checks the new ones.
+    """
+
+    CHECKPOINT = 'chain'
+
+    def __init__(self, app, workers: Optional[int] = None, genesis_hash: Optional[str] = None):
+        """:param genesis_hash: the block every chain starts from, by default the one of this node"""
+        self.app = app
+        self.genesis_hash = genesis_hash
+        self.workers = workers or app.config.get('VALIDATION_WORKERS', 1)
+        self.batch_size = app.config.get('VALIDATION_BATCH_SIZE', 1000)
+
+    @property
+    def history_size(self) -> int:
+        """How many blocks before a range are needed to check it, see `validate_blocks`."""
+        if self.app.config.get('DIFFICULTY_BLOCK_SECONDS'):
+            return self.app.config.get('DIFFICULTY_RETARGET_INTERVAL', 10) + 1
+        return 1
+
+    def validate_blocks(self, blocks: List[Block], history: List[Block]):
+        """
+        :param blocks: consecutive blocks, oldest first, the active chain up to the parent of the first one is the rest
+        of their branch (see `MinedTransaction`)
+        :param history: the `history_size` blocks right before them, oldest first (none before the genesis block)
+        :raises ChainValidationError: at the first invalid block
+        """
+        if not blocks:
+            return
+        digests = self._map(_block_digests, [block.as_dict() for block in blocks])
+        previous = list(history)
+        signatures = []
+        # transaction hash -> block id, a transaction is mined once per branch
+        mined = {}
+        for block, (header_hash, merkle_root) in zip(blocks, digests):
+            self._check_header(block, previous, header_hash, merkle_root)
+            for transaction in block.transactions():
+                if not isinstance(transaction, dict):
+                    raise ChainValidationError(block.id, 'malformed transaction')
+                transaction_hash = transaction.get('transaction_hash')
+                try:
+                    public_key = public_key_cache.get(transaction['public_key'])
+                    signature = tuple(json.loads(transaction['signature']))
+                    content_hash = Transaction.content_hash(transaction['transaction_data_string'],
+                                                            transaction['signature'])
+                except (KeyError, TypeError, ValueError, IndexError) as e:
+                    raise ChainValidationError(block.id, f'malformed transaction: {e}')
+                if transaction_hash and transaction_hash != content_hash:
+                    raise ChainValidationError(block.id, f'transaction {transaction_hash} does not match its hash')
+                if content_hash in mined:
+                    raise ChainValidationError(block.id, f'transaction {content_hash} already in block '
+                                                         f'{mined[content_hash]}')
+                mined[content_hash] = block.id
+                signatures.append((block.id, transaction_hash,
+                                   (str(transaction['transaction_data_string']), signature, public_key)))
+            previous = (previous + [block])[-self.history_size:]
+        # before paying for the signatures
+        already_mined = MinedTransaction.among(list(mined), below_height=blocks[0].id)
+        if already_mined:
+            transaction_hash = min(already_mined, key=mined.get)
+            raise ChainValidationError(mined[transaction_hash], f'transaction {transaction_hash} already mined')
+        validity = Transaction.verify_batch([item for _, _, item in signatures], workers=self.workers)
+        for (block_id, transaction_hash, _), valid in zip(signatures, validity):
+            if not valid:
+                raise ChainValidationError(block_id, f'transaction {transaction_hash} has an invalid signature')
+
+    def expected_target(self, parent: Block, previous: List[Block]) -> int:
+        """The target a child of `parent` has to meet at most, the same rule as `Blockchain.next_target`."""
+        block_seconds = self.app.config.get('DIFFICULTY_BLOCK_SECONDS')
+        if not block_seconds or not parent.target:
+            return initial_target(self.app.config)
+        target = int(parent.target, 16)
+        interval = self.app.config.get('DIFFICULTY_RETARGET_INTERVAL', 10)
+        if parent.id % interval != 0:
+            return target
+        timestamps = [block.timestamp for block in previous if block.id >= parent.id - interval]
+        return retarget(target, timestamps, block_seconds)
+
+    def _check_header(self, block: Block, previous: List[Block], header_hash: str, merkle_root: Optional[str]):
+        parent = previous[-1] if previous else None
+        if parent is None:
+            if block.id != 1:
+                raise ChainValidationError(block.id, 'parent unknown')
+            # the genesis block is hashed differently (see `Blockchain.create_genesis_block`), it is pinned instead
+            genesis_hash = self.genesis_hash or BlockTree.genesis_hash()
+            if genesis_hash is not None and block.hash != genesis_hash:
+                raise ChainValidationError(block.id, 'not the genesis block of this chain')
+            return
+        if block.prev_hash != parent.hash or block.id != parent.id + 1:
+            raise ChainValidationError(block.id, f'does not follow block {parent.id}')
+        self._check_timestamp(block, parent)
+        if block.hash != header_hash:
+            raise ChainValidationError(block.id, 'hash does not match the header')
+        # the header commits to the transactions through the root only, a missing one would let them be swapped
+        if block.merkle_root != merkle_root:
+            raise ChainValidationError(block.id, 'merkle root does not match the transactions')
+        target = int(block.target, 16) if block.target else initial_target(self.app.config)
+        if target > self.expected_target(parent, previous):
+            raise ChainValidationError(block.id, 'target easier than the difficulty requires')
+        if not meets_target(block.hash, target):
+            raise ChainValidationError(block.id, 'hash does not meet the target')
+
+    def _check_timestamp(self, block: Block, parent: Block):
+        """
+        Timestamps only move forward and at most BLOCK_MAX_FUTURE_SECONDS past this node's clock, otherwise a miner
+        could stretch the intervals the retargeting reads (see `expected_target`) and make the target easier.
+        """
+        try:
+            timestamp = datetime.strptime(block.timestamp, '%Y-%m-%dT%H:%M:%SZ')
+            parent_timestamp = datetime.strptime(parent.timestamp, '%Y-%m-%dT%H:%M:%SZ')
+        except (TypeError, ValueError):
+            raise ChainValidationError(block.id, f'malformed timestamp {block.timestamp}')
+        if timestamp <= parent_timestamp:
+            raise ChainValidationError(block.id, f'timestamp not after the one of block {parent.id}')
+        if timestamp > datetime.utcnow() + timedelta(seconds=self.app.config.get('BLOCK_MAX_FUTURE_SECONDS', 120)):
+            raise ChainValidationError(block.id, 'timestamp in the future')
+
+    def validate_chain(self, from_height: Optional[int] = None, to_height: Optional[int] = None,
+                       use_checkpoint: bool = True) -> int:
+        """
+        Validates the active chain in batches of VALIDATION_BATCH_SIZE blocks, recording a checkpoint after each one.
+        :param from_height: by default right after the checkpoint, or the genesis block
+        :return: the height of the last block validated
+        :raises ChainValidationError: at the first invalid block
+        """
+        start = from_height or self._start_after_checkpoint(use_checkpoint)
+        history = Block.query.filter(Block.id >= start - self.history_size, Block.id < start) \
+            .order_by(Block.id).all()
+        height = start - 1
+        while to_height is None or height < to_height:
+            end = height + self.batch_size if to_height is None else min(height + self.batch_size, to_height)
+            blocks = Block.query.filter(Block.id > height, Block.id <= end).order_by(Block.id).all()
+            if not blocks:
+                break
+            self.validate_blocks(blocks, history)
+            history = (history + blocks)[-self.history_size:]
+            height = blocks[-1].id
+            self.save_checkpoint(blocks[-1])
+            print(f'Chain valid up to block {height}.')
+        return height
+
+    def _start_after_checkpoint(self, use_checkpoint: bool) -> int:
+        checkpoint = db.session.get(Checkpoint, self.CHECKPOINT) if use_checkpoint else None
+        if checkpoint is None:
+            return 1
+        block = Block.query.filter_by(id=checkpoint.height).first()
+        if block is None or block.hash != checkpoint.hash:
+            print(f'Checkpoint at block {checkpoint.height} left the active chain, validating from the genesis block.')
+            return 1
+        return checkpoint.height + 1
+
+    def save_checkpoint(self, block: Block):
+        db.session.merge(Checkpoint(name=self.CHECKPOINT, height=block.id, hash=block.hash,
+                                    validated_at=datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')))
+        db.session.commit()
+
+    def _map(self, function, items: list) -> list:
+        if self.workers <= 1 or len(items) < 2:
+            return [function(item) for item in items]
+        chunksize = max(1, len(items) // (self.workers * 4))
+        return list(get_worker_pool(self.workers).map(function, items, chunksize=chunksize))
@@ -0,0 +1,164 @@
+"""
+Binary envelope of the messages exchanged between nodes:
+
+    magic (1 byte) | version (1 byte) | type (1 byte) | id length (1 byte) | id | fields
+
+every field being a 4 bytes big endian length followed by its bytes. Transactions travel as the raw 64 bytes signature
+(r || s) and the 33 bytes compressed public key, a batch of them as one message whose fields are transaction envelopes.
+The id of a transaction is its hash and the id of a new-blocks message derives from the blocks it carries, so copies
+relayed by other nodes can be told apart without decoding them. The id is chosen by the sender: a receiver only trusts
+the one it recomputed out of a message it handled (see `content_id`). JSON messages (the legacy format) are told apart
+by their first byte, so a node decodes both whatever it sends.
+"""
+
+import hashlib
+import json
+import struct
+import uuid
+
+from typing import Optional
+
+from fastecdsa.encoding.sec1 import SEC1Encoder
+
+from src.key_cache import public_key_cache
+from src.models import Transaction
+
+MAGIC = b'\xbc'
+VERSION = 1
+
+TYPE_JSON = 0
+TYPE_TRANSACTION = 1
+TYPE_NODE = 2
+TYPE_TRANSACTIONS = 3
+
+BINARY = 'binary'
+JSON = 'json'
+
+
+class WireError(ValueError):
+    pass
+
+
+def encode(data, topic: str = None) -> bytes:
+    if topic == 'transaction' and isinstance(data, dict):
+        return _envelope(TYPE_TRANSACTION, bytes.fromhex(_transaction_hash(data)), _transaction_fields(data))
+    if topic == 'transaction' and isinstance(data, list):
+        return _envelope(TYPE_TRANSACTIONS, b'', [encode(transaction, topic) for transaction in data])
+    if topic == 'node' and isinstance(data, dict) and 'address' in data:
+        return _envelope(TYPE_NODE, b'', [str(data['id']).encode(), data['address'].encode()])
+    return _envelope(TYPE_JSON, _json_message_id(data, topic),
+                     [json.dumps(data, sort_keys=True, ensure_ascii=False).encode()])
+
+
+def message_id(message: bytes) -> Optional[bytes]:
+    """The id in the envelope of `message` without decoding the rest, None for JSON or id-less messages."""
+    if message[:1] != MAGIC or len(message) < 4:
+        return None
+    return message[4:4 + message[3]] or None
+
+
+def decode(message: bytes):
+    if not message[:1] == MAGIC:
+        data = json.loads(message)
+        # some publishers encode the JSON string twice
+        return json.loads(data) if isinstance(data, str) else data
+    if len(message) < 4:
+        raise WireError('Truncated envelope')
+    version, message_type, id_length = message[1], message[2], message[3]
+    if version != VERSION:
+        raise WireError(f'Unsupported wire version {version}')
+    message_id = message[4:4 + id_length]
+    fields = _split_fields(message, 4 + id_length)
+    if message_type == TYPE_TRANSACTION:
+        return _transaction_from_fields(message_id, fields)
+    if message_type == TYPE_TRANSACTIONS:
+        transactions = [decode(field) for field in fields]
+        if not all(isinstance(transaction, dict) for transaction in transactions):
+            raise WireError('Malformed transaction batch')
+        return transactions
+    if message_type == TYPE_NODE and len(fields) == 2:
+        return {'id': fields[0].decode(), 'address': fields[1].decode()}
+    if message_type == TYPE_JSON and len(fields) == 1:
+        return json.loads(fields[0])
+    raise WireError(f'Unknown or malformed message of type {message_type}')
+
+
+def content_id(data, topic: str) -> Optional[bytes]:
+    """
+    The envelope id of `data` recomputed out of its decoded content, None for the messages that have no stable one
+    (or are malformed).
+    """
+    try:
+        if topic == 'transaction' and isinstance(data, dict):
+            return bytes.fromhex(Transaction.content_hash(data['transaction_data_string'], data['signature']))
+        if topic == 'chain' and isinstance(data, dict) and isinstance(data.get('blocks'), list):
+            return _blocks_id(data['blocks'])
+    except (KeyError, TypeError, ValueError):
+        pass
+    return None
+
+
+def _json_message_id(data, topic: str) -> bytes:
+    if topic == 'chain' and isinstance(data, dict) and isinstance(data.get('blocks'), list):
+        # whoever relays the same blocks sends the same id, see `SeenCache`
+        return _blocks_id(data['blocks'])
+    return uuid.uuid4().bytes
+
+
+def _blocks_id(blocks: list) -> bytes:
+    hashes = ''.join(str(block.get('hash')) for block in blocks if isinstance(block, dict))
+    return hashlib.sha256(hashes.encode()).digest()[:16]
+
+
+def _envelope(message_type: int, message_id: bytes, fields) -> bytes:
+    parts = [MAGIC, bytes((VERSION, message_type, len(message_id))), message_id]
+    for field in fields:
+        parts.append(struct.pack('>I', len(field)))
+        parts.append(field)
+    return b''.join(parts)
+
+
+def _split_fields(message: bytes, offset: int) -> list:
+    fields = []
+    while offset < len(message):
+        if offset + 4 > len(message):
+            raise WireError('Truncated field length')
+        (length,) = struct.unpack_from('>I', message, offset)
+        offset += 4
+        if offset + length > len(message):
+            raise WireError('Truncated field')
+        fields.append(message[offset:offset + length])
+        offset += length
+    return fields
+
+
+def _transaction_hash(transaction: dict) -> str:
+    transaction_hash = transaction.get('transaction_hash')
+    if not transaction_hash or transaction_hash == 'None':
+        transaction_hash = Transaction.content_hash(transaction['transaction_data_string'], transaction['signature'])
+    return transaction_hash
+
+
+def _transaction_fields(transaction: dict) -> list:
+    public_key = public_key_cache.get(transaction['public_key'])
+    r, s = json.loads(transaction['signature'])
+    return [
+        SEC1Encoder.encode_public_key(public_key, compressed=True),
+        r.to_bytes(32, 'big') + s.to_bytes(32, 'big'),
+        transaction['transaction_data_string'].encode(),
+    ]
+
+
+def _transaction_from_fields(message_id: bytes, fields: list) -> dict:
+    if len(fields) != 3 or len(fields[0]) != 33 or len(fields[1]) != 64:
+        raise WireError('Malformed transaction')
+    public_key, signature, transaction_data_string = fields
+    return {
+        'id': 'None',
+        'transaction_hash': message_id.hex(),
+        # decoded (and cached) by `public_key_cache`
+        'public_key': public_key,
+        'transaction_data_string': transaction_data_string.decode(),
+        'signature': json.dumps([int.from_bytes(signature[:32], 'big'), int.from_bytes(signature[32:], 'big')]),
+        'valid': 'True',
+    }
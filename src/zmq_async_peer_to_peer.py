@@ -0,0 +1,204 @@
+import asyncio
+import threading
+import zmq
+import zmq.asyncio
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from src import wire
+from src.seen_cache import SeenCache
+from src.zmq_peer_to_peer import BaseZMQPeerToPeer
+
+
+class AsyncZMQReactor:
+    """
+    `ZMQReactor` on an asyncio event loop: one coroutine per subscriber socket awaits its messages, drops the ones
+    already handled, decodes the others and queues them for the consumer coroutine of their topic. A full queue makes
+    the readers wait (and ZMQ buffer) instead of dropping. The handlers are coroutines, blocking work such as the database
+    goes through `offload`, on one thread per topic so the messages of a topic are still handled in order.
+    """
+
+    def __init__(self, queue_size: int = 1000, batch_size: int = 64, seen: Optional[SeenCache] = None):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.seen = seen
+        self.duplicates = defaultdict(int)
+        self.handlers = {}
+        self.queues = {}
+        self.executors = {}
+        self.tasks = []
+        self.app = None
+        self.loop = None
+        self.stopped = None
+        self.thread = None
+        # sockets added before the loop runs
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def on(self, topic: str, handler: Callable[[list], Awaitable], idle: Optional[Callable[[], Awaitable]] = None,
+           idle_ms: int = 1000):
+        """Sets the coroutine handling the messages of a topic, before `start`."""
+        self.handlers[topic] = (handler, idle, idle_ms)
+
+    def add(self, socket: zmq.asyncio.Socket, topic: Optional[str] = None):
+        """
+        Starts reading a subscriber socket. Thread safe.
+        :param topic: of every message of the socket, None when they come with a topic frame
+        """
+        with self.lock:
+            if self.loop is None:
+                self.pending.append((socket, topic))
+                return
+        self.loop.call_soon_threadsafe(self._read_soon, socket, topic)
+
+    def start(self, app) -> List[threading.Thread]:
+        self.app = app
+        ready = threading.Event()
+        self.thread = threading.Thread(target=asyncio.run, args=(self.run(ready),), daemon=True)
+        self.thread.start()
+        ready.wait()
+        return [self.thread]
+
+    def stop(self):
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+            self.thread.join()
+            self.thread = None
+
+    async def run(self, ready: threading.Event):
+        self.stopped = asyncio.Event()
+        for topic in self.handlers:
+            self.queues[topic] = asyncio.Queue(maxsize=self.queue_size)
+            self.executors[topic] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{topic}-handler')
+            self.tasks.append(asyncio.create_task(self.consume(topic)))
+        with self.lock:
+            self.loop = asyncio.get_running_loop()
+            pending, self.pending = self.pending, []
+        for socket, topic in pending:
+            self._read_soon(socket, topic)
+        ready.set()
+        await self.stopped.wait()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for executor in self.executors.values():
+            executor.shutdown(wait=True)
+        with self.lock:
+            self.loop = None
+        self.tasks = []
+
+    def _read_soon(self, socket: zmq.asyncio.Socket, topic: Optional[str]):
+        self.tasks.append(self.loop.create_task(self.read(socket, topic)))
+
+    async def read(self, socket: zmq.asyncio.Socket, topic: Optional[str]):
+        while True:
+            try:
+                message_topic, message = await self._receive(socket, topic)
+            except zmq.ZMQError as e:
+                print(f'ZMQError at receiving {topic}: {e}')
+                return
+            except Exception as e:
+                print(f'Problem decoding {topic} message: ', e)
+                continue
+            if message_topic is None:
+                continue
+            if message_topic not in self.queues:
+                print(f'No handler for topic {message_topic}, message dropped.')
+                continue
+            # waits while the consumer is that far behind
+            await self.queues[message_topic].put(message)
+
+    async def _receive(self, socket: zmq.asyncio.Socket, topic: Optional[str]) -> Tuple[Optional[str], object]:
+        """:return: the topic and the decoded message, no topic for a message already seen"""
+        if topic is None:
+            frame, payload = await socket.recv_multipart()
+            topic = frame.decode()
+        else:
+            payload = await socket.recv()
+        message_id = wire.message_id(payload) if self.seen is not None else None
+        if message_id is not None and (topic, message_id) in self.seen:
+            self.duplicates[topic] += 1
+            return None, None
+        return topic, wire.decode(payload)
+
+    async def consume(self, topic: str):
+        handler, idle, idle_ms = self.handlers[topic]
+        queue = self.queues[topic]
+        while True:
+            messages = []
+            try:
+                messages.append(await asyncio.wait_for(queue.get(), idle_ms / 1000))
+            except asyncio.TimeoutError:
+                pass
+            while messages and len(messages) < self.batch_size and not queue.empty():
+                messages.append(queue.get_nowait())
+            try:
+                if messages:
+                    await handler(messages)
+                if idle is not None:
+                    await idle()
+            except Exception as e:
+                print(f'A problem occurred handling {topic} messages: ', e)
+
+    async def offload(self, topic: str, function: Callable, *args):
+        """Runs `function` on the thread of `topic`, inside an app context."""
+        return await asyncio.get_running_loop().run_in_executor(self.executors[topic], self._in_app_context,
+                                                                function, *args)
+
+    def _in_app_context(self, function: Callable, *args):
+        with self.app.app_context():
+            return function(*args)
+
+    def backlog(self, topic: str) -> int:
+        """How many messages of `topic` are waiting to be handled."""
+        return self.queues[topic].qsize() if topic in self.queues else 0
+
+    def stats(self) -> dict:
+        return {topic: {'queued': self.queues[topic].qsize() if topic in self.queues else 0,
+                        'duplicates': self.duplicates[topic]}
+                for topic in self.handlers}
+
+
+class AsyncZMQPeerToPeer(BaseZMQPeerToPeer):
+    """
+    The ZMQ backend with every subscriber socket read by coroutines on a single event loop (see `AsyncZMQReactor`),
+    instead of a thread waiting on a poller. Publishing, the ports and the wire format are the same, so these nodes
+    and `ZMQPeerToPeer` ones can run in the same network.
+    """
+    _instance = None
+    node_sub_sockets = []
+    chain_sub_sockets = []
+    transaction_sub_sockets = []
+    topic_sub_sockets = []
+    context = zmq.asyncio.Context()
+    reactor = None
+    seen = None
+
+    def create_reactor(self) -> AsyncZMQReactor:
+        reactor = AsyncZMQReactor(queue_size=self.app.config.get('ZMQ_DISPATCH_QUEUE_SIZE', 1000),
+                                  batch_size=self.app.config.get('ZMQ_DISPATCH_BATCH_SIZE',
+                                                                 self.app.config.get('VERIFY_BATCH_SIZE', 64)),
+                                  seen=self.seen)
+        reactor.on('node', self.on_nodes)
+        reactor.on('chain', self.on_chains)
+        reactor.on('transaction', self.on_transactions, idle=self.on_transactions_idle,
+                   idle_ms=self.receive_timeout_ms())
+        return reactor
+
+    async def on_nodes(self, messages: list):
+        await self.reactor.offload('node', self.handle_nodes, messages)
+
+    async def on_chains(self, messages: list):
+        await self.reactor.offload('chain', self.handle_chains, messages)
+
+    async def on_transactions(self, messages: list):
+        await self.reactor.offload('transaction', self.handle_transactions, messages)
+
+    async def on_transactions_idle(self):
+        await self.reactor.offload('transaction', self.transactions_idle)
+
+
+def create_async_zmq(app):
+    return AsyncZMQPeerToPeer(app)
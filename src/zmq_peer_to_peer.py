@@ -1,26 +1,41 @@
 import json
+import threading
 import time
 import zmq
 
-from fastecdsa import ecdsa, curve
-from fastecdsa.point import Point
 from sqlalchemy.exc import SQLAlchemyError
-from typing import Union
+from typing import List, Optional, Tuple, Union
 
-from src import db
-from src.models import Block, Node, Transaction
+from src import db, wire
+from src.models import Node
+from src.block_tree import BlockTree
 from src.blockchain import Blockchain
+from src.chain_sync import ChainSync
+from src.flow_control import CreditGate
 from src.peer_to_peer import PeerToPeer
-from src.zmqpublisher import ZMQPublisher
+from src.seen_cache import SeenCache
+from src.zmq_reactor import ZMQReactor
+from src.zmqpublisher import ZMQPublisher, set_socket_options
 
 
-class ZMQPeerToPeer(PeerToPeer):
+class BaseZMQPeerToPeer(PeerToPeer):
+    """
+    What the ZMQ backends share: the publishers, the subscriptions, the wire format and the handlers. How the
+    subscriber sockets are read is up to the subclasses.
+    """
     _instance = None
+    TOPICS = ('node', 'chain', 'transaction')
     node_sub_sockets = []
     chain_sub_sockets = []
     transaction_sub_sockets = []
-    poller = zmq.Poller()
+    # one per node in the single port layout, every message comes with its topic
+    topic_sub_sockets = []
     context = zmq.Context()
+    reactor = None
+    seen = None
+    # set with TRANSACTION_FLOW_CONTROL = 'credit'
+    flow_control = None
+    credit_advertised_at = 0
     num_of_publishers = 0
     num_of_subscribers = 0
 
@@ -34,9 +49,46 @@ class ZMQPeerToPeer(PeerToPeer):
         self.broadcast_nodes_port = app.config['NODES_PORT']
         self.broadcast_transaction_port = app.config['TRANSACTION_PORT']
         self.broadcast_chain_port = app.config['CHAIN_PORT']
-        self.node_publisher = self.set_publisher(self.broadcast_nodes_port)
-        self.chain_publisher = self.set_publisher(self.broadcast_chain_port)
-        self.transaction_publisher = self.set_publisher(self.broadcast_transaction_port)
+        self.topic_port = app.config.get('ZMQ_TOPIC_PORT')
+        if self.topic_port is not None:
+            self.node_publisher = self.chain_publisher = self.transaction_publisher = \
+                self.set_publisher(self.topic_port, self.socket_options())
+        else:
+            self.node_publisher = self.set_publisher(self.broadcast_nodes_port, self.socket_options('node'))
+            self.chain_publisher = self.set_publisher(self.broadcast_chain_port, self.socket_options('chain'))
+            self.transaction_publisher = self.set_publisher(self.broadcast_transaction_port,
+                                                            self.socket_options('transaction'))
+        if self.reactor is None:
+            if app.config.get('TRANSACTION_FLOW_CONTROL') == 'credit':
+                self.flow_control = CreditGate(timeout=app.config.get('TRANSACTION_CREDIT_TIMEOUT', 5),
+                                               max_hold=app.config.get('TRANSACTION_CREDIT_MAX_HOLD', 1))
+            self.seen = SeenCache(max_size=app.config.get('GOSSIP_SEEN_SIZE', 100000),
+                                  ttl=app.config.get('GOSSIP_SEEN_TTL', 600))
+            # every subscriber socket is handed over to it, see `start_receiving`
+            self.reactor = self.create_reactor()
+
+    def create_reactor(self) -> ZMQReactor:
+        reactor = ZMQReactor(self.context, queue_size=self.app.config.get('ZMQ_DISPATCH_QUEUE_SIZE', 1000),
+                             batch_size=self.app.config.get('ZMQ_DISPATCH_BATCH_SIZE',
+                                                            self.app.config.get('VERIFY_BATCH_SIZE', 64)),
+                             seen=self.seen)
+        reactor.on('node', self.handle_nodes)
+        reactor.on('chain', self.handle_chains)
+        reactor.on('transaction', self.handle_transactions, idle=self.transactions_idle,
+                   idle_ms=self.receive_timeout_ms())
+        return reactor
+
+    def socket_options(self, topic: Optional[str] = None) -> dict:
+        """
+        The ZMQ options (HWM, linger, buffer sizes...) of the sockets of `topic`: the 'default' entry of
+        ZMQ_SOCKET_OPTIONS overridden by the one of the topic. The single port layout only uses the 'default' one.
+        """
+        options = self.app.config.get('ZMQ_SOCKET_OPTIONS', {})
+        return {**options.get('default', {}), **(options.get(topic, {}) if topic else {})}
+
+    def start_receiving(self) -> List[threading.Thread]:
+        """One thread reads every subscriber socket and hands the messages to a worker per topic."""
+        return self.reactor.start(self.app)
 
     def bootstrap(self, *args, **kwargs):
         blockchain = Blockchain(self.app)
@@ -69,19 +121,9 @@ class ZMQPeerToPeer(PeerToPeer):
                         self.subscribe_to_node(_node)
                         self.add_node(_node)
 
-                    # at least get a genesis block
-                    if not Block.query.all():
-                        response = blockchain.get_blocks_from(Node(address=node['address']), 1)
-                        if response:
-                            try:
-                                genesis_block = Block()
-                                [setattr(genesis_block, key, response[key]) for key in response]
-                                db.session.add(genesis_block)
-                                db.session.commit()
-                            except SQLAlchemyError as e:
-                                print(f'Genesis block could not be added: ', e)
-                            except Exception as e:
-                                print(f'A problem occurred while adding the genesis block: ', e)
+                # the chain (or what is missing of it since the last run) from all the known nodes at once
+                ChainSync(self.app).sync([node['address'] for node in available_nodes
+                                          if node['address'] != self.app.config['THIS_NODE']])
         else:
             # this node could be the first of all
             if blockchain.create_genesis_block():
@@ -91,18 +133,20 @@ class ZMQPeerToPeer(PeerToPeer):
 
     def subscribe_to_node(self, node: Node) -> bool:
         try:
-            node_subscriber = self.set_subscriber(node.address, self.broadcast_nodes_port)
-            self.node_sub_sockets.append(node_subscriber)
-            self.poller.register(node_subscriber, zmq.POLLIN)
-            self.num_of_subscribers += 1
-            chain_subscriber = self.set_subscriber(node.address, self.broadcast_chain_port)
-            self.chain_sub_sockets.append(chain_subscriber)
-            self.poller.register(chain_subscriber, zmq.POLLIN)
-            self.num_of_subscribers += 1
-            transaction_subscriber = self.set_subscriber(node.address, self.broadcast_transaction_port)
-            self.transaction_sub_sockets.append(transaction_subscriber)
-            self.poller.register(transaction_subscriber, zmq.POLLIN)
-            self.num_of_subscribers += 1
+            if self.topic_port is not None:
+                subscriber = self.set_subscriber(node.address, self.topic_port, topics=self.TOPICS,
+                                                 options=self.socket_options())
+                self.register_subscriber(subscriber, self.topic_sub_sockets, None)
+                return True
+            node_subscriber = self.set_subscriber(node.address, self.broadcast_nodes_port,
+                                                  options=self.socket_options('node'))
+            self.register_subscriber(node_subscriber, self.node_sub_sockets, 'node')
+            chain_subscriber = self.set_subscriber(node.address, self.broadcast_chain_port,
+                                                   options=self.socket_options('chain'))
+            self.register_subscriber(chain_subscriber, self.chain_sub_sockets, 'chain')
+            transaction_subscriber = self.set_subscriber(node.address, self.broadcast_transaction_port,
+                                                         options=self.socket_options('transaction'))
+            self.register_subscriber(transaction_subscriber, self.transaction_sub_sockets, 'transaction')
             return True
         except zmq.error.ZMQError as e:
             print(f'Node: {self.app.config["THIS_NODE"]} could not be subscribed to {node.address}', e)
@@ -111,9 +155,18 @@ class ZMQPeerToPeer(PeerToPeer):
             print(f'Node: {self.app.config["THIS_NODE"]} could not be subscribed to {node.address}', e)
             return False
 
-    def set_publisher(self, port):
+    def register_subscriber(self, subscriber: zmq.Socket, sockets: list, topic: Optional[str]):
+        """:param topic: None when the messages of the socket come with a topic frame"""
+        if subscriber is None:
+            # set_subscriber already told why
+            return
+        sockets.append(subscriber)
+        self.reactor.add(subscriber, topic)
+        self.num_of_subscribers += 1
+
+    def set_publisher(self, port, options: dict = None):
         try:
-            publisher = ZMQPublisher(port)
+            publisher = ZMQPublisher(port, options, nodrop=self.app.config.get('ZMQ_PUBLISHER_NODROP', False))
             print(f'Publisher broadcasting at: tcp://*:{port}')
             self.num_of_publishers += 1
             return publisher
@@ -122,11 +175,14 @@ class ZMQPeerToPeer(PeerToPeer):
         except Exception as e:
             print('Problem at set_publisher: ', e)
 
-    def set_subscriber(self, address, port) -> Union[zmq.Socket, Exception]:
+    def set_subscriber(self, address, port, topics: Tuple[str, ...] = ('',),
+                       options: dict = None) -> Union[zmq.Socket, Exception]:
         try:
             subscriber = self.context.socket(zmq.SUB)
+            set_socket_options(subscriber, options or {})
             subscriber.connect(f'tcp://{address}:{port}')
-            subscriber.setsockopt_string(zmq.SUBSCRIBE, '')
+            for topic in topics:
+                subscriber.setsockopt_string(zmq.SUBSCRIBE, topic)
             print(f'Node {self.app.config["THIS_NODE"]} subscribed to {address} ready on port: {port}')
             return subscriber
         except zmq.error.ZMQError as e:
@@ -134,151 +190,168 @@ class ZMQPeerToPeer(PeerToPeer):
         except Exception as e:
             print('Problem at set_subscriber: ', e)
 
+    def topic_of(self, publisher) -> Optional[str]:
+        if self.topic_port is not None:
+            # a single publisher carries every topic, the callers have to name it
+            return None
+        return {
+            self.node_publisher: 'node',
+            self.chain_publisher: 'chain',
+            self.transaction_publisher: 'transaction',
+        }.get(publisher)
+
     def broadcast(self, publisher, data, topic=None) -> bool:
         try:
-            _data = json.dumps(data, sort_keys=True, ensure_ascii=False)
-            publisher.send_json(_data)
-            print(f'Just broadcast: {_data}')
+            topic = topic or self.topic_of(publisher)
+            if topic == 'transaction' and self.flow_control is not None and not self.flow_control.acquire():
+                print('Transactions held back, a node ran out of credit.')
+                return False
+            if not self.send(publisher, data, topic):
+                return False
+            print(f'Just broadcast: {data}')
             return True
         except Exception as e:
             print(f'Problems broadcasting: ', e)
             return False
 
-    def receive_transaction(self):
-        socks = dict(self.poller.poll(1000))
+    def send(self, publisher, data, topic: Optional[str]) -> bool:
+        """:return: False if the publisher dropped the message"""
+        # the subscribers of a shared port filter by the topic frame
+        frame = topic if self.topic_port is not None else None
+        if self.topic_port is not None and topic is None:
+            raise ValueError('a topic is needed to broadcast on the shared port')
+        # a full subscriber must not cost a block to the others: retried for a while, then sent to those with room
+        retry_ms = self.app.config.get('ZMQ_CHAIN_SEND_RETRY_MS', 1000) if topic == 'chain' else 0
+        if self.app.config.get('WIRE_FORMAT', wire.BINARY) == wire.JSON:
+            # legacy format, kept for debugging and for nodes that do not speak the binary one
+            return publisher.send_json(json.dumps(data, sort_keys=True, ensure_ascii=False), frame, retry_ms)
+        message = wire.encode(data, topic)
+        if not publisher.send(message, frame, retry_ms):
+            return False
+        if topic == 'chain':
+            # its echo (this node subscribes to itself) and the relays of other nodes are dropped unread;
+            # transactions are not, a node learns about its own ones through the echo
+            self.mark_handled(topic, wire.message_id(message))
+        return True
 
-        for transaction_sub_socket in self.transaction_sub_sockets:
-            try:
-                if transaction_sub_socket in socks:
-                    transaction: dict = json.loads(transaction_sub_socket.recv_json())
-                    if transaction['id'] != 'None':
-                        transaction_id = transaction['id']
-                    else:
-                        transactions = Transaction.query.all()
-                        transaction_id = len(transactions) + 1
-                    received_public_key = transaction['public_key'].split(' ')
-                    x = int(received_public_key[1].strip()[:-2], 16)
-                    y = int(received_public_key[2].strip()[:-4], 16)
-                    public_key = Point(x, y, curve=curve.secp256k1)
-                    transaction_data_string = transaction['transaction_data_string']
-                    signature = tuple(json.loads(transaction['signature']))
-                    valid = ecdsa.verify(signature, str(transaction_data_string), public_key, curve.secp256k1, ecdsa.sha256)
-                    # if we ratify the transaction sent is valid we store it in the database
-                    if valid:
-                        transaction_db = Transaction()
-                        transaction_db.id = transaction_id
-                        transaction_db.public_key = public_key
-                        transaction_db.transaction_data_string = transaction_data_string
-                        transaction_db.signature = json.dumps(signature)
-                        transaction_db.valid = valid
-                        try:
-                            db.session.add(transaction_db)
-                            db.session.commit()
-                            print(f'Transaction: {transaction_id} added.')
-                            transactions = Transaction.query.all()
-                            if len(transactions) >= self.app.config['TRANSACTIONS_AMOUNT']:
-                                blockchain = Blockchain(self.app)
-                                # proof_work generates a new block
-                                new_block = blockchain.proof_of_work()
-                                db.session.add(new_block)
-                                self.broadcast(self.chain_publisher, blockchain.get_blocks_as_list_of_dict())
-                                db.session.query(Transaction).delete()
-                                db.session.commit()
-                        except SQLAlchemyError as e:
-                            print(f'Transaction {transaction_id} could not be added: ', e)
-                            continue
-                    else:
-                        print(f'Transaction: {transaction_id} is not valid.')
-            except zmq.ZMQError as e:
-                # Handle the error
-                print(f"ZMQError at receiving transaction: {e}")
-            except Exception as e:
-                print(f'Problem receiving transaction: ', e)
-                continue
-
-    def receive_node(self):
-        socks = dict(self.poller.poll(1000))
-
-        # Handle incoming messages from all subscribed sockets
-        for node_sub_socket in self.node_sub_sockets:
-            if node_sub_socket in socks:
-                node: dict = json.loads(node_sub_socket.recv_json())
-                received_node = Node(address=node['address'])
-                if node['id'] != 'None':
-                    received_node.id = node['id']
-                else:
-                    received_node.id = None
-                print(f'{received_node.id}, {received_node.address} arrived to {self.app.config["THIS_NODE"]}')
-                try:
-                    existing_nodes = Node.query.filter_by(address=received_node.address).all()
-                    if len(existing_nodes) >= 1:
-                        Node.query.filter_by(address=received_node.address).delete()
-                        db.session.commit()
-                        db.session.add(received_node)
-                        db.session.commit()
-                        print(f'Broadcast node: there was at least one node with the same address: {received_node.address}')
-                        # continue
-                        # raise Exception(f'Broadcast node: there is at least one node with the same address: {received_node.address}')
-                    # TODO check if it's necessary to swap the ids
-                    # elif len(existing_node) == 1:
-                    #     _nodes = Node.query.all()
-                    #     existing_node.id = len(_nodes) + 1
-                    #     db.session.add(received_node)
-                    #     db.session.add(existing_node)
-                    #     db.session.commit()
-                    #     print(f'Node: {received_node.id}, {received_node.address} already registered.')
-                    else:
-                        # Fresh node
-                        db.session.add(received_node)
-                        db.session.commit()
-                        print(f'Node: {received_node.id}, {received_node.address} added.')
-                        self.subscribe_to_node(received_node)
-                        print(f'{self.app.config["THIS_NODE"]} subscribed to {received_node.address}')
-                except SQLAlchemyError as e:
-                    # TODO make it more elegant instead of just spit the exception
-                    print(f'Node {received_node.id}, {received_node.address} could not be added: ', e)
-                    db.session.rollback()
-                except Exception as e:
-                    print(f'A problem occurred ', e)
-                    # raise Exception(f'A problem occurred ', e)
-
-    def receive_chain(self):
-        socks = dict(self.poller.poll(1000))
+    def transactions_idle(self):
+        super().transactions_idle()
+        if self.flow_control is not None:
+            self.advertise_credit()
+
+    def advertise_credit(self):
+        """
+        Tells the other nodes how many more transaction messages this one can take from each of them, every
+        TRANSACTION_CREDIT_INTERVAL_MS at most: what is left of TRANSACTION_CREDIT_WINDOW once the messages still
+        waiting to be handled are taken out, shared among all the senders. See `CreditGate`.
+        """
+        now = time.monotonic()
+        if (now - self.credit_advertised_at) * 1000 < self.app.config.get('TRANSACTION_CREDIT_INTERVAL_MS', 100):
+            return
+        self.credit_advertised_at = now
+        window = self.app.config.get('TRANSACTION_CREDIT_WINDOW', 1000) - self.reactor.backlog('transaction')
+        # this node sends to itself too
+        credit = max(window, 0) // max(Node.query.count(), 1)
+        # not through `broadcast`, it would log every advertisement
+        self.send(self.node_publisher, {'origin': self.app.config['THIS_NODE'], 'credit': credit}, 'node')
+
+    def transport_stats(self) -> dict:
+        publishers = {id(publisher): publisher for publisher in
+                      (self.node_publisher, self.chain_publisher, self.transaction_publisher) if publisher is not None}
+        return {
+            'publishers': [publisher.stats() for publisher in publishers.values()],
+            'receiving': self.reactor.stats(),
+            'flow_control': self.flow_control.stats() if self.flow_control is not None else None,
+        }
+
+    def broadcast_batch(self, publisher, items, topic=None) -> bool:
+        # the whole batch travels as one message
+        return self.broadcast(publisher, list(items), topic)
+
+    def handle_transactions(self, messages: list):
+        transactions = []
+        for message in messages:
+            # a batch submitted through the API arrives as a single message
+            transactions.extend(message if isinstance(message, list) else [message])
+        self.process_transactions(transactions)
+        for message in messages:
+            message_id = wire.content_id(message, 'transaction')
+            if message_id is not None and self.mempool.seen(message_id.hex()):
+                self.mark_handled('transaction', message_id)
 
+    def handle_nodes(self, messages: list):
+        for node in messages:
+            self.handle_node(node)
+
+    def handle_node(self, node: dict):
+        if 'credit' in node:
+            # flow control advertisement, see `advertise_credit`; only the nodes of the network are waited for
+            if self.flow_control is not None and Node.query.filter_by(address=node.get('origin')).first() is not None:
+                self.flow_control.grant(node['origin'], int(node['credit']))
+            return
+        received_node = Node(address=node['address'])
+        if node['id'] != 'None':
+            received_node.id = node['id']
+        else:
+            received_node.id = None
+        print(f'{received_node.id}, {received_node.address} arrived to {self.app.config["THIS_NODE"]}')
         try:
-            # Handle incoming messages from all subscribed sockets
-            for chain_sub_socket in self.chain_sub_sockets:
-                if chain_sub_socket in socks:
-                    received_blocks = json.loads(chain_sub_socket.recv_json())
-                    stored_blocks = Block.query.all()
-                    if len(received_blocks) > len(stored_blocks):
-                        # first we check the received blocks against what we already have
-                        for i in range(len(stored_blocks)):
-                            if stored_blocks[i].as_dict() != received_blocks[i]:
-                                print(f'Inconsistency in the chain received compared with the one we already have')
-                                continue
-                        try:
-                            # what we have is shorter than what we received
-                            num_blocks_deleted = db.session.query(Block).delete()
-                            print(f'Updating chain: {num_blocks_deleted} blocks deleted.')
-                            for block in received_blocks:
-                                new_block = Block()
-                                [setattr(new_block, key, block[key]) for key in block]
-                                db.session.add(new_block)
-                            db.session.commit()
-                            print(f'Chain updated and broadcast.')
-                            self.broadcast(self.chain_publisher, received_blocks)
-                            # TODO: delete only required, here we are wiping out everything
-                            db.session.query(Transaction).delete()
-                            db.session.commit()
-                        except SQLAlchemyError as e:
-                            print(f'Chain could not be updated: ', e)
-                            db.session.rollback()
-        except zmq.ZMQError as e:
-            # Handle the error
-            print(f"ZMQError at receiving chain: {e}")
+            existing_nodes = Node.query.filter_by(address=received_node.address).all()
+            if len(existing_nodes) >= 1:
+                Node.query.filter_by(address=received_node.address).delete()
+                db.session.commit()
+                db.session.add(received_node)
+                db.session.commit()
+                print(f'Broadcast node: there was at least one node with the same address: {received_node.address}')
+                # continue
+                # raise Exception(f'Broadcast node: there is at least one node with the same address: {received_node.address}')
+            # TODO check if it's necessary to swap the ids
+            # elif len(existing_node) == 1:
+            #     _nodes = Node.query.all()
+            #     existing_node.id = len(_nodes) + 1
+            #     db.session.add(received_node)
+            #     db.session.add(existing_node)
+            #     db.session.commit()
+            #     print(f'Node: {received_node.id}, {received_node.address} already registered.')
+            else:
+                # Fresh node
+                db.session.add(received_node)
+                db.session.commit()
+                print(f'Node: {received_node.id}, {received_node.address} added.')
+                self.subscribe_to_node(received_node)
+                print(f'{self.app.config["THIS_NODE"]} subscribed to {received_node.address}')
+        except SQLAlchemyError as e:
+            # TODO make it more elegant instead of just spit the exception
+            print(f'Node {received_node.id}, {received_node.address} could not be added: ', e)
+            db.session.rollback()
         except Exception as e:
-            print(f'A problem occurred receiving chain: ', e)
+            print(f'A problem occurred ', e)
+            # raise Exception(f'A problem occurred ', e)
+
+    def handle_chains(self, messages: list):
+        for message in messages:
+            try:
+                self.handle_chain(message)
+            except Exception as e:
+                print(f'A problem occurred receiving chain: ', e)
+
+    def handle_chain(self, received_blocks):
+        if not self.is_new_blocks_message(received_blocks):
+            # a whole chain sent by an older node, the blocks we already know are skipped
+            received_blocks = {'origin': None, 'blocks': received_blocks}
+        self.receive_blocks(received_blocks)
+        if all(isinstance(block, dict) and BlockTree.get(block.get('hash')) is not None
+               for block in received_blocks['blocks']):
+            self.mark_handled('chain', wire.content_id(received_blocks, 'chain'))
+
+    def mark_handled(self, topic: str, message_id: Optional[bytes]):
+        """
+        The relays of a message handled successfully are dropped unread from now on. The id is recomputed out of the
+        message (see `wire.content_id`), never taken from the envelope: a junk message sent under the id of a real one
+        must not get the real one dropped.
+        """
+        if message_id is not None:
+            self.seen.add((topic, message_id))
 
     def add_node(self, node: Node) -> bool:
         if node.address != self.app.config['THIS_NODE']:
@@ -337,9 +410,17 @@ class ZMQPeerToPeer(PeerToPeer):
                 last_octet = int(self.app.config['THIS_NODE'].split('.')[-1])
                 address = f'{last_octet}.0.0.{counter}'
                 node = Node(address=address)
-                self.broadcast(self.node_publisher, node.as_dict())
+                self.broadcast(self.node_publisher, node.as_dict(), topic='node')
                 time.sleep(15)
 
 
+class ZMQPeerToPeer(BaseZMQPeerToPeer):
+    """
+    The ZMQ backend with every subscriber socket read by a `ZMQReactor` thread, the only one touching them: the
+    messages are handed to a worker thread per topic.
+    """
+    _instance = None
+
+
 def create_zmq(app):
     return ZMQPeerToPeer(app)
@@ -0,0 +1,212 @@
+import queue
+import threading
+import zmq
+
+from collections import defaultdict
+from typing import Callable, List, Optional, Tuple
+
+from src import wire
+from src.seen_cache import SeenCache
+
+
+class TopicWorker:
+    """
+    Runs the handler of one topic in its own thread, fed through a bounded queue. What does not fit in the queue is
+    dropped and counted, the receiving thread never waits for the database.
+    """
+
+    def __init__(self, topic: str, handler: Callable[[list], None], queue_size: int,
+                 idle: Optional[Callable[[], None]] = None, idle_ms: int = 1000):
+        """
+        :param handler: called with the messages received together, decoded
+        :param idle: called after every batch and every `idle_ms` without any message, e.g. for timed commits
+        """
+        self.topic = topic
+        self.handler = handler
+        self.idle = idle
+        self.idle_ms = idle_ms
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        # messages queued or being handled
+        self.backlog = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def put(self, messages: list) -> bool:
+        try:
+            self.queue.put_nowait(messages)
+            with self.lock:
+                self.backlog += len(messages)
+            return True
+        except queue.Full:
+            self.dropped += len(messages)
+            print(f'{self.topic} worker busy, {len(messages)} messages dropped ({self.dropped} so far).')
+            return False
+
+    def start(self, app):
+        self.thread = threading.Thread(target=self.run, args=(app,), daemon=True)
+        self.thread.start()
+
+    def run(self, app):
+        with app.app_context():
+            while True:
+                try:
+                    messages = self.queue.get(timeout=self.idle_ms / 1000)
+                except queue.Empty:
+                    messages = []
+                if messages is None:
+                    return
+                if messages:
+                    try:
+                        self.handler(messages)
+                    except Exception as e:
+                        print(f'A problem occurred handling {self.topic} messages: ', e)
+                    with self.lock:
+                        self.backlog -= len(messages)
+                if self.idle is not None:
+                    try:
+                        self.idle()
+                    except Exception as e:
+                        print(f'A problem occurred in the {self.topic} idle tasks: ', e)
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+class ZMQReactor:
+    """
+    A single thread owns every subscriber socket: it waits on all of them at once, decodes what arrives and hands it
+    to the worker of its topic (see `TopicWorker`). A socket either carries a single topic or, subscribed to several
+    of them on one port, prefixes every message with a topic frame. Sockets created by other threads are passed over
+    with `add` and the poll is woken up through an inproc pair, so a new subscription or a message is picked up right
+    away instead of at the next poll timeout. With a `SeenCache`, messages whose envelope id is in it are dropped
+    before decoding them. The reactor never fills it, the handlers add the ids of the messages they handled.
+    """
+
+    def __init__(self, context: zmq.Context, queue_size: int = 1000, batch_size: int = 64,
+                 seen: Optional[SeenCache] = None):
+        """
+        :param batch_size: how many messages are read from one socket before looking at the others
+        :param seen: keyed by (topic, message id), see `wire.content_id`
+        """
+        self.context = context
+        self.seen = seen
+        self.duplicates = defaultdict(int)
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.poller = zmq.Poller()
+        self.topics = {}
+        self.workers = {}
+        self.added = queue.Queue()
+        self.running = False
+        self.thread = None
+        wake_address = f'inproc://zmq-reactor-{id(self)}'
+        self.wake_receiver = context.socket(zmq.PAIR)
+        self.wake_receiver.bind(wake_address)
+        self.wake_sender = context.socket(zmq.PAIR)
+        self.wake_sender.connect(wake_address)
+        self.wake_lock = threading.Lock()
+        self.poller.register(self.wake_receiver, zmq.POLLIN)
+
+    def on(self, topic: str, handler: Callable[[list], None], idle: Optional[Callable[[], None]] = None,
+           idle_ms: int = 1000):
+        """Sets the handler of a topic, before `start`."""
+        self.workers[topic] = TopicWorker(topic, handler, self.queue_size, idle, idle_ms)
+
+    def add(self, socket: zmq.Socket, topic: Optional[str] = None):
+        """
+        Hands a subscriber socket over to the reactor, the caller must not use it any more. Thread safe.
+        :param topic: of every message of the socket, None when they come with a topic frame
+        """
+        self.added.put((socket, topic))
+        self.wake()
+
+    def wake(self):
+        with self.wake_lock:
+            self.wake_sender.send(b'')
+
+    def start(self, app) -> List[threading.Thread]:
+        for worker in self.workers.values():
+            worker.start(app)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return [self.thread] + [worker.thread for worker in self.workers.values()]
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for worker in self.workers.values():
+            worker.stop()
+
+    def run(self):
+        while self.running:
+            events = dict(self.poller.poll())
+            if self.wake_receiver in events:
+                self._drain_wakeups()
+            received = defaultdict(list)
+            for socket, topic in self.topics.items():
+                if socket in events:
+                    for message_topic, message in self._read(socket, topic):
+                        received[message_topic].append(message)
+            for topic, messages in received.items():
+                if topic in self.workers:
+                    self.workers[topic].put(messages)
+                else:
+                    print(f'No handler for topic {topic}, {len(messages)} messages dropped.')
+
+    def _drain_wakeups(self):
+        while True:
+            try:
+                self.wake_receiver.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+        while True:
+            try:
+                socket, topic = self.added.get_nowait()
+            except queue.Empty:
+                break
+            if topic is not None and topic not in self.workers:
+                print(f'No handler for topic {topic}, socket ignored.')
+                continue
+            self.topics[socket] = topic
+            self.poller.register(socket, zmq.POLLIN)
+
+    def _read(self, socket: zmq.Socket, topic: Optional[str]) -> List[Tuple[str, object]]:
+        """:return: the (topic, decoded message) pairs read"""
+        messages = []
+        while len(messages) < self.batch_size:
+            try:
+                if topic is None:
+                    frame, payload = socket.recv_multipart(zmq.NOBLOCK)
+                    message_topic = frame.decode()
+                else:
+                    message_topic, payload = topic, socket.recv(zmq.NOBLOCK)
+                message_id = wire.message_id(payload) if self.seen is not None else None
+                if message_id is not None and (message_topic, message_id) in self.seen:
+                    self.duplicates[message_topic] += 1
+                    continue
+                messages.append((message_topic, wire.decode(payload)))
+            except zmq.Again:
+                break
+            except zmq.ZMQError as e:
+                print(f'ZMQError at receiving {topic}: {e}')
+                break
+            except Exception as e:
+                print(f'Problem decoding {topic} message: ', e)
+        return messages
+
+    def backlog(self, topic: str) -> int:
+        """How many messages of `topic` were received and not handled yet."""
+        return self.workers[topic].backlog if topic in self.workers else 0
+
+    def stats(self) -> dict:
+        return {topic: {'queued': worker.queue.qsize(), 'backlog': worker.backlog, 'dropped': worker.dropped,
+                        'duplicates': self.duplicates[topic]}
+                for topic, worker in self.workers.items()}
@@ -1,20 +1,84 @@
+import json
+import threading
+import time
 import zmq
 
 
+def set_socket_options(socket: zmq.Socket, options: dict):
+    """:param options: by ZMQ option name, e.g. {'SNDHWM': 10000, 'LINGER': 0}; before bind or connect"""
+    for name, value in options.items():
+        socket.setsockopt(getattr(zmq, name.upper()), value)
+
+
 class ZMQPublisher:
+    """
+    A PUB socket per port. A PUB socket silently drops what a slow subscriber has no room for (see SNDHWM); with
+    `nodrop` it is an XPUB socket with XPUB_NODROP instead, a message that does not fit is not sent at all and it is
+    counted as dropped. A message retried for too long goes out anyway to the subscribers that have room, and it is
+    counted as dropped for the full ones.
+    """
     _instances = {}
     context = zmq.Context()
 
-    def __new__(cls, port):
+    def __new__(cls, port, options: dict = None, nodrop: bool = False):
         if port not in cls._instances:
             instance = super().__new__(cls)
-            instance.socket = cls.context.socket(zmq.PUB)
+            instance.port = port
+            instance.nodrop = nodrop
+            instance.socket = cls.context.socket(zmq.XPUB if nodrop else zmq.PUB)
+            if nodrop:
+                instance.socket.setsockopt(zmq.XPUB_NODROP, 1)
+            set_socket_options(instance.socket, options or {})
             instance.socket.bind(f'tcp://*:{port}')
+            instance.sent = 0
+            instance.dropped = 0
+            instance.lock = threading.Lock()
             cls._instances[port] = instance
         return cls._instances[port]
 
-    def send_json(self, data):
-        self.socket.send_json(data)
+    def send_json(self, data, topic: str = None, retry_ms: int = 0) -> bool:
+        return self.send(json.dumps(data).encode(), topic, retry_ms)
+
+    def send(self, message: bytes, topic: str = None, retry_ms: int = 0) -> bool:
+        """
+        :param topic: sent as a first frame, for the subscribers filtering by topic on a shared port
+        :param retry_ms: how long to keep trying when a subscriber is full, for the messages that must not be lost;
+        then they are sent to the others
+        :return: False if the message was not sent at all because a subscriber is too far behind
+        """
+        frames = [message] if topic is None else [topic.encode(), message]
+        deadline = time.monotonic() + retry_ms / 1000
+        while True:
+            # the API, the miner and the receiving workers all publish
+            with self.lock:
+                try:
+                    self.socket.send_multipart(frames, flags=zmq.NOBLOCK if self.nodrop else 0)
+                    self.sent += 1
+                    return True
+                except zmq.Again:
+                    if time.monotonic() >= deadline:
+                        self.dropped += 1
+                        if retry_ms:
+                            self._send_lossy(frames)
+                            print(f'Publisher at port {self.port}: a subscriber is full, message dropped for it '
+                                  f'({self.dropped} so far).')
+                            return True
+                        print(f'Publisher at port {self.port}: a subscriber is full, message dropped '
+                              f'({self.dropped} so far).')
+                        return False
+            time.sleep(0.01)
+
+    def _send_lossy(self, frames: list):
+        """Sends like a PUB socket, the full subscribers miss the message. Under `lock`."""
+        self.socket.setsockopt(zmq.XPUB_NODROP, 0)
+        try:
+            self.socket.send_multipart(frames, flags=zmq.NOBLOCK)
+        finally:
+            self.socket.setsockopt(zmq.XPUB_NODROP, 1)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'port': self.port, 'nodrop': self.nodrop, 'sent': self.sent, 'dropped': self.dropped}
 
     def close(self):
         self.socket.close()